@@ -6,9 +6,11 @@ import sys
 import os
 import os.path
 import itertools
+import json
 
 from mrtarget.modules.Evidences import process_evidences_pipeline
 from mrtarget.common.connection import new_es_client
+from mrtarget.common.esutil import load_bulk_folder, finalize_index
 from mrtarget.modules.Association import ScoringProcess
 from mrtarget.modules.DataDrivenRelation import DataDrivenRelationProcess
 from mrtarget.modules.ECO import EcoProcess
@@ -20,6 +22,8 @@ from mrtarget.modules.Reactome import ReactomeProcess
 from mrtarget.modules.SearchObjects import SearchObjectProcess
 from mrtarget.modules.Drug import DrugProcess
 
+from opentargets_urlzsource import URLZSource
+
 import mrtarget.cfg
 
 def main():
@@ -59,12 +63,34 @@ def main():
     #create something to accumulate qc metrics into over various steps
     qc_metrics = QCMetrics()
 
+    #how all the stages send bulk requests to elasticsearch
+    es_bulk = {
+        "max_chunk_bytes": args.elasticsearch_bulk_bytes,
+        "max_chunk_actions": args.elasticsearch_bulk_actions,
+        "max_retries": args.elasticsearch_bulk_retries,
+        "dead_letter": args.elasticsearch_dead_letter,
+        "alias": args.elasticsearch_alias,
+        "finalize": args.elasticsearch_finalize,
+        "status_timeout": args.elasticsearch_status_timeout,
+    }
+
+    if args.load:
+        if not args.elasticsearch_folder:
+            logger.error("--load needs --elasticsearch-folder")
+            return 1
+        for index, count in sorted(load_bulk_folder(es, args.elasticsearch_folder, **es_bulk).items()):
+            logger.info("loaded %d documents into %s", count, index)
+
+    if args.elasticsearch_folder and not args.skip_qc:
+        #the qc queries the indexes, which are only in files until they are loaded
+        logger.info("skipping qc of the stages written to %s", args.elasticsearch_folder)
+        args.skip_qc = True
 
     if args.rea:
         process = ReactomeProcess(args.elasticseach_nodes, es_config.rea.name, 
             es_config.rea.mapping, es_config.rea.setting,
             data_config.reactome_pathway_data, data_config.reactome_pathway_relation,
-            args.rea_workers_writer, args.rea_queue_write)
+            args.rea_workers_writer, args.rea_queue_write, args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
@@ -75,7 +101,7 @@ def main():
             es_config.gen.mapping, es_config.gen.setting, 
             args.gen_plugin_places, data_config.gene_data_plugin_names,
             data_config, es_config,
-            args.gen_workers_writer, args.gen_queue_write )
+            args.gen_workers_writer, args.gen_queue_write, args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.merge_all(args.dry_run)
         if not args.skip_qc:
@@ -86,7 +112,7 @@ def main():
             es_config.efo.mapping, es_config.efo.setting, 
             data_config.ontology_efo, data_config.ontology_hpo, 
             data_config.ontology_mp, data_config.disease_phenotype,
-            args.efo_workers_writer, args.efo_queue_write)
+            args.efo_workers_writer, args.efo_queue_write, args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
@@ -95,14 +121,14 @@ def main():
         process = EcoProcess(args.elasticseach_nodes, es_config.eco.name, 
             es_config.eco.mapping, es_config.eco.setting,
             data_config.ontology_eco, data_config.ontology_so,
-            args.eco_workers_writer, args.eco_queue_write)
+            args.eco_workers_writer, args.eco_queue_write, args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
             qc_metrics.update(process.qc(es, es_config.eco.name))
 
     if args.val:
-        process_evidences_pipeline(data_config.input_file, args.val_first_n,
+        metrics = process_evidences_pipeline(data_config.input_file, args.val_first_n,
             args.elasticseach_nodes, es_config.val_right.name, es_config.val_wrong.name, 
             es_config.val_right.mapping, es_config.val_wrong.mapping, 
             es_config.val_right.setting, es_config.val_wrong.setting, 
@@ -111,12 +137,19 @@ def main():
             args.val_append_data,
             args.val_workers_validator, args.val_queue_validator,
             args.val_workers_writer, args.val_queue_validator_writer,
+            args.val_batch_lines, args.val_batch_bytes,
+            args.val_workers_reader, args.val_split_bytes,
             args.val_cache_target, args.val_cache_target_u2e, args.val_cache_target_contains,
             args.val_cache_eco, args.val_cache_efo, args.val_cache_efo_contains,
             data_config.eco_scores, data_config.schema,
-            data_config.excluded_biotypes, data_config.datasources_to_datatypes)
-
-        #TODO qc
+            data_config.excluded_biotypes, data_config.datasources_to_datatypes,
+            args.val_hash, args.val_preload, args.val_cache,
+            args.val_checkpoint, args.val_resume,
+            args.val_dedup, args.val_dedup_capacity,
+            args.val_prefilter, args.val_route_by_target, args.val_index_sort,
+            es_folder=args.elasticsearch_folder, es_bulk=es_bulk)
+        if not args.skip_qc:
+            qc_metrics.update(metrics)
 
     if args.hpa:
         process = HPAProcess(args.elasticseach_nodes, es_config.hpa.name, 
@@ -124,7 +157,7 @@ def main():
                 data_config.tissue_translation_map, data_config.tissue_curation_map,
                 data_config.hpa_normal_tissue, data_config.hpa_rna_level, 
                 data_config.hpa_rna_value, data_config.hpa_rna_zscore,
-                args.hpa_workers_writer, args.hpa_queue_write)
+                args.hpa_workers_writer, args.hpa_queue_write, args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
@@ -137,11 +170,19 @@ def main():
                 args.as_workers_writer, args.as_workers_production, args.as_workers_score, 
                 args.as_queue_score, args.as_queue_production, args.as_queue_write,
                 args.as_cache_hpa, args.as_cache_efo, args.as_cache_target, 
+                args.as_cache_target_fragment, args.as_cache_disease_fragment,
                 data_config.scoring_weights, data_config.is_direct_do_not_propagate,
-                data_config.datasources_to_datatypes)
+                data_config.datasources_to_datatypes,
+                args.as_evidence_reader, args.as_evidence_slices, args.as_queue_evidence,
+                args.as_pipeline, args.as_manifest, args.as_incremental,
+                args.as_shard, args.as_shards,
+                args.as_schedule, args.as_split_evidence, args.as_weightings,
+                args.as_partials, args.as_partials_datasource, args.elasticsearch_folder, es_bulk,
+                args.as_shard_timeout)
         if not args.qc_only:
             process.process_all(args.dry_run)
-        if not args.skip_qc:
+        #only the first shard sees the complete index
+        if not args.skip_qc and args.as_shard == 0:
             qc_metrics.update(process.qc(es, es_config.asc.name))
         
     if args.ddr:
@@ -156,7 +197,8 @@ def main():
                 args.ddr_queue_score_result,
                 args.ddr_queue_write,
                 data_config.ddr["score-threshold"],
-                data_config.ddr["evidence-count"])
+                data_config.ddr["evidence-count"],
+                args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         #TODO qc
@@ -173,7 +215,8 @@ def main():
                 data_config.chembl_mechanism, 
                 data_config.chembl_component, 
                 data_config.chembl_protein, 
-                data_config.chembl_molecule)
+                data_config.chembl_molecule,
+                args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         #TODO qc
@@ -192,12 +235,23 @@ def main():
                 data_config.chembl_molecule,
                 data_config.chembl_indication,
                 data_config.adverse_events,
-                data_config.drugbank)
+                data_config.drugbank,
+                args.elasticsearch_folder, es_bulk)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
             qc_metrics.update(process.qc(es, es_config.drg.name))
 
+    if args.finalize:
+        #the indexes of all the stages, whichever run loaded them
+        for key, index in sorted(es_config.items()):
+            if not es.indices.exists(index=index.name):
+                continue
+            with URLZSource(index.setting).open() as settings_file:
+                settings = json.load(settings_file)
+            replicas = settings.get("index", settings).get("number_of_replicas")
+            finalize_index(es, index.name, replicas, args.elasticsearch_status_timeout)
+
     if args.qc_in:
         #handle reading in previous qc from filename provided, and adding comparitive metrics
         qc_metrics.compare_with(args.qc_in)
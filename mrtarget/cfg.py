@@ -43,7 +43,23 @@ def setup_ops_parser():
         # to do it ourselves later. Otherwise the "default" is always present and
         # values are appended to it.
     p.add("--elasticsearch-folder", help="write to files instead of a live elasticsearch server",
-        action='store') #this only applies to --val at the moment
+        env_var='ELASTICSEARCH_FOLDER', action='store')
+    # bulk requests are bounded by bytes and actions, rejected actions are retried
+    p.add("--elasticsearch-bulk-bytes", help="largest bulk request in bytes",
+        env_var='ELASTICSEARCH_BULK_BYTES', action='store', default=10*1024*1024, type=int)
+    p.add("--elasticsearch-bulk-actions", help="most actions in a bulk request",
+        env_var='ELASTICSEARCH_BULK_ACTIONS', action='store', default=10000, type=int)
+    p.add("--elasticsearch-bulk-retries", help="times an action rejected by an overloaded cluster is retried",
+        env_var='ELASTICSEARCH_BULK_RETRIES', action='store', default=5, type=int)
+    p.add("--elasticsearch-dead-letter", help="file to append the bulk actions that failed to",
+        env_var='ELASTICSEARCH_DEAD_LETTER', action='store')
+    # indexes are built beside the live ones and replace them once complete
+    p.add("--elasticsearch-alias", help="load each index into a new version and move an alias named as the index to it",
+        env_var='ELASTICSEARCH_ALIAS', action='store_true', default=False)
+    p.add("--elasticsearch-finalize", help="after loading an index, wait for its merge and replicas, only start the merge, or defer both to --finalize",
+        env_var='ELASTICSEARCH_FINALIZE', action='store', default='wait', choices=['wait', 'async', 'defer'])
+    p.add("--elasticsearch-status-timeout", help="seconds to wait for the status of an index",
+        env_var='ELASTICSEARCH_STATUS_TIMEOUT', action='store', default=3600, type=int)
 
     # process handling
     #note this is the number of workers for each parallel operation
@@ -87,8 +103,21 @@ def setup_ops_parser():
         
     p.add("--val-workers-validator", help="# of procs for validation workers",
         env_var="VAL_WORKERS_VALIDATOR", action='store', default=4, type=int)
-    p.add("--val-queue-validator", help="size of validation validator queue",
-        env_var="VAL_QUEUE_VALIDATOR", action='store', default=1000, type=int)
+    # if 0 read the files one after the other in the main process
+    # if >0 use that many processes to read files, and ranges of large uncompressed or
+    # block gzipped (bgzip) files, at the same time. Not used with --val-first-n
+    p.add("--val-workers-reader", help="# of procs for reading evidence files",
+        env_var="VAL_WORKERS_READER", action='store', default=0, type=int)
+    p.add("--val-split-bytes", help="split uncompressed and block gzipped files in ranges of this size for readers (bytes, 0 to not split)",
+        env_var="VAL_SPLIT_BYTES", action='store', default=256*1024*1024, type=int)
+    p.add("--val-queue-validator", help="size of validation validator queue (in batches)",
+        env_var="VAL_QUEUE_VALIDATOR", action='store', default=100, type=int)
+    # lines are sent to validation workers, and actions come back, in batches
+    # a batch is closed at whichever of the two limits it reaches first
+    p.add("--val-batch-lines", help="max # of lines in a batch for validation workers",
+        env_var="VAL_BATCH_LINES", action='store', default=500, type=int)
+    p.add("--val-batch-bytes", help="max size of a batch for validation workers (bytes, 0 for no limit)",
+        env_var="VAL_BATCH_BYTES", action='store', default=1024*1024, type=int)
     # if 0 use main thread for writing
     # if >0 use that many threads for writing
     p.add("--val-workers-writer", help="# of procs for validation writers",
@@ -107,8 +136,43 @@ def setup_ops_parser():
         env_var="VAL_CACHE_TARGET_U2E", action='store', default=1024*256, type=int)
     p.add("--val-cache-target-contains", help="size of validation cache for target existing (bytes)",
         env_var="VAL_CACHE_TARGET_CONTAINS", action='store', default=1024*64, type=int)
+    # reads every target and disease id once before validating, instead of
+    # each validation process querying elasticsearch for the ones it meets
+    p.add("--val-preload", help="preload all target and disease ids for validation",
+        env_var="VAL_PRELOAD", action='store_true', default=False)
+    # lines with the same content as in a previous run, with the same schema,
+    # settings and target and disease ids, are taken from this file instead of
+    # being validated again. Implies --val-preload
+    p.add("--val-cache", help="SQLite file of validated lines to reuse between runs",
+        env_var="VAL_CACHE", action='store', default=None)
+    # lines of each file that are in the indexes are recorded in this file as
+    # they are loaded, so a run that died partway through can be resumed
+    p.add("--val-checkpoint", help="file of the lines of each evidence file loaded so far",
+        env_var="VAL_CHECKPOINT", action='store', default=None)
+    p.add("--val-resume", help="resume loading the indexes of --val-checkpoint from the lines it records",
+        env_var="VAL_RESUME", action='store_true', default=False)
+    # evidence with the same unique association fields as an earlier one is
+    # dropped before it is indexed, instead of overwriting it
+    p.add("--val-dedup", help="drop duplicate evidence before indexing",
+        env_var="VAL_DEDUP", action='store_true', default=False)
+    p.add("--val-dedup-capacity", help="# of distinct evidence the memory of --val-dedup is sized for",
+        env_var="VAL_DEDUP_CAPACITY", action='store', default=10000000, type=int)
+    # lines with an unsupported sourceID or an unknown target or disease are
+    # rejected from those fields alone, without parsing or validating them
+    p.add("--val-prefilter", help="reject lines with unknown datasources, targets or diseases before parsing them",
+        env_var="VAL_PREFILTER", action='store_true', default=False)
+    # evidence is indexed with its target as routing, so the evidence of a
+    # target is in a single shard, which readers of a target then only query
+    p.add("--val-route-by-target", help="route valid evidence to shards by target",
+        env_var="VAL_ROUTE_BY_TARGET", action='store_true', default=False)
+    p.add("--val-index-sort", help="sort the segments of the valid evidence index by target and disease",
+        env_var="VAL_INDEX_SORT", action='store_true', default=False)
     p.add("--val-append-data", help="append to existing data instead of replacing existing data from a previous --val run",
         env_var="VAL_APPEND_DATA", action='store_true', default=False)
+    # evidence ids are md5 hashes of the unique association fields, any other
+    # algorithm gives different ids than previous releases but hashes faster
+    p.add("--val-hash", help="hash algorithm for evidence ids",
+        env_var="VAL_HASH", action='store', default='md5', choices=['md5', 'sha1', 'blake2b', 'xxhash'])
 
     p.add("--as-workers-production", help="# of procs for assocation pair producers",
         env_var="AS_WORKERS_PRODUCTION", action='store', default=4, type=int)
@@ -130,6 +194,53 @@ def setup_ops_parser():
         env_var="AS_CACHE_EFO", action='store', default=1024*1024*4, type=int)
     p.add("--as-cache-target", help="size of association cache for target (bytes)",
         env_var="AS_CACHE_TARGET", action='store', default=1024*512, type=int)
+    p.add("--as-cache-target-fragment", help="size of association cache for target facets and info (targets)",
+        env_var="AS_CACHE_TARGET_FRAGMENT", action='store', default=1024, type=int)
+    p.add("--as-cache-disease-fragment", help="size of association cache for disease facets and info (diseases)",
+        env_var="AS_CACHE_DISEASE_FRAGMENT", action='store', default=1024*16, type=int)
+    # target reads the evidence of each target with its own scroll
+    # sliced reads the whole evidence index once with parallel sliced scans sorted by target
+    p.add("--as-evidence-reader", help="how to read evidence for associations",
+        env_var="AS_EVIDENCE_READER", action='store', default='target', choices=['target', 'sliced'])
+    p.add("--as-evidence-slices", help="# of parallel slices for the sliced evidence reader",
+        env_var="AS_EVIDENCE_SLICES", action='store', default=4, type=int)
+    p.add("--as-queue-evidence", help="size of each sliced evidence reader queue (in documents)",
+        env_var="AS_QUEUE_EVIDENCE", action='store', default=10000, type=int)
+    # staged uses separate producer and scorer processes
+    # fused uses --as-workers-score processes that each handle whole targets
+    # and send serialized associations to the writers
+    p.add("--as-pipeline", help="layout of the association processes",
+        env_var="AS_PIPELINE", action='store', default='staged', choices=['staged', 'fused'])
+    # the manifest is written after each run with a digest of the evidence of each target
+    # incremental runs only rescore the targets whose digest changed and delete the others
+    p.add("--as-manifest", help="TSV file of per-target evidence digests to write/read",
+        env_var="AS_MANIFEST", action='store', default=None)
+    p.add("--as-incremental", help="only rescore targets whose evidence changed since the --as-manifest run",
+        env_var="AS_INCREMENTAL", action='store_true', default=False)
+    # shards split the targets by a hash of their id so several machines can write
+    # to the same index, the first shard creates and finalizes the index
+    p.add("--as-shard", help="shard of the targets to score, from 0 to --as-shards - 1",
+        env_var="AS_SHARD", action='store', default=0, type=int)
+    p.add("--as-shards", help="# of shards the targets are split into",
+        env_var="AS_SHARDS", action='store', default=1, type=int)
+    p.add("--as-shard-timeout", help="seconds a shard waits for the other shards before failing",
+        env_var="AS_SHARD_TIMEOUT", action='store', default=86400, type=int)
+    # index dispatches targets in gene index order
+    # cost counts the evidence of each target first and dispatches the heaviest first
+    p.add("--as-schedule", help="order targets are dispatched in with the target evidence reader",
+        env_var="AS_SCHEDULE", action='store', default='index', choices=['index', 'cost'])
+    p.add("--as-split-evidence", help="split targets with more evidence than this by disease (0 to never split)",
+        env_var="AS_SPLIT_EVIDENCE", action='store', default=100000, type=int)
+    # YAML file of named alternative scoring weights, each as a mapping of datasource to weight
+    # each one is scored from the same evidence into an index named after the association index
+    p.add("--as-weightings", help="YAML file of alternative scoring weights to also score",
+        env_var="AS_WEIGHTINGS", action='store', default=None)
+    # partial aggregates are written by complete runs, when datasources to rebuild are given
+    # only the associations of the targets with evidence from those datasources are rebuilt
+    p.add("--as-partials", help="SQLite file of per target, disease and datasource partial aggregates",
+        env_var="AS_PARTIALS", action='store', default=None)
+    p.add("--as-partials-datasource", help="datasource whose evidence changed, to rebuild from --as-partials",
+        env_var="AS_PARTIALS_DATASOURCE", action='append', default=[])
 
         
     # if 0 use main thread for writing
@@ -175,6 +286,14 @@ def setup_ops_parser():
     p.add("--dry-run", help="do not store data in the backend, useful for dev work. Does not work with all the steps!!",
         action='store_true', default=False)
 
+    # replay the files of an earlier run into elasticsearch, before any stage
+    p.add("--load", help="load the files written to --elasticsearch-folder into elasticsearch",
+        action="store_true")
+
+    # merge and replicate the indexes loaded with --elasticsearch-finalize defer
+    p.add("--finalize", help="force merge the indexes and restore their replicas, after all the stages",
+        action="store_true")
+
     # load supplemental and genetic informtaion from various external resources
     p.add("--hpa", help="download human protein atlas, process, and store in elasticsearch",
         action="store_true")
@@ -4,11 +4,14 @@ import itertools
 import gzip
 import logging
 import os.path
+import struct
+import zlib
 import requests as r
 import requests_file
 import mrtarget
 import pkg_resources as res
 from opentargets_urlzsource import URLZSource
+import pypeln.process as pr
 
 
 
@@ -66,6 +69,239 @@ def make_iter_lines(iterable_of_filenames, first_n=0):
         if first_n > 0 else it_lines
 
 
+def make_iter_batches(iterable_of_lines, batch_lines, batch_bytes=0):
+    """return an iterator of lists of the (filename, (line_n, line)) elements of
+    `iterable_of_lines`, in the same order. A list is closed when it has `batch_lines`
+    lines or, if `batch_bytes` is > 0, when its lines add up to at least that many bytes.
+    """
+    batch = []
+    n_bytes = 0
+    for element in iterable_of_lines:
+        batch.append(element)
+        n_bytes += len(element[1][1])
+        if len(batch) >= batch_lines or (batch_bytes > 0 and n_bytes >= batch_bytes):
+            yield batch
+            batch = []
+            n_bytes = 0
+    if batch:
+        yield batch
+
+
+def is_local(filename):
+    return '://' not in filename or filename.startswith('file://')
+
+
+def local_path(filename):
+    return filename[7:] if filename.startswith('file://') else filename
+
+
+def is_bgzf(path):
+    """true if the file is block gzipped, as by bgzip, so it can be read from any block"""
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def get_bgzf_blocks(path):
+    """return the (offset, size) of each block of a block gzipped file, from the headers only"""
+    blocks = []
+    offset = 0
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            header = f.read(18)
+            if len(header) < 18 or header[12:14] != b'BC':
+                raise IOError("%s is not block gzipped at %d" % (path, offset))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            blocks.append((offset, block_size))
+            offset += block_size
+    return blocks
+
+
+def get_line_ranges(filename, range_bytes):
+    """return the ranges a file can be read in, as (filename, compression, start, end, previous)
+    with start and end in bytes of the file and previous the offset of the block before start
+    for block gzipped files. Uncompressed and block gzipped local files are split every
+    `range_bytes`, other files are one range to be read whole.
+    """
+    if range_bytes <= 0 or not is_local(filename):
+        return [(filename, None, None, None, None)]
+    path = local_path(filename)
+    if path.endswith('.gz') or path.endswith('.gzip'):
+        if not is_bgzf(path):
+            return [(filename, None, None, None, None)]
+        ranges = []
+        start, previous, last = 0, None, None
+        for offset, block_size in get_bgzf_blocks(path):
+            if offset - start >= range_bytes:
+                ranges.append((filename, 'bgzf', start, offset, previous))
+                start, previous = offset, last
+            last = offset
+        ranges.append((filename, 'bgzf', start, os.path.getsize(path), previous))
+        return ranges
+    elif path.endswith('.zip'):
+        return [(filename, None, None, None, None)]
+    else:
+        size = os.path.getsize(path)
+        return [(filename, 'plain', start, min(start + range_bytes, size), None)
+            for start in range(0, max(size, 1), range_bytes)]
+
+
+def _decompress_bgzf_block(f, offset):
+    f.seek(offset)
+    header = f.read(18)
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+    return zlib.decompress(header + f.read(block_size - 18), 31), offset + block_size
+
+
+def _iter_range_chunks(path, compression, start, end, chunk_bytes=1024*1024):
+    """yield (data, in range) of the uncompressed data from `start` to the end of the file,
+    data is in range if it comes from before `end` in the file"""
+    with open(path, 'rb') as f:
+        if compression == 'bgzf':
+            offset = start
+            while True:
+                f.seek(offset)
+                if not f.read(1):
+                    break
+                data, next_offset = _decompress_bgzf_block(f, offset)
+                yield data, offset < end
+                offset = next_offset
+        else:
+            f.seek(start)
+            position = start
+            while True:
+                data = f.read(chunk_bytes)
+                if not data:
+                    break
+                if position < end < position + len(data):
+                    yield data[:end - position], True
+                    yield data[end - position:], False
+                else:
+                    yield data, position < end
+                position += len(data)
+
+
+def _starts_line(path, compression, start, previous):
+    """true if the data of a range starts a line"""
+    if start == 0:
+        return True
+    with open(path, 'rb') as f:
+        if compression == 'bgzf':
+            data, _ = _decompress_bgzf_block(f, previous)
+        else:
+            f.seek(start - 1)
+            data = f.read(1)
+    return data.endswith(b'\n')
+
+
+def iter_range_lines(line_range):
+    """yield the lines that start in a range from get_line_ranges, or all the lines of a file
+    for a range to be read whole, as bytes with their newline"""
+    filename, compression, start, end, previous = line_range
+    if compression is None:
+        path = local_path(filename)
+        if is_local(filename) and (path.endswith('.gz') or path.endswith('.gzip')):
+            handle = gzip.open(path, 'rb')
+        elif is_local(filename) and not path.endswith('.zip'):
+            handle = open(path, 'rb')
+        else:
+            handle = URLZSource(filename).open()
+        with handle as f:
+            for line in f:
+                yield line if isinstance(line, bytes) else line.encode('utf-8')
+        return
+
+    path = local_path(filename)
+    skip = not _starts_line(path, compression, start, previous)
+    #bytes of data in range so far and position of the start of the buffer in it
+    in_range = 0
+    position = 0
+    buffer = b''
+    for data, data_in_range in _iter_range_chunks(path, compression, start, end):
+        if data_in_range:
+            in_range += len(data)
+        buffer += data
+        line_start = 0
+        newline = buffer.find(b'\n')
+        while newline >= 0:
+            if position + line_start >= in_range:
+                return
+            if skip:
+                skip = False
+            else:
+                yield buffer[line_start:newline + 1]
+            line_start = newline + 1
+            newline = buffer.find(b'\n', line_start)
+        position += line_start
+        buffer = buffer[line_start:]
+    if buffer and position < in_range and not skip:
+        yield buffer
+
+
+def count_range_lines(line_range):
+    """number of lines that start in a range from get_line_ranges"""
+    filename, compression, start, end, previous = line_range
+    path = local_path(filename)
+    count = 1 if _starts_line(path, compression, start, previous) else 0
+    last = b''
+    for data, data_in_range in _iter_range_chunks(path, compression, start, end):
+        if not data_in_range:
+            break
+        count += data.count(b'\n')
+        last = data[-1:] or last
+    #a newline at the end of the range starts a line of the next range
+    if last == b'\n':
+        count -= 1
+    return count
+
+
+def read_range_batches(numbered_range, batch_lines, batch_bytes, skip=None):
+    """yield the lines of a (range, number of its first line) as from make_iter_batches,
+    leaving out the ones for which skip(filename, line number) is true"""
+    line_range, line_n = numbered_range
+    filename = line_range[0]
+    lines = zip(itertools.cycle([filename]), enumerate(iter_range_lines(line_range), start=line_n))
+    if skip is not None:
+        lines = (line for line in lines if not skip(line[0], line[1][0]))
+    for batch in make_iter_batches(lines, batch_lines, batch_bytes):
+        yield batch
+
+
+def make_parallel_iter_batches(iterable_of_filenames, batch_lines, batch_bytes, workers,
+        range_bytes, maxsize=100, skip=None):
+    """return a stage of batches of lines as from make_iter_batches, for all filenames in
+    `iterable_of_filenames` read by `workers` processes. Local files that are uncompressed
+    or block gzipped are split in ranges of `range_bytes` that are read in parallel too.
+    Lines for which skip(filename, line number) is true are left out.
+
+    Every line keeps the filename and line number it has in its file, for which split
+    files are first counted in parallel, but batches are in no particular order.
+    """
+    logger = logging.getLogger(__name__)
+    ranges_of_files = [get_line_ranges(filename, range_bytes) for filename in iterable_of_filenames]
+
+    #lines before each range of a split file, the last one is not needed
+    to_count = [r for ranges in ranges_of_files if len(ranges) > 1 for r in ranges[:-1]]
+    counts = {}
+    if to_count:
+        logger.info('counting the lines of %d ranges of split files', len(to_count))
+        for line_range, count in pr.map(lambda r: (r, count_range_lines(r)), to_count, workers=workers):
+            counts[line_range] = count
+
+    numbered_ranges = []
+    for ranges in ranges_of_files:
+        line_n = 1
+        for line_range in ranges:
+            numbered_ranges.append((line_range, line_n))
+            line_n += counts.get(line_range, 0)
+
+    return pr.flat_map(functools.partial(read_range_batches, batch_lines=batch_lines, batch_bytes=batch_bytes,
+        skip=skip),
+        numbered_ranges, workers=workers, maxsize=maxsize)
+
+
 def file_or_resource(fname):
     '''get filename and check if in getcwd then get from
     the package resources folder
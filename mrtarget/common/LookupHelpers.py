@@ -32,7 +32,9 @@ class LookUpDataRetriever(object):
             hpa_cache_size = 0,
             efo_index = None,
             efo_cache_size = 0,
-            efo_cache_contains_size = 0
+            efo_cache_contains_size = 0,
+            gene_universe = None,
+            efo_universe = None
             ):
 
         self.es = es
@@ -41,11 +43,12 @@ class LookUpDataRetriever(object):
 
         if gene_index is not None:
             self.lookup.available_genes = GeneLookUpTable(self.es, gene_index,
-                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size)
+                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size,
+                gene_universe)
             self._get_non_reference_gene_mappings()
         if efo_index is not None:
             self.lookup.available_efos = EFOLookUpTable(self.es, efo_index,
-            efo_cache_size, efo_cache_contains_size)
+            efo_cache_size, efo_cache_contains_size, efo_universe)
         if eco_index is not None:
             self.lookup.available_ecos = ECOLookUpTable(self.es, eco_index, 
             eco_cache_size)
@@ -4,7 +4,7 @@ from past.utils import old_div
 import logging
 
 from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import Match,Bool
+from elasticsearch_dsl.query import Match,Bool,MatchAll
 
 import cachetools
 import sys
@@ -53,10 +53,16 @@ class HPALookUpTable(object):
 
 class GeneLookUpTable(object):
 
-    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size):
+    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size,
+            universe=None):
         self._es = es
         self._es_index = es_index
 
+        #gene ids, uniprot to ensembl mapping and ambiguous uniprot ids from load_universe
+        #if given, they answer __contains__ and get_uniprot2ensembl without elasticsearch
+        self._gene_ids, self._uniprot2ensembl, self._uniprot_ambiguous = \
+            universe if universe is not None else (None, None, None)
+
         self.cache_gene = cachetools.LRUCache(cache_gene_size, getsizeof=sys.getsizeof)
         self.cache_gene.hits = 0
         self.cache_gene.queries = 0
@@ -88,9 +94,37 @@ class GeneLookUpTable(object):
             return val
         #can't have multiple hits, primary key!
 
+    @staticmethod
+    def load_universe(es, es_index):
+        """read every gene id and uniprot accession with one scan of the index, for
+        a GeneLookUpTable to check evidence without any more queries
+        """
+        gene_ids = set()
+        uniprot2ensembl = {}
+        uniprot_ambiguous = set()
+        for gene in Search().using(es).index(es_index).query(MatchAll()).source(
+                includes=["uniprot_id", "uniprot_accessions"]).params(scroll='1h', size=1000).scan():
+            gene_id = gene.meta.id
+            gene_ids.add(gene_id)
+            source = gene.to_dict()
+            uniprot_ids = set(source.get("uniprot_accessions") or [])
+            uniprot_ids.add(source.get("uniprot_id"))
+            for uniprot_id in uniprot_ids:
+                if not uniprot_id:
+                    continue
+                if uniprot_id in uniprot2ensembl and uniprot2ensembl[uniprot_id] != gene_id:
+                    uniprot_ambiguous.add(uniprot_id)
+                uniprot2ensembl[uniprot_id] = gene_id
+        return frozenset(gene_ids), uniprot2ensembl, frozenset(uniprot_ambiguous)
+
     def get_uniprot2ensembl(self, uniprot_id):
         assert uniprot_id is not None
 
+        if self._uniprot2ensembl is not None:
+            if uniprot_id in self._uniprot_ambiguous:
+                raise ValueError("Multiple genes with uniprot %s" %(uniprot_id))
+            return self._uniprot2ensembl.get(uniprot_id)
+
         self.cache_u2e.queries += 1
         if uniprot_id in self.cache_u2e:
             self.cache_u2e.hits += 1
@@ -117,6 +151,9 @@ class GeneLookUpTable(object):
 
     def __contains__(self, gene_id):
 
+        if self._gene_ids is not None:
+            return gene_id in self._gene_ids
+
         self.cache_contains.queries += 1
         if gene_id in self.cache_contains:
             self.cache_contains.hits += 1
@@ -209,9 +246,11 @@ class ECOLookUpTable(object):
 
 class EFOLookUpTable(object):
 
-    def __init__(self, es, index, cache_efo_size, cache_contains_size):
+    def __init__(self, es, index, cache_efo_size, cache_contains_size, universe=None):
         self._es = es
         self._es_index = index
+        #disease ids from load_universe, if given they answer __contains__ without elasticsearch
+        self._efo_ids = universe
         #TODO configure size
         self.cache_efo = cachetools.LRUCache(cache_efo_size, getsizeof=sys.getsizeof)
         self.cache_efo.hits = 0
@@ -231,6 +270,14 @@ class EFOLookUpTable(object):
             #assume already a short code
             return url
 
+    @staticmethod
+    def load_universe(es, es_index):
+        """read every disease id with one scan of the index, for an EFOLookUpTable
+        to check evidence without any more queries
+        """
+        return frozenset(efo.meta.id for efo in Search().using(es).index(es_index).query(
+            MatchAll()).source(False).params(scroll='1h', size=1000).scan())
+
     def get_efo(self, efo_id):
         
         self.cache_efo.queries += 1
@@ -253,6 +300,9 @@ class EFOLookUpTable(object):
 
     def __contains__(self, efo_id):
 
+        if self._efo_ids is not None:
+            return efo_id in self._efo_ids
+
         self.cache_contains.queries += 1
         if efo_id in self.cache_contains:
             self.cache_contains.hits += 1
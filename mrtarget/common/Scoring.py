@@ -87,4 +87,137 @@ class HarmonicSumScorer(object):
     def sigmoid_scaling(value,mid_value=100, precision=3):
         center = 1
         s = 2. / (1 + np.exp(1./mid_value * (value - center)))
-        return round(s, precision)
\ No newline at end of file
+        return round(s, precision)
+
+class HarmonicSumBatchScorer(object):
+
+    def __init__(self, datasources_to_datatypes, buffer=100, scale_factor=2, cap=1):
+        """
+        A HarmonicSumBatchScorer computes the same harmonic sums as a set of HarmonicSumScorer
+        objects (one per datasource, one per datatype and one overall) but for many
+        target-disease pairs at once, using numpy arrays instead of one python object per score.
+
+        Results are identical to the ones produced by HarmonicSumScorer: the top `buffer`
+        scores are summed sequentially in descending order with the same divisors.
+        Args:
+            datasources_to_datatypes (dict): datasource name to datatype name
+            buffer: number of element to keep for each harmonic sum
+            scale_factor (float): scaling factor applied to each datapoint position
+            cap (float): datasource harmonic sums higher than this are replaced by it
+        """
+        self.buffer = buffer
+        self.scale_factor = scale_factor
+        self.cap = cap
+        self.datasources_to_datatypes = dict(datasources_to_datatypes)
+        self.datasources = sorted(datasources_to_datatypes)
+        self.datatypes = sorted(set(datasources_to_datatypes.values()))
+        self.datasource_index = dict((ds, i) for i, ds in enumerate(self.datasources))
+        self.datatype_index = dict((dt, i) for i, dt in enumerate(self.datatypes))
+
+        # datasource columns for each datatype row, padded with -1
+        members = [[self.datasource_index[ds] for ds in self.datasources
+                    if datasources_to_datatypes[ds] == dt] for dt in self.datatypes]
+        width = max([len(m) for m in members] + [0])
+        self._datatype_columns = np.full((len(self.datatypes), width), -1, dtype=np.intp)
+        for i, m in enumerate(members):
+            self._datatype_columns[i, :len(m)] = m
+
+        # same divisors as HarmonicSumScorer.harmonic_sum, computed by python for exactness
+        self._divisors = np.array([(i + 1) ** scale_factor for i in range(buffer)],
+                                  dtype=np.float64)
+
+    def score(self, pairs, datasources, scores, n_pairs):
+        """
+        Compute datasource, datatype and overall harmonic sums for a batch of pairs
+        Args:
+            pairs (array): index of the pair, in [0, n_pairs), of each score
+            datasources (array): index in self.datasources of the datasource of each score
+            scores (array): the evidence scores
+            n_pairs (int): number of pairs in the batch
+        Returns:
+            datasource_scores (array): (n_pairs, n_datasources) capped datasource harmonic sums
+            datatype_scores (array): (n_pairs, n_datatypes) datatype harmonic sums
+            overall (array): (n_pairs,) overall harmonic sums
+            counts (array): (n_pairs, n_datasources) number of scores per datasource
+            capped (array): (n_pairs, n_datasources) True where a datasource was capped
+        """
+        n_datasources = len(self.datasources)
+        groups = np.asarray(pairs, dtype=np.intp) * n_datasources + \
+            np.asarray(datasources, dtype=np.intp)
+
+        top, counts = self.top_scores(groups, scores, n_pairs * n_datasources)
+        datasource_scores = self.harmonic_sums(top).reshape(n_pairs, n_datasources)
+        counts = counts.reshape(n_pairs, n_datasources)
+
+        capped = datasource_scores > self.cap
+        datasource_scores[capped] = self.cap
+
+        # datatypes include every datasource of that type, even the ones without evidence
+        columns = self._datatype_columns
+        datatype_matrix = np.where(columns >= 0, datasource_scores[:, columns], -np.inf)
+        datatype_scores = self.sorted_harmonic_sums(datatype_matrix)
+
+        # overall only includes the datasources with evidence
+        overall = self.sorted_harmonic_sums(
+            np.where(counts > 0, datasource_scores, -np.inf))
+
+        return datasource_scores, datatype_scores, overall, counts, capped
+
+    def top_scores(self, groups, scores, n_groups):
+        """
+        Select the top `buffer` scores of each group, using a partial sort for groups larger than that
+        Args:
+            groups (array): group index of each score, in [0, n_groups)
+            scores (array): scores to select from
+            n_groups (int): total number of groups
+        Returns:
+            top (array): (n_groups, width) each row the selected scores sorted in descending order
+                and padded with zeros
+            counts (array): (n_groups,) number of scores of each group before selection
+        """
+        groups = np.asarray(groups, dtype=np.intp)
+        scores = np.asarray(scores, dtype=np.float64)
+        counts = np.bincount(groups, minlength=n_groups)
+
+        overflowing = np.flatnonzero(counts > self.buffer)
+        if len(overflowing):
+            order = np.argsort(groups, kind='mergesort')
+            groups = groups[order]
+            scores = scores[order]
+            starts = np.cumsum(counts) - counts
+            keep = np.ones(len(scores), dtype=bool)
+            for group in overflowing:
+                start = starts[group]
+                n_drop = counts[group] - self.buffer
+                dropped = np.argpartition(scores[start:start + counts[group]], n_drop)[:n_drop]
+                keep[start + dropped] = False
+            groups = groups[keep]
+            scores = scores[keep]
+
+        kept = np.minimum(counts, self.buffer)
+        order = np.lexsort((-scores, groups))
+        groups = groups[order]
+        ranks = np.arange(len(groups)) - (np.cumsum(kept) - kept)[groups]
+
+        top = np.zeros((n_groups, kept.max() if n_groups else 0), dtype=np.float64)
+        top[groups, ranks] = scores[order]
+        return top, counts
+
+    def sorted_harmonic_sums(self, matrix):
+        """
+        Harmonic sums along the last axis of a matrix in any order, where -inf marks a missing value
+        """
+        matrix = -np.sort(-matrix, axis=-1)[..., :self.buffer]
+        matrix[np.isneginf(matrix)] = 0.
+        return self.harmonic_sums(matrix)
+
+    def harmonic_sums(self, matrix):
+        """
+        Harmonic sums along the last axis of a matrix already sorted in descending order
+
+        Uses a cumulative sum so the additions happen in the same order as python sum()
+        """
+        width = matrix.shape[-1]
+        if width == 0:
+            return np.zeros(matrix.shape[:-1], dtype=np.float64)
+        return np.cumsum(matrix / self._divisors[:width], axis=-1)[..., -1]
@@ -0,0 +1,86 @@
+from builtins import object
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+
+
+class BloomFilter(object):
+    """
+    Set of strings in a fixed number of bits, sized for `capacity` strings with
+    a probability of `error_rate` of a string that was not added being reported
+    as added. Strings that were added are always reported as added
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def __contains__(self, key):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """add the key, returning if it was possibly added before"""
+        added = True
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not self.array[p >> 3] & mask:
+                self.array[p >> 3] |= mask
+                added = False
+        return added
+
+
+class DuplicateFilter(object):
+    """
+    Streaming filter of the strings seen before. Every string goes into a
+    BloomFilter, so memory is bounded, and into a SQLite file. The file is only
+    read for the strings the filter reports as possibly seen, to confirm they
+    really are repeats.
+
+    The file is temporary, in `directory` or the default temporary directory,
+    and removed on close
+    """
+
+    def __init__(self, capacity, error_rate=0.01, directory=None, commit_keys=10000):
+        self.bloom = BloomFilter(capacity, error_rate)
+        handle, self.filename = tempfile.mkstemp(suffix='.sqlite', dir=directory)
+        os.close(handle)
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.commit_keys = commit_keys
+        self.pending = []
+        self.duplicates = 0
+        self.false_positives = 0
+
+    def _flush(self):
+        self.connection.executemany("INSERT OR IGNORE INTO seen VALUES (?)", self.pending)
+        self.connection.commit()
+        self.pending = []
+
+    def add(self, key):
+        """add the key, returning if it was added before"""
+        if self.bloom.add(key):
+            if self.pending:
+                self._flush()
+            row = self.connection.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.duplicates += 1
+                return True
+            self.false_positives += 1
+        self.pending.append((key,))
+        if len(self.pending) >= self.commit_keys:
+            self._flush()
+        return False
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.filename)
@@ -1,14 +1,31 @@
 
 from builtins import object
+import collections
+import gzip
+import json
 import logging
+import os
+import random
+import re
+import shutil
+import threading
 import time
-from elasticsearch import RequestError
+from multiprocessing.pool import ThreadPool
+from elasticsearch import RequestError, TransportError
+import elasticsearch.helpers
+from elasticsearch.serializer import JSONSerializer
 
 
 class ElasticsearchBulkIndexManager(object):
     """Context manager to open an an Elasticsearch index for bulk loading."""
 
-    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False):
+    #how much of the index is allocated, from worst to best
+    STATUSES = [u"red", u"yellow", u"green"]
+    #seconds an async force merge request is kept open without a status timeout
+    MERGE_TIMEOUT = 24 * 60 * 60
+
+    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False, resume=False,
+            keep_on_error=False, alias=False, finalize="wait", status_timeout=None):
         """Set the index to load to, and define initial state for it.
 
         Parameters
@@ -22,10 +39,38 @@ class ElasticsearchBulkIndexManager(object):
             set this to True if you want the data to be appended to the
             existing index with name index_name instead of replacing
             this index with an empty index first.
+        resume
+            set this to True to continue a load that was interrupted, which
+            left the index in bulk mode. The index is appended to, and on
+            exit given the settings it was created with instead of the bulk
+            mode ones it has now.
+        keep_on_error
+            set this to True if a load that fails is resumed later, to leave
+            the index in bulk mode on an error instead of restoring its
+            settings and force merging it.
+        alias
+            set this to True to load into a new index named after index_name
+            and the time, and only on success move the alias index_name to it
+            and delete the indexes it was on. Readers of index_name see the
+            previous data until then.
+        finalize
+            "wait" to force merge the index and wait for all its replicas on
+            exit, "async" to start the merge and only wait for its primary
+            shards, "defer" to also leave it without replicas and unmerged
+            until finalize_index is called for it.
+        status_timeout
+            seconds to wait for the index to reach a status before giving up,
+            or None to wait for ever.
         """
         self.logger = logging.getLogger(__name__)
         self.client = client
         self.index_name = index_name
+        #the index loaded into, other than index_name for an alias
+        self.target = index_name
+        #the indexes the alias was on before, set on entry
+        self.previous = []
+        #whether the target is a new version the alias is moved to
+        self.new_version = False
         #these are set on entry 
         self.old_number_of_replicas = None
         self.old_refresh_interval = None
@@ -34,43 +79,44 @@ class ElasticsearchBulkIndexManager(object):
         self.settings = settings
         self.mappings = mappings
         self.append_data = append_data
+        self.resume = resume
+        self.keep_on_error = keep_on_error
+        self.alias = alias
+        if finalize not in ("wait", "async", "defer"):
+            raise ValueError("unknown finalization %s" % finalize)
+        self.finalize = finalize
+        self.status_timeout = status_timeout
+        #the thread of an async force merge, set on exit
+        self.merge_thread = None
 
     def __enter__(self):
         #setup
+        if self.alias:
+            self.open_alias_target()
         #ensure the index exists and is empty and ready
         #ignore if index doesn't exist
-        if self.client.indices.exists(index=self.index_name):
+        elif self.client.indices.exists(index=self.index_name):
             # if append_data is False, it means index needs to be replaced instead of appended to,
             # so delete existing index and create again:
-            if not self.append_data:
+            if not self.append_data and not self.resume:
                 self.logger.debug("deleting prevous index %s", self.index_name)
                 self.client.indices.delete(index=self.index_name, ignore=[404])
                 self.create_index()
         else:
             self.create_index()
 
-        #store old settings to restore later, if present
-        self.logger.debug("saving old settings for %s", self.index_name)
-        old_settings = self.client.indices.get_settings(self.index_name)
-        if self.index_name in old_settings:
-            if "settings" in old_settings[self.index_name]:
-                if "index" in old_settings[self.index_name]["settings"]:
-                    if "number_of_replicas" in old_settings[self.index_name]["settings"]["index"]:
-                        #store number of replicas
-                        self.old_number_of_replicas = old_settings[self.index_name]["settings"]["index"]["number_of_replicas"]
-                    if "refresh_interval" in old_settings[self.index_name]["settings"]["index"]:
-                        #store index interval
-                        self.old_refresh_interval = old_settings[self.index_name]["settings"]["index"]["refresh_interval"]
-                    if "translog.durability" in old_settings[self.index_name]["settings"]["index"]:
-                        #store transaction log durability setting
-                        self.old_translog_durability = old_settings[self.index_name]["settings"]["index"]["translog.durability"]
-
+        if self.resume:
+            #the index still has the settings of the interrupted load
+            self.logger.debug("resuming load into %s", self.target)
+            self.restore_configured_settings()
+        else:
+            self.save_old_settings()
 
         #set replicas to zero
         #set update interval to "never"
         #set transaction log durability to "async"
-        self.logger.debug("changing settings for bulk into %s", self.index_name)
-        self.client.indices.put_settings(index=self.index_name, body={
+        self.logger.debug("changing settings for bulk into %s", self.target)
+        self.client.indices.put_settings(index=self.target, body={
             "index" : {
                 "number_of_replicas" : 0,
                 "refresh_interval" : -1,
@@ -78,45 +124,159 @@ class ElasticsearchBulkIndexManager(object):
             }
         })
         return self
-        
+
+    def open_alias_target(self):
+        """Choose the index to load into behind the alias, creating it if new."""
+        aliased = self.client.indices.get_alias(name=self.index_name, ignore=[404])
+        if aliased.get("status") == 404:
+            aliased = {}
+        self.previous = sorted(aliased)
+        if self.client.indices.exists(index=self.index_name) and not self.previous:
+            #an index from before there were aliases, replaced on the swap
+            self.previous = [self.index_name]
+
+        if self.append_data and self.previous:
+            #appending changes the live index in place, as without an alias
+            self.target = self.previous[-1]
+            self.previous = []
+            return
+
+        if self.resume:
+            #the newest version that never got the alias is what was interrupted
+            versions = self.get_versions()
+            unaliased = [name for name in versions if name not in self.previous]
+            if unaliased:
+                self.target = unaliased[-1]
+                self.new_version = True
+                return
+
+        self.target = "%s-%s" % (self.index_name, time.strftime("%Y%m%d%H%M%S", time.gmtime()))
+        self.new_version = True
+        self.create_index()
+
+    def get_versions(self):
+        """The indexes loaded into behind the alias, oldest first."""
+        pattern = re.compile(r"^%s-\d{14}$" % re.escape(self.index_name))
+        indexes = self.client.indices.get(index="%s-*" % self.index_name, ignore=[404])
+        return sorted(name for name in indexes if pattern.match(name))
+
+    def restore_configured_settings(self):
+        """Restore the settings the index was created with on exit."""
+        index_settings = self.settings.get("index", self.settings)
+        translog = index_settings.get("translog", {})
+        self.old_number_of_replicas = index_settings.get("number_of_replicas")
+        self.old_refresh_interval = index_settings.get("refresh_interval")
+        self.old_translog_durability = index_settings.get("translog.durability", translog.get("durability"))
+
+    def save_old_settings(self):
+        """Store the current settings of the index to restore them on exit."""
+        #store old settings to restore later, if present
+        self.logger.debug("saving old settings for %s", self.target)
+        old_settings = self.client.indices.get_settings(self.target)
+        if self.target in old_settings:
+            if "settings" in old_settings[self.target]:
+                if "index" in old_settings[self.target]["settings"]:
+                    if "number_of_replicas" in old_settings[self.target]["settings"]["index"]:
+                        #store number of replicas
+                        self.old_number_of_replicas = old_settings[self.target]["settings"]["index"]["number_of_replicas"]
+                    if "refresh_interval" in old_settings[self.target]["settings"]["index"]:
+                        #store index interval
+                        self.old_refresh_interval = old_settings[self.target]["settings"]["index"]["refresh_interval"]
+                    if "translog.durability" in old_settings[self.target]["settings"]["index"]:
+                        #store transaction log durability setting
+                        self.old_translog_durability = old_settings[self.target]["settings"]["index"]["translog.durability"]
+
     def __exit__(self, type, value, traceback):
         #teardown
+        if type is not None and self.keep_on_error:
+            self.logger.warning("leaving %s in bulk mode to resume loading it", self.target)
+            return None
+        if type is not None and self.new_version:
+            #readers never saw the failed load
+            self.logger.warning("deleting %s, %s is unchanged", self.target, self.index_name)
+            self.client.indices.delete(index=self.target, ignore=[404])
+            return None
 
         #restore old settings
-        self.logger.debug("Restoring old settings for %s", self.index_name)
-        self.client.indices.put_settings(index=self.index_name, body={
-            "index" : {
-                "number_of_replicas" : self.old_number_of_replicas,
-                "refresh_interval" : self.old_refresh_interval,
-                "translog.durability" : self.old_translog_durability
-            }
-        })
-        
+        #deferred finalization leaves the replicas for finalize_index
+        self.logger.debug("Restoring old settings for %s", self.target)
+        index_settings = {
+            "refresh_interval" : self.old_refresh_interval,
+            "translog.durability" : self.old_translog_durability
+        }
+        if self.finalize != "defer":
+            index_settings["number_of_replicas"] = self.old_number_of_replicas
+        self.client.indices.put_settings(index=self.target, body={"index": index_settings})
+
+        if self.finalize == "wait":
+            #run force-merge
+            #this will compress everyhting into a single "segment"
+            #temporarily, will use more disk as things are copied around
+            #but in the end should be smaller and more performant
+            self.logger.debug("Force merging %s", self.target)
+            self.client.indices.forcemerge(index=self.target, max_num_segments=1)
 
-        #run force-merge
-        #this will compress everyhting into a single "segment"
-        #temporarily, will use more disk as things are copied around
-        #but in the end should be smaller and more performant
-        self.logger.debug("Force merging %s", self.index_name)
-        self.client.indices.forcemerge(index=self.index_name, max_num_segments=1)
+            #wait for everthing to sort itself out
+            self.wait_for_status(u"green")
+        else:
+            if self.finalize == "async":
+                #the merge goes on in the cluster while the next stage runs
+                self.start_forcemerge()
+            #searchable once the primaries are allocated and what was loaded is visible
+            self.client.indices.refresh(index=self.target)
+            self.wait_for_status(u"yellow")
 
-        #wait for everthing to sort itself out
-        #self.wait_for_status(u"yellow")
-        self.wait_for_status(u"green")
+        if self.new_version:
+            self.swap_alias()
 
         #don't return True to indicate any exceptions have been handled
         #this contex manager is only for cleanup
         return None
 
+    def start_forcemerge(self):
+        """Force merge the index in a background thread. Elasticsearch before
+        7.7 refuses wait_for_completion, so the request is left to run on its
+        own instead; the cluster goes on merging even if this process exits."""
+        self.logger.debug("Starting force merge of %s", self.target)
+
+        def forcemerge():
+            try:
+                self.client.indices.forcemerge(index=self.target, max_num_segments=1,
+                    request_timeout=self.status_timeout or self.MERGE_TIMEOUT)
+            except TransportError as e:
+                self.logger.warning("force merge of %s failed: %s", self.target, e)
+
+        self.merge_thread = threading.Thread(target=forcemerge, 
+            name="forcemerge-%s" % self.target)
+        self.merge_thread.daemon = True
+        self.merge_thread.start()
+
+    def swap_alias(self):
+        """Move the alias to the loaded index in one step, and delete the
+        indexes it was on."""
+        actions = [{"add": {"index": self.target, "alias": self.index_name}}]
+        for name in self.previous:
+            if name == self.index_name:
+                actions.append({"remove_index": {"index": name}})
+            else:
+                actions.append({"remove": {"index": name, "alias": self.index_name}})
+        self.logger.info("moving alias %s to %s", self.index_name, self.target)
+        self.client.indices.update_aliases(body={"actions": actions})
+
+        previous = [name for name in self.previous if name != self.index_name]
+        if previous:
+            self.logger.debug("deleting previous indexes %s", ", ".join(previous))
+            self.client.indices.delete(index=",".join(previous), ignore=[404])
+
     def create_index(self):
         """Tell the Elasticsearch client to create the index as configured."""
-        self.logger.debug("creating index %s", self.index_name)
+        self.logger.debug("creating index %s", self.target)
         body = {
             "settings": self.settings,
             "mappings": self.mappings
         }
         try:
-            self.client.indices.create(index=self.index_name, body=body)
+            self.client.indices.create(index=self.target, body=body)
         except RequestError as e:
             if u'resource_already_exists_exception' == e.error:
                 self.logger.debug("swallowing index exists exception")
@@ -125,10 +285,572 @@ class ElasticsearchBulkIndexManager(object):
                 raise e
 
     def wait_for_status(self, desired):
-        #TODO implement a timeout?
-        self.logger.debug("Checking index status %s", self.index_name)
-        status = None
-        while status != desired:
-            time.sleep(1)
-            status = self.client.cat.indices(index=self.index_name).strip().split()[0]
-            self.logger.debug("Status of %s is %s", self.index_name, status)
+        wait_for_status(self.client, self.target, desired, self.status_timeout)
+
+
+def wait_for_status(client, index_name, desired, timeout=None):
+    """Wait until the index has the desired status or a better one, raising
+    RuntimeError if that takes more than timeout seconds."""
+    logger = logging.getLogger(__name__)
+    logger.debug("Checking index status %s", index_name)
+    statuses = ElasticsearchBulkIndexManager.STATUSES
+    start = time.time()
+    status = None
+    while status not in statuses or statuses.index(status) < statuses.index(desired):
+        if timeout is not None and time.time() - start > timeout:
+            raise RuntimeError("%s is still %s and not %s after %ds" % (index_name, status, desired, timeout))
+        time.sleep(1)
+        status = client.cat.indices(index=index_name).strip().split()[0]
+        logger.debug("Status of %s is %s", index_name, status)
+
+
+def finalize_index(client, index_name, number_of_replicas, status_timeout=None):
+    """Force merge an index loaded with deferred finalization and give it its
+    replicas, waiting for all of them."""
+    logger = logging.getLogger(__name__)
+    logger.info("finalizing %s", index_name)
+    client.indices.forcemerge(index=index_name, max_num_segments=1)
+    client.indices.put_settings(index=index_name, body={
+        "index" : {
+            "number_of_replicas" : number_of_replicas
+        }
+    })
+    wait_for_status(client, index_name, u"green", status_timeout)
+
+
+def is_routing_required(client, index_name):
+    """Whether the documents of an index, or of the indexes of an alias, are
+    routed, as set by _routing in their mappings."""
+    mappings = client.indices.get_mapping(index=index_name)
+    return any(mapping.get("mappings", {}).get("_routing", {}).get("required", False)
+        for mapping in mappings.values())
+
+
+class BulkWriter(object):
+    """Sends bulk actions to Elasticsearch.
+
+    Requests are bounded by bytes of NDJSON as well as by number of actions, so
+    small and large documents both make requests of a sensible size. Actions
+    rejected because the cluster is overloaded (429) are retried on their own,
+    after an exponential backoff with full jitter, and the request size is
+    halved until requests go through again. Actions that still fail are
+    written, as bulk API NDJSON, to the dead letter file if there is one.
+    """
+
+    def __init__(self, client, thread_count=4, queue_size=4, max_chunk_bytes=10 * 1024 * 1024,
+            max_chunk_actions=10000, max_retries=5, initial_backoff=2, max_backoff=600,
+            dead_letter=None, min_chunk_bytes=64 * 1024, log_seconds=60, index_names=None):
+        """
+        Parameters
+        ----------
+        client
+            is an elasticsearch client object
+        thread_count
+            number of threads sending requests, if 0 use the calling thread
+        queue_size
+            number of requests to prepare ahead of the sending threads
+        max_chunk_bytes
+            largest request, in bytes of NDJSON
+        max_chunk_actions
+            most actions in a request
+        max_retries
+            times an action rejected with 429 is sent again
+        initial_backoff
+            seconds of the backoff before the first retry, doubled each time
+            up to max_backoff
+        dead_letter
+            file to append the actions that failed to
+        index_names
+            dictionary of index names of the actions to the names of the
+            indexes to send them to instead
+        """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.min_chunk_bytes = min(min_chunk_bytes, max_chunk_bytes)
+        self.max_chunk_actions = max_chunk_actions
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        self.log_seconds = log_seconds
+        self.index_names = index_names or {}
+        self.serializer = client.transport.serializer
+        #shrunk by rejections, grown back by requests that go through
+        self.chunk_bytes = max_chunk_bytes
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.failed = 0
+
+    def bulk(self, actions):
+        """Send actions, as for elasticsearch.helpers. Yields (success, item)
+        for each action, in order, like elasticsearch.helpers.parallel_bulk"""
+        return self.write(self.serialize(action) for action in actions)
+
+    def bulk_ndjson(self, chunks):
+        """Send already serialized actions.
+
+        chunks is an iterable of (number of actions, bytes) where the bytes are
+        complete lines of the bulk API NDJSON format. Chunks of several actions
+        have an action and its source for each. Yields (success, item) for each
+        action
+        """
+        actions = (action for n, data in chunks
+            for action in ([data] if n == 1 else pair_lines(data)))
+        if self.index_names:
+            actions = (self.rename(action) for action in actions)
+        return self.write(actions)
+
+    def rename(self, data):
+        """Send serialized action to the index it is renamed to, if any"""
+        end = data.index(b"\n")
+        action = json.loads(data[:end])
+        details = next(iter(action.values()))
+        if details.get("_index") not in self.index_names:
+            return data
+        details["_index"] = self.index_names[details["_index"]]
+        return self.serializer.dumps(action).encode("utf-8") + data[end:]
+
+    def serialize(self, data):
+        if data.get("_index") in self.index_names:
+            data = dict(data, _index=self.index_names[data["_index"]])
+        action, source = elasticsearch.helpers.expand_action(data)
+        lines = [self.serializer.dumps(action)]
+        if source is not None:
+            lines.append(self.serializer.dumps(source))
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+    def make_requests(self, actions):
+        request = []
+        size = 0
+        for action in actions:
+            if request and (size + len(action) > self.chunk_bytes
+                    or len(request) >= self.max_chunk_actions):
+                yield request
+                request = []
+                size = 0
+            request.append(action)
+            size += len(action)
+        if request:
+            yield request
+
+    def send(self, request):
+        """Send the actions of a request, retrying the rejected ones. Returns
+        (success, item, bytes) for each action"""
+        results = [None] * len(request)
+        pending = list(range(len(request)))
+        attempt = 0
+        while True:
+            rejected = []
+            try:
+                response = self.client.bulk(body=b"".join(request[i] for i in pending))
+                for i, item in zip(pending, response["items"]):
+                    #each item has a single key with the type of action
+                    status = next(iter(item.values())).get("status", 500)
+                    if status == 429:
+                        rejected.append(i)
+                    results[i] = (200 <= status < 300, item)
+            except TransportError as e:
+                if e.status_code != 429:
+                    raise
+                rejected = pending
+                for i in rejected:
+                    results[i] = (False, {"index": {"status": 429, "error": str(e)}})
+
+            if not rejected:
+                break
+            #smaller requests for everyone until the cluster catches up
+            self.chunk_bytes = max(self.min_chunk_bytes, self.chunk_bytes // 2)
+            if attempt >= self.max_retries:
+                break
+            attempt += 1
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+            time.sleep(random.uniform(0, backoff))
+            with self.lock:
+                self.retried += len(rejected)
+            pending = rejected
+
+        if attempt == 0 and not rejected and self.chunk_bytes < self.max_chunk_bytes:
+            self.chunk_bytes = min(self.max_chunk_bytes, self.chunk_bytes + self.max_chunk_bytes // 10)
+
+        failed = [i for i, (success, _) in enumerate(results) if not success]
+        if failed:
+            self.write_dead_letter([request[i] for i in failed], [results[i][1] for i in failed])
+        return [(success, item, len(action)) for (success, item), action in zip(results, request)]
+
+    def write_dead_letter(self, actions, items):
+        with self.lock:
+            self.failed += len(actions)
+            self.logger.error("%d actions failed to index, the first with %s", len(actions),
+                next(iter(items[0].values())).get("error"))
+            if self.dead_letter:
+                with open(self.dead_letter, "ab") as dead_letter:
+                    dead_letter.write(b"".join(actions))
+
+    def write(self, actions):
+        """Send serialized actions, each the bytes of its bulk API NDJSON lines.
+        Yields (success, item) for each action"""
+        if self.thread_count > 0:
+            #bound the number of prepared requests waiting for a thread
+            semaphore = threading.BoundedSemaphore(self.thread_count + self.queue_size)
+
+            def bounded_requests():
+                for request in self.make_requests(actions):
+                    semaphore.acquire()
+                    yield request
+
+            def bounded_send(request):
+                try:
+                    return self.send(request)
+                finally:
+                    semaphore.release()
+
+            pool = ThreadPool(self.thread_count)
+            responses = pool.imap(bounded_send, bounded_requests())
+        else:
+            pool = None
+            responses = (self.send(request) for request in self.make_requests(actions))
+
+        start = logged = time.time()
+        count = 0
+        size = 0
+        try:
+            for results in responses:
+                for success, item, action_size in results:
+                    count += 1
+                    size += action_size
+                    yield success, item
+                if time.time() - logged > self.log_seconds:
+                    self.log_rate(count, size, start)
+                    logged = time.time()
+        finally:
+            if pool is not None:
+                pool.terminate()
+        self.log_rate(count, size, start)
+
+    def log_rate(self, count, size, start):
+        elapsed = max(time.time() - start, 1e-6)
+        self.logger.info("bulk wrote %d documents, %.1f MB in %.0fs (%.0f docs/s, %.2f MB/s), "
+            "%d retried, %d failed", count, size / 1e6, elapsed, count / elapsed,
+            size / 1e6 / elapsed, self.retried, self.failed)
+
+
+def pair_lines(data):
+    """Split bulk API NDJSON of actions that all have a source into the bytes
+    of each action"""
+    lines = data.splitlines(True)
+    return [lines[i] + lines[i + 1] for i in range(0, len(lines), 2)]
+
+
+def new_bulk_sink(client, folder=None, bulk_options=None):
+    """Where the stages write their indexes to, the Elasticsearch server of the
+    client or, if a folder is given, files in it to load later with
+    load_bulk_folder. bulk_options are keyword arguments of the
+    ElasticsearchSink."""
+    if folder:
+        return BulkFileSink(folder)
+    return ElasticsearchSink(client, **(bulk_options or {}))
+
+
+class ElasticsearchSink(object):
+    """Writes bulk loads to an Elasticsearch server with a BulkWriter.
+
+    Indexes are opened with alias, finalize and status_timeout as described
+    for ElasticsearchBulkIndexManager, and actions for an index loaded behind
+    an alias go to the index being loaded.
+    """
+
+    def __init__(self, client, alias=False, finalize="wait", status_timeout=None, **bulk_options):
+        self.client = client
+        self.alias = alias
+        self.finalize = finalize
+        self.status_timeout = status_timeout
+        self.bulk_options = bulk_options
+        self.managers = []
+
+    def index(self, index_name, settings={}, mappings={}, append_data=False, resume=False,
+            keep_on_error=False):
+        """Context manager to open an index for bulk loading, see
+        ElasticsearchBulkIndexManager."""
+        manager = ElasticsearchBulkIndexManager(self.client, index_name, settings, mappings,
+            append_data, resume, keep_on_error, self.alias, self.finalize, self.status_timeout)
+        self.managers.append(manager)
+        return manager
+
+    def get_targets(self):
+        """Dictionary of the names of the opened indexes loaded under another name"""
+        return dict((manager.index_name, manager.target) for manager in self.managers
+            if manager.target != manager.index_name)
+
+    def get_writer(self, thread_count, queue_size):
+        return BulkWriter(self.client, thread_count, queue_size,
+            index_names=self.get_targets(), **self.bulk_options)
+
+    def bulk(self, actions, thread_count=4, queue_size=4):
+        """Send actions, as for elasticsearch.helpers, with threads unless
+        thread_count is 0. Yields (success, item) for each action."""
+        return self.get_writer(thread_count, queue_size).bulk(actions)
+
+    def bulk_ndjson(self, chunks, thread_count=4, queue_size=4):
+        """Send already serialized actions, see BulkWriter.bulk_ndjson."""
+        return self.get_writer(thread_count, queue_size).bulk_ndjson(chunks)
+
+    def flush(self, index_names):
+        """Make what was sent to the indexes durable."""
+        targets = self.get_targets()
+        self.client.indices.flush(index=[targets.get(name, name) for name in index_names])
+
+    def is_routing_required(self, index_name):
+        return is_routing_required(self.client, self.get_targets().get(index_name, index_name))
+
+
+class BulkFileSink(object):
+    """Writes bulk loads to files instead of an Elasticsearch server.
+
+    Each index is a subfolder of the folder, with the settings and mappings to
+    create it with in index.json and the actions as bulk API NDJSON in gzip
+    files. A new file is started every `rotate_bytes` of NDJSON, and blocks of
+    `block_bytes` are compressed by `compress_threads` threads. Files are only
+    given their part-NNNNN.ndjson.gz name once complete, and the _SUCCESS file
+    is written when the index is.
+    """
+
+    INDEX_FILE = "index.json"
+    SUCCESS_FILE = "_SUCCESS"
+
+    def __init__(self, folder, rotate_bytes=1 << 30, block_bytes=1 << 22, compress_threads=4,
+            compress_level=6):
+        self.logger = logging.getLogger(__name__)
+        self.folder = folder
+        self.rotate_bytes = rotate_bytes
+        self.block_bytes = block_bytes
+        self.compress_threads = compress_threads
+        self.compress_level = compress_level
+        self.writers = {}
+        self.serializer = JSONSerializer()
+
+    def get_directory(self, index_name):
+        return os.path.join(self.folder, index_name)
+
+    def index(self, index_name, settings={}, mappings={}, append_data=False, resume=False,
+            keep_on_error=False):
+        """Context manager to open the folder of an index, replacing what was
+        written to it before unless appending or resuming."""
+        return BulkFileIndexManager(self, index_name, settings, mappings, append_data or resume)
+
+    def get_writer(self, index_name):
+        writer = self.writers.get(index_name)
+        if writer is None:
+            writer = BulkFileWriter(self.get_directory(index_name), self.rotate_bytes,
+                self.block_bytes, self.compress_threads, self.compress_level)
+            self.writers[index_name] = writer
+        return writer
+
+    def close_index(self, index_name):
+        writer = self.writers.pop(index_name, None)
+        if writer is not None:
+            writer.close()
+
+    def bulk(self, actions, thread_count=4, queue_size=4):
+        """Write actions, as for elasticsearch.helpers, into the files of their
+        indexes. Yields (success, item) for each action."""
+        for data in actions:
+            action, source = elasticsearch.helpers.expand_action(data)
+            op_type, details = next(iter(action.items()))
+            if "_index" not in details:
+                raise ValueError("unable to write an action without an index to a file")
+            lines = [self.serializer.dumps(action)]
+            if source is not None:
+                lines.append(self.serializer.dumps(source))
+            lines.append("")
+            self.get_writer(details["_index"]).write("\n".join(lines).encode("utf-8"))
+            yield True, {op_type: details}
+
+    def bulk_ndjson(self, chunks, thread_count=4, queue_size=4):
+        """Write already serialized actions, see BulkWriter.bulk_ndjson, into the
+        files of their indexes."""
+        for _, data in chunks:
+            for action, lines in split_ndjson(data.splitlines(True)):
+                details = next(iter(action.values()))
+                self.get_writer(details["_index"]).write(lines)
+                yield True, action
+
+    def flush(self, index_names):
+        """Complete the files of what was written to the indexes."""
+        for index_name in index_names:
+            if index_name in self.writers:
+                self.writers[index_name].flush()
+
+    def is_routing_required(self, index_name):
+        with open(os.path.join(self.get_directory(index_name), self.INDEX_FILE)) as index_file:
+            mappings = json.load(index_file)["mappings"]
+        return mappings.get("_routing", {}).get("required", False)
+
+
+class BulkFileIndexManager(object):
+    """Context manager to open the folder of an index of a BulkFileSink."""
+
+    def __init__(self, sink, index_name, settings={}, mappings={}, append_data=False):
+        self.logger = logging.getLogger(__name__)
+        self.sink = sink
+        self.index_name = index_name
+        self.settings = settings
+        self.mappings = mappings
+        self.append_data = append_data
+
+    def __enter__(self):
+        directory = self.sink.get_directory(self.index_name)
+        if os.path.isdir(directory) and not self.append_data:
+            self.logger.debug("deleting previous files of %s", self.index_name)
+            shutil.rmtree(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        success = os.path.join(directory, self.sink.SUCCESS_FILE)
+        if os.path.exists(success):
+            os.remove(success)
+        filename = os.path.join(directory, self.sink.INDEX_FILE)
+        with open(filename + ".tmp", "w") as index_file:
+            json.dump({"settings": self.settings, "mappings": self.mappings}, index_file)
+        os.rename(filename + ".tmp", filename)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        #what was written is kept in complete files even on an error, an
+        #interrupted load can be resumed by appending to them
+        self.sink.close_index(self.index_name)
+        if type is None:
+            directory = self.sink.get_directory(self.index_name)
+            open(os.path.join(directory, self.sink.SUCCESS_FILE), "w").close()
+        return None
+
+
+class BulkFileWriter(object):
+    """Writes NDJSON into a directory as numbered gzip files, each of a block
+    of lines compressed by a thread pool as its own gzip member."""
+
+    PART_PATTERN = "part-%05d.ndjson.gz"
+
+    def __init__(self, directory, rotate_bytes, block_bytes, compress_threads, compress_level=6):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.block_bytes = block_bytes
+        self.compress_level = compress_level
+        #appended files are numbered after the existing ones
+        self.part = len(list_bulk_files(directory))
+        self.block = []
+        self.block_size = 0
+        self.file = None
+        self.file_bytes = 0
+        self.pool = ThreadPool(compress_threads)
+        #blocks in compression, written in order once done
+        self.max_pending = 2 * compress_threads
+        self.pending = collections.deque()
+
+    def get_filename(self):
+        return os.path.join(self.directory, self.PART_PATTERN % self.part)
+
+    def write(self, data):
+        """Write bytes of complete lines"""
+        self.block.append(data)
+        self.block_size += len(data)
+        if self.block_size >= self.block_bytes:
+            self.submit_block()
+
+    def submit_block(self):
+        if not self.block:
+            return
+        if self.file is None:
+            self.file = open(self.get_filename() + ".tmp", "wb")
+        data = b"".join(self.block)
+        self.block = []
+        self.block_size = 0
+        self.pending.append(self.pool.apply_async(gzip.compress, (data, self.compress_level)))
+        self.file_bytes += len(data)
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().get())
+        if self.file_bytes >= self.rotate_bytes:
+            self.close_file()
+
+    def close_file(self):
+        while self.pending:
+            self.file.write(self.pending.popleft().get())
+        self.file.close()
+        os.rename(self.get_filename() + ".tmp", self.get_filename())
+        self.file = None
+        self.file_bytes = 0
+        self.part += 1
+
+    def flush(self):
+        """Complete the file of everything written so far"""
+        self.submit_block()
+        if self.file is not None:
+            self.close_file()
+
+    def close(self):
+        self.flush()
+        self.pool.close()
+        self.pool.join()
+
+
+def list_bulk_files(directory):
+    """Complete files of a BulkFileWriter in the directory, in order"""
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith("part-") and name.endswith(".ndjson.gz"))
+
+
+def split_ndjson(lines):
+    """Group bulk API NDJSON lines into actions. Yields (action, bytes) with the
+    action line decoded and the bytes of its lines."""
+    lines = iter(lines)
+    for line in lines:
+        action = json.loads(line)
+        if "delete" in action:
+            yield action, line
+        else:
+            yield action, line + next(lines)
+
+
+def read_bulk_files(directory):
+    """Read the actions written by a BulkFileWriter as (1, bytes) chunks for
+    BulkWriter.bulk_ndjson"""
+    for filename in list_bulk_files(directory):
+        with gzip.open(filename, "rb") as bulk_file:
+            for _, data in split_ndjson(bulk_file):
+                yield 1, data
+
+
+def load_bulk_folder(client, folder, thread_count=4, queue_size=4, **bulk_options):
+    """Load the indexes a BulkFileSink wrote into the folder into Elasticsearch,
+    replacing them. Returns a dictionary of index name to number of actions.
+    bulk_options are keyword arguments of the ElasticsearchSink."""
+    logger = logging.getLogger(__name__)
+    counts = {}
+    for index_name in sorted(os.listdir(folder)):
+        directory = os.path.join(folder, index_name)
+        if not os.path.isdir(directory):
+            continue
+        if not os.path.exists(os.path.join(directory, BulkFileSink.SUCCESS_FILE)):
+            raise RuntimeError("%s was not completely written, unable to load it" % directory)
+        with open(os.path.join(directory, BulkFileSink.INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+
+        logger.info("loading %s from %s", index_name, directory)
+        count = 0
+        failcount = 0
+        sink = ElasticsearchSink(client, **bulk_options)
+        with sink.index(index_name, index["settings"], index["mappings"]):
+            for success, _ in sink.bulk_ndjson(read_bulk_files(directory), thread_count, queue_size):
+                count += 1
+                if not success:
+                    failcount += 1
+            if failcount:
+                raise RuntimeError("%s of %s actions failed to load into %s" % (
+                    failcount, count, index_name))
+        counts[index_name] = count
+    return counts
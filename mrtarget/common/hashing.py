@@ -0,0 +1,76 @@
+from builtins import object
+import hashlib
+import json
+
+import simplejson
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# md5 is what evidence ids have always been, the others are only faster when
+# the hashes do not have to match the ones of a previous release
+HASH_ALGORITHMS = ('md5', 'sha1', 'blake2b', 'xxhash')
+
+# the standard library encoder gives the same bytes as simplejson.dumps(sort_keys=True)
+# for anything that came out of a json parser, and is built only once instead of
+# once per dumps call with keyword arguments
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def canonical_json(obj):
+    """the canonical serialization of a parsed json object, keys in sorted order"""
+    return _canonical_encoder.encode(obj)
+
+
+def get_hash_function(algorithm):
+    """return a function from bytes to a hex digest for the named algorithm"""
+    if algorithm == 'md5':
+        return lambda data: hashlib.md5(data).hexdigest()
+    elif algorithm == 'sha1':
+        return lambda data: hashlib.sha1(data).hexdigest()
+    elif algorithm == 'blake2b':
+        return lambda data: hashlib.blake2b(data, digest_size=8).hexdigest()
+    elif algorithm == 'xxhash':
+        if xxhash is None:
+            raise ValueError("hash algorithm xxhash needs the xxhash package to be installed")
+        return lambda data: xxhash.xxh64_hexdigest(data)
+    else:
+        raise ValueError("unknown hash algorithm %s, must be one of %s" % (algorithm, ", ".join(HASH_ALGORITHMS)))
+
+
+class CanonicalHasher(object):
+    """
+    Hashes evidence strings, or parts of them, by their canonical json so the
+    order of keys in the input file does not matter.
+
+    It can be pickled to be given to other processes
+    """
+
+    def __init__(self, algorithm='md5'):
+        self.algorithm = algorithm
+        self._hash = get_hash_function(algorithm)
+
+    def __getstate__(self):
+        return self.algorithm
+
+    def __setstate__(self, algorithm):
+        self.__init__(algorithm)
+
+    def hash_bytes(self, data):
+        return self._hash(data)
+
+    def hash_object(self, obj):
+        """hash a parsed json object, such as the unique association fields of an evidence"""
+        return self._hash(canonical_json(obj).encode("utf-8"))
+
+    def hash_line(self, line):
+        """hash a line of an evidence file, canonically if it can be parsed and as it is
+        otherwise. Only needed for lines that are rejected so it parses the line again
+        rather than having every valid line pay for it"""
+        try:
+            parsed_line = simplejson.loads(line)
+        except ValueError:
+            return self._hash(line.encode("utf-8"))
+        return self.hash_object(parsed_line)
@@ -0,0 +1,83 @@
+from builtins import object
+import copy
+import logging
+
+import fastjsonschema
+import jsonschema
+
+#keywords whose value is a schema, a list of schemas, or a map of names to schemas
+_SCHEMA_KEYWORDS = ('additionalItems', 'additionalProperties', 'contains', 'else', 'if',
+    'items', 'not', 'propertyNames', 'then')
+_SCHEMA_LIST_KEYWORDS = ('allOf', 'anyOf', 'oneOf', 'items')
+_SCHEMA_MAP_KEYWORDS = ('definitions', 'dependencies', 'patternProperties', 'properties')
+
+
+def _strip_schema(schema):
+    """
+    Remove the default and format keywords from a schema and its subschemas,
+    in place, so the compiled validator neither fills defaults into instances
+    nor checks formats, whichever fastjsonschema release compiles it
+    """
+    if not isinstance(schema, dict):
+        return schema
+    schema.pop('default', None)
+    schema.pop('format', None)
+    for keyword in _SCHEMA_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            _strip_schema(schema[keyword])
+    for keyword in _SCHEMA_LIST_KEYWORDS:
+        if isinstance(schema.get(keyword), list):
+            for subschema in schema[keyword]:
+                _strip_schema(subschema)
+    for keyword in _SCHEMA_MAP_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            for subschema in schema[keyword].values():
+                _strip_schema(subschema)
+    return schema
+
+
+class CompiledValidator(object):
+    """
+    Wraps a jsonschema validator with a validator compiled to python code from
+    the same schema. Valid instances only go through the compiled one, and only
+    instances it rejects are walked by the jsonschema validator, so the errors
+    of those are exactly what the jsonschema validator would have given.
+
+    The jsonschema validator does not check formats, and neither does the
+    compiled one. If the schema cannot be compiled everything goes through the
+    jsonschema validator.
+    """
+
+    def __init__(self, validator):
+        self.logger = logging.getLogger(__name__ + ".CompiledValidator")
+        self.validator = validator
+        self.compiled = None
+
+        # refs are resolved as the jsonschema validator does, relative to the
+        # $id of the schema or where it was read from if it has none. Compiling
+        # changes the schema so it is given a copy
+        resolver = validator.resolver
+        schema = _strip_schema(copy.deepcopy(validator.schema))
+        if '$id' not in schema and 'id' not in schema:
+            schema['$id'] = resolver.resolution_scope
+
+        def resolve_remote(uri):
+            # the resolver caches documents, they are stripped in a copy
+            return _strip_schema(copy.deepcopy(resolver.resolve_remote(uri)))
+
+        handlers = dict((scheme, resolve_remote) for scheme in ('file', 'http', 'https'))
+        try:
+            self.compiled = fastjsonschema.compile(schema, handlers=handlers)
+        except (fastjsonschema.JsonSchemaDefinitionException, jsonschema.RefResolutionError,
+                OSError, ValueError) as e:
+            self.logger.warning("unable to compile schema, validating without it: %s", e)
+
+    def iter_errors(self, instance):
+        if self.compiled is not None:
+            try:
+                self.compiled(instance)
+                return iter(())
+            except Exception:
+                # let the jsonschema validator say what is wrong with it
+                pass
+        return self.validator.iter_errors(instance)
@@ -3,27 +3,39 @@ from builtins import object
 import logging
 import copy
 
+import contextlib
 import functools
+import hashlib
+import heapq
 import itertools
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
 from collections import defaultdict
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
-from mrtarget.common.DataStructure import JSONSerializable
+from mrtarget.common.esutil import new_bulk_sink, is_routing_required
+from mrtarget.common.DataStructure import JSONSerializable, PipelineEncoder, json_serialize
 from mrtarget.common.connection import new_es_client
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
-from mrtarget.common.Scoring import ScoringMethods, HarmonicSumScorer
+from mrtarget.common.Scoring import ScoringMethods, HarmonicSumBatchScorer
 from mrtarget.modules.EFO import EFO
 from mrtarget.common.EvidenceString import Evidence, ExtendedInfoGene, ExtendedInfoEFO
 from mrtarget.modules.GeneData import Gene
 from mrtarget.modules.HPA import HPAExpression, hpa2tissues
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
+import cachetools
+import yaml
 from elasticsearch import helpers
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll, ConstantScore, Q
 import pypeln.process as pr
+import numpy as np
 import simplejson as json
 
 
@@ -212,6 +224,29 @@ class Association(JSONSerializable):
         if efo_info:
             self.disease[ExtendedInfoEFO.root] = efo_info.data
 
+    def set_target_fragment(self, fragment):
+        '''set the target and target facets built once for all the associations of a target'''
+        self.target = fragment.data
+        self._set_fragment_facets(fragment.facets)
+
+    def set_disease_fragment(self, fragment):
+        '''set the disease and disease facets built once for all the associations of a disease'''
+        self.disease = fragment.data
+        self._set_fragment_facets(fragment.facets)
+
+    def _set_fragment_facets(self, facets):
+        for key, value in facets.items():
+            if key == 'free_text_search':
+                self.private['facets']['free_text_search'].extend(value)
+            elif key in ('datatype', 'datasource'):
+                #these come from the evidence, not from the fragment
+                pass
+            elif key == 'expression_tissues' and not value:
+                #an empty fragment must not overwrite another one
+                pass
+            else:
+                self.private['facets'][key] = value
+
     def set_available_datasource(self, ds):
         if ds not in self.private['facets']['datasource']:
             self.private['facets']['datasource'].append(ds)
@@ -227,6 +262,192 @@ class Association(JSONSerializable):
     __nonzero__ = __bool__
 
 
+class AssociationFragment(object):
+    '''target or disease part of an association, with its facets'''
+    def __init__(self, data, facets):
+        self.data = data
+        self.facets = facets
+        self._json = None
+
+    def get_json(self):
+        '''
+        Returns (data, facets, free_text_search) already serialized, with the 
+        facets as a dict of serialized values, as AssociationRecord sets them
+        '''
+        if self._json is None:
+            facets = {}
+            free_text_search = []
+            for key, value in self.facets.items():
+                if key == 'free_text_search':
+                    free_text_search.extend(_to_json(v) for v in value)
+                elif key in ('datatype', 'datasource'):
+                    pass
+                elif key == 'expression_tissues' and not value:
+                    pass
+                else:
+                    facets[key] = _to_json(value)
+            self._json = (_to_json(self.data), facets, free_text_search)
+        return self._json
+
+
+def _to_json(value):
+    '''serialize a value exactly as JSONSerializable.to_json does'''
+    return json.dumps(value, default=json_serialize, sort_keys=True, 
+        cls=PipelineEncoder)
+
+def _number_to_json(value):
+    text = repr(value)
+    if text in ('nan', 'inf', '-inf'):
+        return json.dumps(value)
+    return text
+
+
+class AssociationLayout(object):
+    '''
+    The keys of the association documents for a datasource to datatype mapping,
+    sorted and serialized once so AssociationRecord only has to fill the values
+    '''
+    def __init__(self, datasources_to_datatypes):
+        self.datasources_to_datatypes = dict(datasources_to_datatypes)
+        self.datasources = sorted(self.datasources_to_datatypes)
+        self.datatypes = sorted(set(self.datasources_to_datatypes.values()))
+        self.datasource_keys = [json.dumps(k) + ': ' for k in self.datasources]
+        self.datatype_keys = [json.dumps(k) + ': ' for k in self.datatypes]
+
+        #the other scoring methods are never filled, only harmonic sum is
+        empty = AssociationScore(self.datasources, self.datatypes).to_json()
+        self.methods = [method for method_key, method in ScoringMethods.__dict__.items()
+            if not method_key.startswith('_')]
+        self.empty_scores = dict((method, empty) for method in self.methods
+            if method != ScoringMethods.HARMONIC_SUM)
+        self.keys = sorted(['disease', 'evidence_count', 'id', 'is_direct', 
+            'private', 'target'] + self.methods)
+        self.json_keys = dict((k, json.dumps(k) + ': ') for k in self.keys)
+
+    def values_to_json(self, keys, names, values):
+        return '{' + ', '.join([key + (_number_to_json(values[name]) 
+                if name in values else '0.0')
+            for key, name in zip(keys, names)]) + '}'
+
+
+class AssociationRecord(object):
+    '''
+    Compact association, holding only the non-zero scores and counts and the 
+    shared target and disease fragments. It serializes to the same document as
+    an Association with the same data
+    '''
+    __slots__ = ('id', 'target_id', 'disease_id', 'is_direct', 'layout',
+        'datasource_scores', 'datatype_scores', 'overall', 
+        'datasource_counts', 'total', 
+        'datasources', 'datatypes', 'free_text_search',
+        'target_fragment', 'disease_fragment')
+
+    def __init__(self, target, disease, is_direct, layout):
+        self.id = '%s-%s' % (target, disease)
+        self.target_id = target
+        self.disease_id = disease
+        self.is_direct = is_direct
+        self.layout = layout
+        self.datasource_scores = {}
+        self.datatype_scores = {}
+        self.overall = 0
+        self.datasource_counts = {}
+        self.total = 0.0
+        #facets, in order of appearance in the evidence
+        self.datasources = []
+        self.datatypes = []
+        self.free_text_search = []
+        self.target_fragment = None
+        self.disease_fragment = None
+
+    @property
+    def target(self):
+        if self.target_fragment is not None:
+            return self.target_fragment.data
+        return {'id': self.target_id}
+
+    @property
+    def disease(self):
+        if self.disease_fragment is not None:
+            return self.disease_fragment.data
+        return {'id': self.disease_id}
+
+    def set_target_fragment(self, fragment):
+        self.target_fragment = fragment
+
+    def set_disease_fragment(self, fragment):
+        self.disease_fragment = fragment
+
+    def __bool__(self):
+        return self.overall != 0
+
+    __nonzero__ = __bool__
+
+    def get_datatype_counts(self):
+        counts = {}
+        for datasource, count in self.datasource_counts.items():
+            datatype = self.layout.datasources_to_datatypes[datasource]
+            counts[datatype] = counts.get(datatype, 0.0) + count
+        return counts
+
+    def to_json(self):
+        layout = self.layout
+
+        facets = {'datasource': _to_json(self.datasources), 
+            'datatype': _to_json(self.datatypes),
+            'expression_tissues': '[]'}
+        free_text_search = [_to_json(v) for v in self.free_text_search]
+        values = {'id': _to_json(self.id), 
+            'is_direct': _to_json(self.is_direct)}
+        for name, fragment, default in (
+                ('target', self.target_fragment, self.target_id), 
+                ('disease', self.disease_fragment, self.disease_id)):
+            if fragment is None:
+                values[name] = _to_json({'id': default})
+            else:
+                data, fragment_facets, fragment_free_text = fragment.get_json()
+                values[name] = data
+                facets.update(fragment_facets)
+                free_text_search.extend(fragment_free_text)
+        facets['free_text_search'] = '[' + ', '.join(free_text_search) + ']'
+        values['private'] = '{"facets": {' + ', '.join(
+            [json.dumps(k) + ': ' + facets[k] for k in sorted(facets)]) + '}}'
+
+        values['evidence_count'] = '{"datasources": %s, "datatypes": %s, "total": %s}' % (
+            layout.values_to_json(layout.datasource_keys, layout.datasources, 
+                self.datasource_counts),
+            layout.values_to_json(layout.datatype_keys, layout.datatypes, 
+                self.get_datatype_counts()),
+            _number_to_json(self.total))
+        values[ScoringMethods.HARMONIC_SUM] = \
+            '{"datasources": %s, "datatypes": %s, "overall": %s}' % (
+            layout.values_to_json(layout.datasource_keys, layout.datasources, 
+                self.datasource_scores),
+            layout.values_to_json(layout.datatype_keys, layout.datatypes, 
+                self.datatype_scores),
+            _number_to_json(self.overall))
+        values.update(layout.empty_scores)
+
+        return '{' + ', '.join([layout.json_keys[k] + values[k] 
+            for k in layout.keys]) + '}'
+
+
+class EvidenceColumns(object):
+    '''
+    Scoring projection of the evidence of several pairs, as one row per pair with
+    its facets and one array element per evidence with the index of its pair,
+    the index of its datasource and its unweighted score
+    '''
+    def __init__(self, layout):
+        self.layout = layout
+        self.pairs = []
+        self.pair = None
+        self.datasource = None
+        self.score = None
+        #evidence counts per pair and datasource, when not all the evidence is kept
+        self.counts = None
+
+
 class EvidenceScore(object):
     def __init__(self, score, datatype, datasource, is_direct):
         self.score = score
@@ -240,85 +461,449 @@ class Scorer(object):
     Aggregates evidence for a given target-disease pair
     '''
     def __init__(self):
-        pass
+        self.engine = None
+        self.layout = None
 
     def score(self,target, disease, evidence_scores, is_direct, datasources_to_datatypes):
+        return self.score_many([(target, disease, evidence_scores, is_direct)],
+            datasources_to_datatypes)[0]
 
+    def score_many(self, evidence_sets, datasources_to_datatypes):
+        '''
+        Aggregates evidence for several target-disease pairs at once, typically all
+        the pairs of a target, and returns a list with one association per pair
+        '''
 
         datasources = list(datasources_to_datatypes.keys())
         datatypes = set(datasources_to_datatypes.values())
 
-        association = Association(target, disease, is_direct, datasources, datatypes)
+        associations = []
+        for target, disease, evidence_scores, is_direct in evidence_sets:
+            association = Association(target, disease, is_direct, datasources, datatypes)
 
-        # set evidence counts
-        for e in evidence_scores:
-            # make sure datatype is constrained
-            if all([e.datatype in association.evidence_count['datatypes'],
-                    e.datasource in association.evidence_count['datasources']]):
-                association.evidence_count['total']+=1
-                association.evidence_count['datatypes'][e.datatype]+=1
-                association.evidence_count['datasources'][e.datasource]+=1
+            # set evidence counts
+            for e in evidence_scores:
+                # make sure datatype is constrained
+                if all([e.datatype in association.evidence_count['datatypes'],
+                        e.datasource in association.evidence_count['datasources']]):
+                    association.evidence_count['total']+=1
+                    association.evidence_count['datatypes'][e.datatype]+=1
+                    association.evidence_count['datasources'][e.datasource]+=1
 
-                # set facet data
-                association.set_available_datatype(e.datatype)
-                association.set_available_datasource(e.datasource)
+                    # set facet data
+                    association.set_available_datatype(e.datatype)
+                    association.set_available_datasource(e.datasource)
+
+            associations.append(association)
 
         # compute harmonic sum with quadratic (scale_factor) degradation
         #limit to first 100 entries and scale with afactor of 2
-        self._harmonic_sum(evidence_scores, association, 100, 2, datasources_to_datatypes)
-
-        return association
+        self._harmonic_sum([e[2] for e in evidence_sets], associations, 
+            100, 2, datasources_to_datatypes)
+
+        return associations
+
+    def score_records(self, evidence_sets, datasources_to_datatypes):
+        '''
+        Same as score_many, but returns compact AssociationRecord objects that
+        only keep the non-zero scores and counts
+        '''
+        return self.score_columns(self.get_columns(evidence_sets, datasources_to_datatypes))
+
+    def get_columns(self, evidence_sets, datasources_to_datatypes):
+        '''
+        Load the scoring projection of the evidence of several pairs into an 
+        EvidenceColumns, so it can be scored with several weightings
+        '''
+        engine = self._get_engine(100, 2, datasources_to_datatypes)
+        layout = self.layout
+        if layout is None or layout.datasources_to_datatypes != datasources_to_datatypes:
+            layout = AssociationLayout(datasources_to_datatypes)
+            self.layout = layout
+
+        columns = EvidenceColumns(layout)
+        pairs = []
+        datasources = []
+        scores = []
+        for i, (target, disease, evidence_scores, is_direct) in enumerate(evidence_sets):
+            datatype_facets = []
+            datasource_facets = []
+            free_text_search = []
+            for e in evidence_scores:
+                pairs.append(i)
+                datasources.append(engine.datasource_index[e.datasource])
+                scores.append(float(e.score))
 
-    def _harmonic_sum(self, evidence_scores, association, 
+                # set facet data
+                if e.datatype not in datatype_facets:
+                    datatype_facets.append(e.datatype)
+                    free_text_search.append(e.datatype)
+                if e.datasource not in datasource_facets:
+                    datasource_facets.append(e.datasource)
+                    free_text_search.append(e.datasource)
+            columns.pairs.append((target, disease, is_direct, 
+                datatype_facets, datasource_facets, free_text_search))
+
+        columns.pair = np.array(pairs, dtype=np.int32)
+        columns.datasource = np.array(datasources, dtype=np.int16)
+        columns.score = np.array(scores, dtype=np.float64)
+        return columns
+
+    def get_partial_columns(self, partials, datasources_to_datatypes):
+        '''
+        Load partial aggregates, as from get_partials, into an EvidenceColumns 
+        that scores as the evidence they were computed from
+        '''
+        engine = self._get_engine(PARTIAL_SCORES, 2, datasources_to_datatypes)
+        layout = self.layout
+        if layout is None or layout.datasources_to_datatypes != datasources_to_datatypes:
+            layout = AssociationLayout(datasources_to_datatypes)
+            self.layout = layout
+
+        columns = EvidenceColumns(layout)
+        pairs = []
+        datasources = []
+        scores = []
+        counts = []
+        for (target, disease), rows in itertools.groupby(partials, key=lambda p: (p[0], p[1])):
+            i = len(columns.pairs)
+            pair_counts = np.zeros(len(engine.datasources), dtype=np.int64)
+            datatype_facets = []
+            datasource_facets = []
+            free_text_search = []
+            is_direct = False
+            for _, _, datasource, datasource_is_direct, count, datasource_scores in rows:
+                j = engine.datasource_index[datasource]
+                pairs.extend([i] * len(datasource_scores))
+                datasources.extend([j] * len(datasource_scores))
+                scores.extend(datasource_scores)
+                pair_counts[j] = count
+                is_direct = is_direct or datasource_is_direct
+
+                datatype = datasources_to_datatypes[datasource]
+                if datatype not in datatype_facets:
+                    datatype_facets.append(datatype)
+                    free_text_search.append(datatype)
+                datasource_facets.append(datasource)
+                free_text_search.append(datasource)
+            columns.pairs.append((target, disease, is_direct, 
+                datatype_facets, datasource_facets, free_text_search))
+            counts.append(pair_counts)
+
+        columns.pair = np.array(pairs, dtype=np.int32)
+        columns.datasource = np.array(datasources, dtype=np.int16)
+        columns.score = np.array(scores, dtype=np.float64)
+        columns.counts = np.array(counts, dtype=np.int64).reshape(len(counts), len(engine.datasources))
+        return columns
+
+    def score_columns(self, columns, scoring_weights=None):
+        '''
+        Score the pairs of an EvidenceColumns, with each evidence score multiplied
+        by the weight of its datasource if any, as group_evidence would have
+        '''
+        engine = self.engine
+        layout = columns.layout
+
+        scores = columns.score
+        if scoring_weights:
+            weights = np.ones(len(engine.datasources), dtype=np.float64)
+            for datasource, weight in scoring_weights.items():
+                if datasource in engine.datasource_index:
+                    weights[engine.datasource_index[datasource]] = weight
+            scores = scores * weights[columns.datasource]
+
+        datasource_scores, datatype_scores, overall, counts, capped = \
+            engine.score(columns.pair, columns.datasource, scores, len(columns.pairs))
+        if columns.counts is not None:
+            #only the top scores were kept, not all the evidence
+            counts = columns.counts
+
+        datasource_scores = datasource_scores.tolist()
+        datatype_scores = datatype_scores.tolist()
+        overall = overall.tolist()
+        records = []
+        for i, (target, disease, is_direct, datatype_facets, datasource_facets, 
+                free_text_search) in enumerate(columns.pairs):
+            record = AssociationRecord(target, disease, is_direct, layout)
+            #facets do not depend on the weights, so they are shared
+            record.datatypes = datatype_facets
+            record.datasources = datasource_facets
+            record.free_text_search = free_text_search
+            pair_datasources = np.flatnonzero(counts[i])
+            for j in pair_datasources:
+                datasource = engine.datasources[j]
+                record.datasource_counts[datasource] = float(counts[i, j])
+                #keep the cap value itself when capped, as HarmonicSumScorer does
+                record.datasource_scores[datasource] = \
+                    engine.cap if capped[i, j] else datasource_scores[i][j]
+            for j, datatype in enumerate(engine.datatypes):
+                if datatype_scores[i][j]:
+                    record.datatype_scores[datatype] = datatype_scores[i][j]
+            record.total = float(counts[i].sum())
+            record.overall = overall[i] if len(pair_datasources) else 0
+            records.append(record)
+
+        return records
+
+    def _get_engine(self, max_entries, scale_factor, datasources_to_datatypes):
+        engine = self.engine
+        if engine is None or engine.buffer != max_entries \
+                or engine.scale_factor != scale_factor \
+                or engine.datasources_to_datatypes != datasources_to_datatypes:
+            #cap datasource scores so very big scores 
+            #do not take over smaller score around the range of 1
+            engine = HarmonicSumBatchScorer(datasources_to_datatypes, 
+                buffer=max_entries, scale_factor=scale_factor, cap=1)
+            self.engine = engine
+        return engine
+
+    def _harmonic_sum(self, evidence_sets, associations, 
             max_entries, scale_factor, datasources_to_datatypes):
-        har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
-        datasource_scorers = {}
-        for e in evidence_scores:
-            if e.datasource not in datasource_scorers:
-                datasource_scorers[e.datasource]= HarmonicSumScorer(buffer=max_entries)
-            datasource_scorers[e.datasource].add(e.score)
-        '''compute datasource scores'''
-        overall_scorer = HarmonicSumScorer(buffer=max_entries)
-        for datasource in datasource_scorers:
-            '''cap datasource scores at this level so very big scores 
-            do not take over smaller score around the range of 1'''
-            har_sum_score.datasources[datasource]=datasource_scorers[datasource].score(scale_factor=scale_factor, cap=1)
-            overall_scorer.add(har_sum_score.datasources[datasource])
-        '''compute datatype scores'''
-        datatypes_scorers = dict()
-        for ds in har_sum_score.datasources:
-            dt = datasources_to_datatypes[ds]
-            if dt not in datatypes_scorers:
-                datatypes_scorers[dt]= HarmonicSumScorer(buffer=max_entries)
-            datatypes_scorers[dt].add(har_sum_score.datasources[ds])
-        for datatype in datatypes_scorers:
-            har_sum_score.datatypes[datatype]=datatypes_scorers[datatype].score(scale_factor=scale_factor)
-        '''compute overall scores'''
-        har_sum_score.overall = overall_scorer.score(scale_factor=scale_factor)
-
-        return association
+        engine = self._get_engine(max_entries, scale_factor, datasources_to_datatypes)
+
+        #flatten all the evidence of all the pairs into arrays
+        pairs = []
+        datasources = []
+        scores = []
+        for i, evidence_scores in enumerate(evidence_sets):
+            for e in evidence_scores:
+                pairs.append(i)
+                datasources.append(engine.datasource_index[e.datasource])
+                scores.append(float(e.score))
+
+        datasource_scores, datatype_scores, overall, counts, capped = \
+            engine.score(pairs, datasources, scores, len(evidence_sets))
+
+        datasource_scores = datasource_scores.tolist()
+        datatype_scores = datatype_scores.tolist()
+        overall = overall.tolist()
+        for i, association in enumerate(associations):
+            har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+            pair_datasources = np.flatnonzero(counts[i])
+            for j in pair_datasources:
+                #keep the cap value itself when capped, as HarmonicSumScorer does
+                har_sum_score.datasources[engine.datasources[j]] = \
+                    engine.cap if capped[i, j] else datasource_scores[i][j]
+            for j, datatype in enumerate(engine.datatypes):
+                har_sum_score.datatypes[datatype] = datatype_scores[i][j]
+            har_sum_score.overall = overall[i] if len(pair_datasources) else 0
+
+        return associations
 
 def produce_evidence_local_init(es_hosts, es_index_val_right,
         scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
     es = new_es_client(es_hosts)
+    routed = is_routing_required(es, es_index_val_right)
     return (es, es_index_val_right, scoring_weights, 
-        is_direct_do_not_propagate, datasources_to_datatypes)
+        is_direct_do_not_propagate, datasources_to_datatypes, routed)
+
+EVIDENCE_SCORING_FIELDS = ['target.id', 'private.efo_codes', 'disease.id',
+    'scores.association_score','sourceID','id']
 
-def get_evidence_for_target_simple(es, target, index):
-    fields = ['target.id', 'private.efo_codes', 'disease.id','scores.association_score','sourceID','id']
-    evidence = Search().using(es).index(index).query(
-        ConstantScore(filter=Q('term', target__id=target))
-    ).source(includes=fields).params(scroll='4h', size=1000).scan()
+def get_evidence_for_target_simple(es, target, index, diseases=None, routed=False):
+    """
+    Yields the scoring fields of the evidence of a target, or of the part of it
+    with diseases in the range. With routed, only the shard of the target is
+    queried, for evidence indexed with the target as routing
+    """
+    query = Q('term', target__id=target)
+    if diseases is not None:
+        #evidence that can be grouped into a disease of the range
+        disease_range = {}
+        if diseases[0] is not None:
+            disease_range['gte'] = diseases[0]
+        if diseases[1] is not None:
+            disease_range['lt'] = diseases[1]
+        query = query & Q('bool', minimum_should_match=1, should=[
+            Q('range', private__efo_codes=disease_range),
+            Q('range', disease__id=disease_range)])
+    search = Search().using(es).index(index).query(
+        ConstantScore(filter=query)
+    ).source(includes=EVIDENCE_SCORING_FIELDS).params(scroll='4h', size=1000)
+    if routed:
+        search = search.params(routing=target)
+    evidence = search.scan()
     for ev in evidence:
         yield ev.to_dict()
 
-def produce_evidence(target, es, es_index_val_right,
-        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+def in_disease_range(disease, diseases):
+    first, last = diseases
+    return (first is None or disease >= first) and (last is None or disease < last)
+
+def get_evidence_counts(es, index, field, query=None, size=10000):
+    """
+    Yields (value, number of evidence) for each value of a keyword field of the
+    evidence index, in value order, paging through a composite aggregation
+    """
+    after = None
+    while True:
+        composite = {'size': size, 'sources': [{'key': {'terms': {'field': field}}}]}
+        if after is not None:
+            composite['after'] = after
+        body = {'size': 0, 'aggs': {'counts': {'composite': composite}}}
+        if query is not None:
+            body['query'] = query
+        counts = es.search(index=index, body=body)['aggregations']['counts']
+        for bucket in counts['buckets']:
+            yield bucket['key']['key'], bucket['doc_count']
+        if not counts['buckets'] or 'after_key' not in counts:
+            break
+        after = counts['after_key']
+
+def split_disease_ranges(disease_counts, parts):
+    """
+    Split sorted (disease, count) into at most parts contiguous ranges of similar
+    total count. Returns a list of ((first, last), count) where first is included
+    and last is not, and None is unbounded
+    """
+    total = sum(count for _, count in disease_counts)
+    ranges = []
+    first = None
+    size = 0
+    seen = 0
+    for disease, count in disease_counts:
+        #start a new range when this disease would go past the next boundary
+        if size and len(ranges) < parts - 1 \
+                and seen + count > float(total) * (len(ranges) + 1) / parts:
+            ranges.append(((first, disease), size))
+            first = disease
+            size = 0
+        size += count
+        seen += count
+    ranges.append(((first, None), size))
+    return ranges
+
+def estimate_makespan(costs, workers):
+    """
+    Time until the last of the workers is done, when each task in order goes 
+    to the least busy worker
+    """
+    loads = [0] * max(workers, 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+def get_evidence_slice(es, index, slice_id, slices, datasources=None):
+    """
+    Scan one slice of the evidence index sorted by target.id, optionally only
+    the evidence of some datasources
+    """
+    query = MatchAll()
+    if datasources:
+        query = ConstantScore(filter=Q('terms', sourceID__keyword=list(datasources)))
+    search = Search().using(es).index(index).query(query) \
+        .source(includes=EVIDENCE_SCORING_FIELDS).sort('target.id') \
+        .params(scroll='4h', size=1000, preserve_order=True)
+    if slices > 1:
+        search = search.extra(slice={'id': slice_id, 'max': slices})
+    for ev in search.scan():
+        yield ev.to_dict()
+
+class _SliceFailure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+def iterate_in_thread(iterable, queue_size):
+    """
+    Consume an iterable in a background thread, buffering up to queue_size elements.
+    Exceptions raised by the iterable are re-raised in the consumer
+    """
+    buffer = queue.Queue(maxsize=queue_size)
+    done = object()
+
+    def fill():
+        try:
+            for element in iterable:
+                buffer.put(element)
+            buffer.put(done)
+        except Exception as e:
+            buffer.put(_SliceFailure(e))
+
+    thread = threading.Thread(target=fill)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        element = buffer.get()
+        if element is done:
+            break
+        if isinstance(element, _SliceFailure):
+            raise element.exception
+        yield element
+
+def get_evidence_by_target(es, index, slices, queue_size, datasources=None):
+    """
+    Read the whole evidence index once with parallel sliced scans, each sorted
+    by target.id, and yield a (target, [evidence...]) batch for each target
+    that has evidence.
+
+    Each slice is read in its own thread and the sorted slices are merged so
+    all the evidence of a target is grouped together as it streams.
+    """
+    streams = [iterate_in_thread(get_evidence_slice(es, index, i, slices, datasources), queue_size)
+        for i in range(slices)]
+    merged = heapq.merge(*streams, key=lambda ev: ev['target']['id'])
+    for target, evidence in itertools.groupby(merged, key=lambda ev: ev['target']['id']):
+        yield target, list(evidence)
+
+def target_shard(target, shards):
+    """
+    Shard of a target out of the given number of shards, stable across 
+    processes and machines unlike the builtin hash
+    """
+    return int(hashlib.md5(target.encode('utf-8')).hexdigest(), 16) % shards
+
+MANIFEST_CONFIGURATION = '#configuration'
+
+def evidence_digest(evidence):
+    """
+    Digest of the scoring fields of the evidence of a target, independent of
+    the order the evidence was read in
+    """
+    rows = sorted(json.dumps(ev, sort_keys=True) for ev in evidence)
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update(row.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def load_manifest(filename):
+    """
+    Read a manifest written by save_manifest. Returns (configuration digest,
+    {target: evidence digest}), or (None, {}) if there is no such file
+    """
+    configuration = None
+    targets = {}
+    if not os.path.isfile(filename):
+        return configuration, targets
+    with open(filename, 'r') as manifest_file:
+        for line in manifest_file:
+            key, digest = line.rstrip('\n').split('\t')
+            if key == MANIFEST_CONFIGURATION:
+                configuration = digest
+            else:
+                targets[key] = digest
+    return configuration, targets
+
+def save_manifest(filename, configuration, targets):
+    """
+    Write the configuration digest and the per-target evidence digests as TSV.
+    The file is replaced only once it has been completely written
+    """
+    manifestdir = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(manifestdir):
+        os.makedirs(manifestdir)
+    with open(filename + '.tmp', 'w') as manifest_file:
+        manifest_file.write('%s\t%s\n' % (MANIFEST_CONFIGURATION, configuration))
+        for target in sorted(targets):
+            manifest_file.write('%s\t%s\n' % (target, targets[target]))
+    os.rename(filename + '.tmp', filename)
+
+def group_evidence(evidence_iterable, scoring_weights, 
+        is_direct_do_not_propagate, datasources_to_datatypes, diseases=None):
     data_cache = {}
     return_values = []
-    for evidence in get_evidence_for_target_simple(es, target, es_index_val_right):
-
-        
+    for evidence in evidence_iterable:
 
         if evidence['sourceID'] in is_direct_do_not_propagate:
             efo_list = [evidence['disease']['id']]
@@ -327,6 +912,9 @@ def produce_evidence(target, es, es_index_val_right,
 
 
         for efo in efo_list:
+            #other diseases are grouped by another part of the target
+            if diseases is not None and not in_disease_range(efo, diseases):
+                continue
             key = (evidence['target']['id'], efo)
 
             if key not in data_cache:
@@ -356,12 +944,35 @@ def produce_evidence(target, es, es_index_val_right,
 
     return return_values
 
-def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
-        es_index_gene, es_index_hpa, es_index_efo,
-        gene_cache_size, hpa_cache_size,
-        efo_cache_size, ):
-    scorer = Scorer()
-    lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
+def split_task(task):
+    """
+    Tasks are either a target, or a (target, (first, last)) part of a target 
+    that only has the pairs with diseases in that range
+    """
+    if isinstance(task, tuple):
+        return task
+    return task, None
+
+def produce_evidence(target, es, es_index_val_right,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes, routed=False):
+    target, diseases = split_task(target)
+    return group_evidence(get_evidence_for_target_simple(es, target, es_index_val_right, diseases, routed),
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes, diseases)
+
+def produce_evidence_batch_local_init(scoring_weights, 
+        is_direct_do_not_propagate, datasources_to_datatypes):
+    return (scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes)
+
+def produce_evidence_batch(batch, 
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+    #evidence has already been read, only group it
+    _, evidence = batch
+    return group_evidence(evidence, 
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes)
+
+def new_association_lookup(es_hosts, es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size):
+    return LookUpDataRetriever(new_es_client(es_hosts), 
         gene_index=es_index_gene,
         gene_cache_size = gene_cache_size,
         hpa_index=es_index_hpa,
@@ -369,56 +980,286 @@ def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
         efo_index=es_index_efo,
         efo_cache_size = efo_cache_size
         ).lookup
-    return scorer, lookup_data, datasources_to_datatypes, dry_run
+
+def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
+        es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size,
+        efo_cache_size, target_fragment_cache_size, disease_fragment_cache_size):
+    scorer = Scorer()
+    lookup_data = new_association_lookup(es_hosts, 
+        es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size)
+    enricher = AssociationEnricher(lookup_data, 
+        target_fragment_cache_size, disease_fragment_cache_size)
+    return scorer, enricher, datasources_to_datatypes, dry_run
+
+class AssociationEnricher(object):
+    '''
+    Adds the target, expression and disease information to scored associations.
+
+    That information only depends on the target or on the disease, so it is
+    built once for each of them as a fragment and shared by all their 
+    associations. The most recently used fragments are kept in bounded caches.
+    Fragments are shared, so they must not be modified once built.
+    '''
+    def __init__(self, lookup_data, target_cache_size, disease_cache_size):
+        self.lookup_data = lookup_data
+        self.target_fragments = cachetools.LRUCache(target_cache_size)
+        self.disease_fragments = cachetools.LRUCache(disease_cache_size)
+
+    def enrich(self, association):
+        target = association.target['id']
+        target_fragment = self.target_fragments.get(target)
+        if target_fragment is None:
+            target_fragment = self.get_target_fragment(target)
+            if self.target_fragments.maxsize > 0:
+                self.target_fragments[target] = target_fragment
+        association.set_target_fragment(target_fragment)
+
+        disease = association.disease['id']
+        disease_fragment = self.disease_fragments.get(disease)
+        if disease_fragment is None:
+            disease_fragment = self.get_disease_fragment(disease)
+            if self.disease_fragments.maxsize > 0:
+                self.disease_fragments[disease] = disease_fragment
+        association.set_disease_fragment(disease_fragment)
+
+        return association
+
+    def get_target_fragment(self, target):
+        gene_data = Gene()
+        gene_data_index = self.lookup_data.available_genes.get_gene(target)
+        if gene_data_index != None:
+            gene_data.load_json(gene_data_index)
+
+        # create a hpa expression empty jsonserializable class
+        hpa_data = HPAExpression()
+        try:
+            hpa_index = self.lookup_data.available_hpa.get_hpa(target)
+            if hpa_index is not None:
+                hpa_data.update(hpa_index)
+        except KeyError:
+            pass
+
+        #use an empty association to build the fragment
+        #so it is exactly what would have been set on each association
+        association = Association(target, None, False, [], [])
+        association.set_target_data(gene_data)
+        try:
+            association.set_hpa_data(hpa_data)
+        except KeyError:
+            pass
+        return AssociationFragment(association.target, association.private['facets'])
+
+    def get_disease_fragment(self, disease):
+        disease_data = EFO()
+        disease_data.load_json(
+            self.lookup_data.available_efos.get_efo(disease))
+
+        association = Association(None, disease, False, [], [])
+        association.set_disease_data(disease_data)
+        return AssociationFragment(association.disease, association.private['facets'])
 
 def score_producer(data, 
-        scorer, lookup_data, datasources_to_datatypes, dry_run):
+        scorer, enricher, datasources_to_datatypes, dry_run):
     target, disease, evidence, is_direct = data
 
     if evidence:
-        score = scorer.score(target, disease, evidence, is_direct, 
-            datasources_to_datatypes)
+        score = scorer.score_records([(target, disease, evidence, is_direct)], 
+            datasources_to_datatypes)[0]
         # skip associations only with data with score 0
         if score: 
+            enricher.enrich(score)
 
-            gene_data = Gene()
-            gene_data_index = lookup_data.available_genes.get_gene(target)
-            if gene_data_index != None:
-                gene_data.load_json(gene_data_index)
-            score.set_target_data(gene_data)
+            element_id = '%s-%s' % (target, disease)
 
-            # create a hpa expression empty jsonserializable class
-            hpa_data = HPAExpression()
-            try:
-                hpa_index = lookup_data.available_hpa.get_hpa(target)
-                if hpa_index is not None:
-                    hpa_data.update(hpa_index)
-            except KeyError:
-                pass
-            except Exception as e:
-                raise e
-            try:
-                score.set_hpa_data(hpa_data)
-            except KeyError:
-                pass
-            except Exception as e:
-                raise e
+            #convert the score into a JSON-compatible object
+            #otherwise Python serialization consumes too much memory
+            return (element_id, score.to_json())
 
+        return None
 
-            disease_data = EFO()
-            disease_data.load_json(
-                lookup_data.available_efos.get_efo(disease))
+def score_target_local_init(evidence_reader, es_hosts, es_index_val_right,
+        weightings, is_direct_do_not_propagate, datasources_to_datatypes,
+        es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size,
+        target_fragment_cache_size, disease_fragment_cache_size):
+    #sliced batches already carry their evidence, no need to query for it
+    es = new_es_client(es_hosts) if evidence_reader != 'sliced' else None
+    routed = es is not None and is_routing_required(es, es_index_val_right)
+    scorer = Scorer()
+    lookup_data = new_association_lookup(es_hosts, 
+        es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size)
+    enricher = AssociationEnricher(lookup_data, 
+        target_fragment_cache_size, disease_fragment_cache_size)
+    return (es, es_index_val_right,
+        weightings, is_direct_do_not_propagate, datasources_to_datatypes,
+        scorer, enricher, routed)
+
+def score_target(item, es, es_index_val_right,
+        weightings, is_direct_do_not_propagate, datasources_to_datatypes,
+        scorer, enricher, routed=False, batch_size=1000):
+    """
+    Fetch, group, score, enrich and serialize all the associations of a target in
+    one process.
 
-            score.set_disease_data(disease_data)
+    Weightings are a list of (index, scoring weights). The evidence is read and
+    grouped once, and scored with each weighting into its own index.
 
+    The item is either a target id or part of a target, whose evidence is then
+    queried, from the shard of the target only if routed, or a (target,
+    [evidence...]) batch from the sliced reader.
 
-            element_id = '%s-%s' % (target, disease)
+    Returns (number of associations, bytes) where the bytes are the bulk API
+    NDJSON lines for those associations, so only those cross to the writer
+    """
+    diseases = None
+    if es is None:
+        target, evidence = item
+    else:
+        target, diseases = split_task(item)
+        evidence = get_evidence_for_target_simple(es, target, es_index_val_right, diseases, routed)
+
+    #weights are applied when scoring each weighting
+    evidence_sets = [e for e in group_evidence(evidence, {}, 
+        is_direct_do_not_propagate, datasources_to_datatypes, diseases) if e[2]]
+
+    count = 0
+    lines = []
+    #score in batches to bound the memory of targets with many diseases
+    for i in range(0, len(evidence_sets), batch_size):
+        columns = scorer.get_columns(evidence_sets[i:i+batch_size], datasources_to_datatypes)
+        count += columns_to_ndjson(columns, weightings, scorer, enricher, lines)
+
+    if not count:
+        return count, b""
+    return count, ("\n".join(lines) + "\n").encode("utf-8")
+
+def columns_to_ndjson(columns, weightings, scorer, enricher, lines):
+    """
+    Score the columns with each weighting, enrich the associations and append
+    their bulk API lines. Returns the number of associations
+    """
+    count = 0
+    for es_index, scoring_weights in weightings:
+        for score in scorer.score_columns(columns, scoring_weights):
+            # skip associations only with data with score 0
+            if score:
+                enricher.enrich(score)
+
+                action = {"index": {"_index": es_index, "_id": score.id}}
+                lines.append(json.dumps(action))
+                lines.append(score.to_json())
+                count += 1
+    return count
+
+PARTIAL_SCORES = 100
+
+def get_partials(evidence_sets):
+    """
+    Yields the partial aggregate of each datasource of each pair as 
+    (target, disease, datasource, is_direct, count, [top scores...]), with the
+    unweighted scores that the harmonic sum of that datasource depends on
+    """
+    for target, disease, evidence_scores, _ in evidence_sets:
+        scores = defaultdict(list)
+        direct = defaultdict(bool)
+        for e in evidence_scores:
+            scores[e.datasource].append(float(e.score))
+            direct[e.datasource] = direct[e.datasource] or e.is_direct
+        for datasource in sorted(scores):
+            yield (target, disease, datasource, direct[datasource], 
+                len(scores[datasource]), heapq.nlargest(PARTIAL_SCORES, scores[datasource]))
 
-            #convert the score into a JSON-compatible object
-            #otherwise Python serialization consumes too much memory
-            return (element_id, score.to_json())
 
-        return None
+class PartialAggregateStore(object):
+    """
+    Local SQLite file of the per (target, disease, datasource) partial
+    aggregates of a complete association run, so associations can be rebuilt
+    when some datasources change without reading the evidence of the others
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        #written from the thread feeding the pipeline
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS partials ("
+            "target TEXT, disease TEXT, datasource TEXT, is_direct INTEGER, "
+            "count INTEGER, scores BLOB, PRIMARY KEY (target, disease, datasource))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS partials_datasource "
+            "ON partials (datasource)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM partials")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+
+    def put(self, partials):
+        self.connection.executemany("INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?, ?, ?)",
+            ((target, disease, datasource, int(is_direct), count, 
+                    np.asarray(scores, dtype=np.float64).tobytes())
+                for target, disease, datasource, is_direct, count, scores in partials))
+
+    def commit(self):
+        self.connection.commit()
+
+    def delete_datasources(self, datasources):
+        self.connection.executemany("DELETE FROM partials WHERE datasource = ?", 
+            ((datasource,) for datasource in datasources))
+
+    def get_targets(self, datasources):
+        targets = set()
+        for datasource in datasources:
+            for row in self.connection.execute(
+                    "SELECT DISTINCT target FROM partials WHERE datasource = ?", (datasource,)):
+                targets.add(row[0])
+        return targets
+
+    def get_target(self, target):
+        """Yields the partial aggregates of a target, as from get_partials"""
+        for disease, datasource, is_direct, count, scores in self.connection.execute(
+                "SELECT disease, datasource, is_direct, count, scores FROM partials "
+                "WHERE target = ? ORDER BY disease, datasource", (target,)):
+            yield (target, disease, datasource, bool(is_direct), count, 
+                np.frombuffer(scores, dtype=np.float64).tolist())
+
+def rebuild_target_local_init(partials, weightings, datasources_to_datatypes,
+        es_hosts, es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size,
+        target_fragment_cache_size, disease_fragment_cache_size):
+    store = PartialAggregateStore(partials)
+    scorer = Scorer()
+    lookup_data = new_association_lookup(es_hosts, 
+        es_index_gene, es_index_hpa, es_index_efo,
+        gene_cache_size, hpa_cache_size, efo_cache_size)
+    enricher = AssociationEnricher(lookup_data, 
+        target_fragment_cache_size, disease_fragment_cache_size)
+    return store, weightings, datasources_to_datatypes, scorer, enricher
+
+def rebuild_target(target, store, weightings, datasources_to_datatypes, scorer, enricher):
+    """
+    Score, enrich and serialize all the associations of a target from its stored
+    partial aggregates. Returns (number of associations, bytes) as score_target
+    """
+    columns = scorer.get_partial_columns(store.get_target(target), datasources_to_datatypes)
+    lines = []
+    count = columns_to_ndjson(columns, weightings, scorer, enricher, lines)
+    if not count:
+        return count, b""
+    return count, ("\n".join(lines) + "\n").encode("utf-8")
 
 
 class ScoringProcess(object):
@@ -428,8 +1269,13 @@ class ScoringProcess(object):
             workers_write, workers_production, workers_score, 
             queue_score, queue_produce, queue_write, 
             cache_hpa, cache_efo, cache_target, 
+            cache_target_fragment, cache_disease_fragment,
             scoring_weights, is_direct_do_not_propagate,
-            datasources_to_datatypes):
+            datasources_to_datatypes,
+            evidence_reader, evidence_slices, queue_evidence,
+            pipeline, manifest, incremental, shard, shards,
+            schedule, split_evidence, weightings,
+            partials, partial_datasources, es_folder=None, es_bulk=None, shard_timeout=86400):
 
         self.logger = logging.getLogger(__name__)
 
@@ -437,6 +1283,8 @@ class ScoringProcess(object):
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.es_index_gene = es_index_gene
         self.es_index_val_right = es_index_val_right
         self.es_index_hpa = es_index_hpa
@@ -452,37 +1300,350 @@ class ScoringProcess(object):
         self.cache_hpa = cache_hpa
         self.cache_efo = cache_efo
         self.cache_target = cache_target
+        self.cache_target_fragment = cache_target_fragment
+        self.cache_disease_fragment = cache_disease_fragment
 
         self.scoring_weights = scoring_weights
         self.is_direct_do_not_propagate = is_direct_do_not_propagate
         self.datasources_to_datatypes = datasources_to_datatypes
 
+        #how evidence is read, either one scan per target or one sliced scan
+        self.evidence_reader = evidence_reader
+        self.evidence_slices = evidence_slices
+        self.queue_evidence = queue_evidence
+
+        #either staged producer and scorer processes, or fused per target processes
+        self.pipeline = pipeline
+
+        #per-target evidence digests of the previous run, to only rescore changes
+        self.manifest = manifest
+        self.incremental = incremental
+        if self.incremental and not self.manifest:
+            raise ValueError("incremental scoring needs a manifest")
+        if self.manifest and self.evidence_reader != 'sliced':
+            #digests need all the evidence of a target in one place
+            self.logger.info("target digests for the manifest use the sliced evidence reader")
+            self.evidence_reader = 'sliced'
+
+        #this process only scores the targets of its shard, other shards may be
+        #on other machines writing to the same index
+        self.shard = shard
+        self.shards = shards
+        if not 0 <= self.shard < self.shards:
+            raise ValueError("shard %d is not between 0 and %d" % (self.shard, self.shards - 1))
+        self.es_index_markers = "%s-shards" % self.es_index
+        #seconds to wait for the other shards before giving up
+        self.shard_timeout = shard_timeout
+
+        #order targets are dispatched in, either gene index order or heaviest first
+        self.schedule = schedule
+        self.split_evidence = split_evidence
+        if self.schedule == 'cost' and self.evidence_reader == 'sliced':
+            self.logger.info("the sliced evidence reader dispatches targets as they are read")
+
+        #alternative scoring weights, each scored into its own index
+        #from the same evidence as the main index
+        self.weightings = [(self.es_index, self.scoring_weights)]
+        if weightings:
+            with URLZSource(weightings).open() as weightings_file:
+                alternatives = yaml.safe_load(weightings_file)
+            for name in sorted(alternatives):
+                self.weightings.append(("%s-%s" % (self.es_index, name), alternatives[name] or {}))
+            if self.pipeline != 'fused':
+                #only whole targets can be scored several times from one load
+                self.logger.info("alternative weightings use the fused pipeline")
+                self.pipeline = 'fused'
+
+        #per (target, disease, datasource) partial aggregates, stored by full runs
+        #and used to rebuild the associations of targets of changed datasources
+        self.partials = partials
+        self.partial_datasources = partial_datasources or []
+        if self.partial_datasources:
+            if not self.partials:
+                raise ValueError("rebuilding datasources needs partial aggregates")
+            if self.shards > 1 or self.incremental:
+                raise ValueError("rebuilding datasources is not sharded nor incremental")
+            for datasource in self.partial_datasources:
+                if datasource not in self.datasources_to_datatypes:
+                    raise ValueError("unknown datasource %s to rebuild" % datasource)
+            if self.pipeline != 'fused':
+                self.logger.info("rebuilding datasources uses the fused pipeline")
+                self.pipeline = 'fused'
+        elif self.partials and self.shards > 1:
+            #each shard would store only its own targets
+            raise ValueError("partial aggregates are not sharded")
+        elif self.partials and self.evidence_reader != 'sliced':
+            #partials need all the evidence of a target in one place
+            self.logger.info("partial aggregates use the sliced evidence reader")
+            self.evidence_reader = 'sliced'
+
+        #files can only replace the indexes, these change them in place
+        if self.es_folder and (self.incremental or self.shards > 1 or self.partial_datasources):
+            raise ValueError("writing to files is not incremental, sharded nor rebuilding datasources")
+        #the other shards would write to the index behind the alias, not the new one
+        if self.shards > 1 and (self.es_bulk or {}).get("alias"):
+            raise ValueError("sharded scoring is unable to build behind an alias")
 
     def get_targets(self, es):
-        for target in Search().using(es).index(self.es_index_gene).query(MatchAll()).params(scroll = '4h').scan():
-            yield str(target.meta.id)
+        for target in Search().using(es).index(self.es_index_gene).query(MatchAll()).source(False).params(scroll = '4h').scan():
+            target = str(target.meta.id)
+            if self.in_shard(target):
+                yield target
+
+    def in_shard(self, target):
+        return self.shards == 1 or target_shard(target, self.shards) == self.shard
+
+    def get_scheduled_targets(self, es):
+        """
+        Yields the known targets with evidence, most evidence first so the 
+        biggest ones do not start last and keep a single worker busy at the end.
+
+        Targets with more than split_evidence evidence are split into parts by
+        disease ranges. Each part only groups the pairs of its diseases, so the
+        pairs of a target are complete within one part.
+        """
+        targets = list(self.get_targets(es))
+        counts = dict(get_evidence_counts(es, self.es_index_val_right, 'target.id'))
+
+        tasks = []
+        for target in targets:
+            count = counts.get(target, 0)
+            if not count:
+                continue
+            if self.split_evidence and count > self.split_evidence:
+                parts = int(math.ceil(float(count) / self.split_evidence))
+                disease_counts = list(get_evidence_counts(es, self.es_index_val_right,
+                    'private.efo_codes', query={'term': {'target.id': target}}))
+                ranges = split_disease_ranges(disease_counts, parts)
+                total = float(sum(size for _, size in ranges)) or 1.
+                for diseases, size in ranges:
+                    tasks.append((count * size / total, (target, diseases)))
+            else:
+                tasks.append((count, target))
+        tasks.sort(key=lambda task: task[0], reverse=True)
+
+        workers = self.workers_score if self.pipeline == 'fused' else self.workers_production
+        unscheduled = estimate_makespan([counts.get(t, 0) for t in targets], workers)
+        scheduled = estimate_makespan([cost for cost, _ in tasks], workers)
+        self.logger.info("scheduled %d tasks for %d targets, estimated makespan %d evidence "
+            "instead of %d in gene index order (%.0f%% shorter)", 
+            len(tasks), len(targets), scheduled, unscheduled,
+            100. * (unscheduled - scheduled) / unscheduled if unscheduled else 0.)
+
+        for _, task in tasks:
+            yield task
+
+    def get_partials_configuration(self):
+        """
+        Digest of the settings the partial aggregates depend on, weights are 
+        applied when scoring them so they are not part of it
+        """
+        configuration = {
+            'is_direct_do_not_propagate': sorted(self.is_direct_do_not_propagate),
+            'datasources_to_datatypes': self.datasources_to_datatypes,
+        }
+        return hashlib.md5(json.dumps(configuration, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_stored_evidence_batches(self, batches, store):
+        """
+        Stores the partial aggregates of each (target, [evidence...]) batch while
+        passing the batches on
+        """
+        for target, evidence in batches:
+            store.put(get_partials(group_evidence(evidence, {}, 
+                self.is_direct_do_not_propagate, self.datasources_to_datatypes)))
+            yield target, evidence
+
+    def rebuild_datasources(self, es, dry_run):
+        """
+        Replace the stored partial aggregates of the datasources to rebuild with 
+        ones from their current evidence, then rebuild all the associations of 
+        the targets that had or have evidence from them from the stored partials
+        """
+        store = PartialAggregateStore(self.partials)
+        if store.get_meta('configuration') != self.get_partials_configuration():
+            raise RuntimeError("partial aggregates in %s are incomplete or for other settings, "
+                "a complete --as run with them is needed first" % self.partials)
+        datasources = self.partial_datasources
+
+        targets = store.get_targets(datasources)
+        known = set(self.get_targets(es))
+        self.logger.info('replacing partial aggregates of %s', ", ".join(datasources))
+        #mark the store incomplete until the datasources have been replaced
+        store.set_meta('configuration', None)
+        store.delete_datasources(datasources)
+        for target, evidence in get_evidence_by_target(es, self.es_index_val_right,
+                self.evidence_slices, self.queue_evidence, datasources):
+            if target not in known:
+                continue
+            targets.add(target)
+            store.put(get_partials(group_evidence(evidence, {}, 
+                self.is_direct_do_not_propagate, self.datasources_to_datatypes)))
+        store.commit()
+        store.set_meta('configuration', self.get_partials_configuration())
+        store.close()
+
+        targets = sorted(targets)
+        self.logger.info('rebuilding associations of %d targets', len(targets))
+        rebuild_target_local_init_baked = functools.partial(rebuild_target_local_init,
+            self.partials, self.weightings, self.datasources_to_datatypes,
+            self.es_hosts, self.es_index_gene, self.es_index_hpa, self.es_index_efo,
+            self.cache_target, self.cache_hpa, self.cache_efo,
+            self.cache_target_fragment, self.cache_disease_fragment)
+        pipeline = pr.map(rebuild_target, targets, 
+            workers=self.workers_score,
+            maxsize=self.queue_score,
+            on_start=rebuild_target_local_init_baked)
 
-    def process_all(self, dry_run):
+        with URLZSource(self.es_mappings).open() as mappings_file:
+            mappings = json.load(mappings_file)
+        with URLZSource(self.es_settings).open() as settings_file:
+            settings = json.load(settings_file)
 
-        # do not pass this es object to other processess, single process only!
-        es = new_es_client(self.es_hosts)
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with contextlib.ExitStack() as indexes:
+            for es_index, _ in self.weightings:
+                indexes.enter_context(sink.index(es_index, 
+                    settings, mappings, append_data=True))
+            #remove pairs that no longer have evidence
+            self.delete_associations(es, targets, dry_run)
+            self.write_associations(sink, pipeline, dry_run)
 
-        targets = self.get_targets(es)
+        self.logger.info("DONE")
 
-        self.logger.info('setting up stages')
+    def get_evidence_batches(self, es):
+        """
+        Yields (target, [evidence...]) for each known target with evidence, reading 
+        the evidence index in a single sliced pass. Targets without evidence never
+        show up so they cost nothing.
+        """
+        targets = set(self.get_targets(es))
+        self.logger.info('reading evidence for %d targets with %d slices', 
+            len(targets), self.evidence_slices)
+
+        batch_count = 0
+        unknown_count = 0
+        for target, evidence in get_evidence_by_target(es, self.es_index_val_right,
+                self.evidence_slices, self.queue_evidence):
+            if not self.in_shard(target):
+                continue
+            if target not in targets:
+                unknown_count += 1
+                continue
+            batch_count += 1
+            yield target, evidence
+
+        self.logger.info('read evidence for %d targets, skipped %d unknown targets', 
+            batch_count, unknown_count)
+
+    def get_lookup_fingerprint(self, es, index):
+        """
+        The concrete indexes behind the name of a lookup index, each with its
+        uuid and creation date, which change whenever a stage reloads it
+        """
+        settings = es.indices.get_settings(index=index, name='index.uuid,index.creation_date')
+        return sorted([name, settings[name]['settings']['index']['uuid'],
+            settings[name]['settings']['index']['creation_date']] for name in settings)
+
+    def get_configuration_digest(self, es):
+        """
+        Digest of the settings and lookup indexes that change every association,
+        so an incremental run against a manifest with a different one rescores
+        everything
+        """
+        lookups = dict((index, self.get_lookup_fingerprint(es, index)) for index in 
+            (self.es_index_gene, self.es_index_hpa, self.es_index_efo))
+        self.logger.info("lookup indexes are %s", ", ".join("%s in %s" % (index, 
+            ", ".join("%s (%s)" % (name, index_uuid) for name, index_uuid, _ in lookups[index])) 
+                for index in sorted(lookups)))
+        configuration = {
+            'lookups': lookups,
+            'scoring_weights': self.scoring_weights,
+            'weightings': self.weightings,
+            'is_direct_do_not_propagate': sorted(self.is_direct_do_not_propagate),
+            'datasources_to_datatypes': self.datasources_to_datatypes,
+            'es_index_gene': self.es_index_gene,
+            'es_index_hpa': self.es_index_hpa,
+            'es_index_efo': self.es_index_efo,
+        }
+        return hashlib.md5(json.dumps(configuration, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_digested_evidence_batches(self, es, batches, previous, digests, dry_run,
+            delete_targets=1000, delete_evidence=100000):
+        """
+        Records the digest of each (target, [evidence...]) batch into digests and
+        yields only the batches that differ from the previous digests.
+
+        Changed targets are buffered so their previous associations can be deleted
+        in one request before they are scored again, which removes the pairs that
+        no longer have evidence. Targets that lost all their evidence are deleted
+        at the end.
+        """
+        pending = []
+        pending_evidence = 0
+        unchanged_count = 0
+        changed_count = 0
+        for target, evidence in batches:
+            digest = evidence_digest(evidence)
+            digests[target] = digest
+            if previous.get(target) == digest:
+                unchanged_count += 1
+                continue
+
+            changed_count += 1
+            pending.append((target, evidence))
+            pending_evidence += len(evidence)
+            if len(pending) >= delete_targets or pending_evidence >= delete_evidence:
+                self.delete_associations(es, [t for t, _ in pending if t in previous], dry_run)
+                for batch in pending:
+                    yield batch
+                pending = []
+                pending_evidence = 0
+
+        self.delete_associations(es, [t for t, _ in pending if t in previous], dry_run)
+        for batch in pending:
+            yield batch
+
+        removed = [t for t in previous if t not in digests]
+        self.delete_associations(es, removed, dry_run)
+
+        self.logger.info('incremental scoring of %d changed targets, skipped %d unchanged, removed %d',
+            changed_count, unchanged_count, len(removed))
+
+    def delete_associations(self, es, targets, dry_run, chunk_size=1000):
+        """Delete all the associations of the given targets, for all the weightings"""
+        if dry_run:
+            return
+        for i in range(0, len(targets), chunk_size):
+            es.delete_by_query(index=[index for index, _ in self.weightings], conflicts='proceed',
+                body={'query': {'terms': {'target.id': targets[i:i+chunk_size]}}})
+
+    def staged_pipeline(self, produce_input, dry_run):
+        """
+        Producers group the evidence into target/disease pairs, which are
+        sent to separate scoring processes. Yields (id, json) per association
+        """
 
         #bake the arguments for the setup into function objects
-        produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
-            self.es_hosts, self.es_index_val_right,
-            self.scoring_weights, self.is_direct_do_not_propagate, 
-            self.datasources_to_datatypes)
+        if self.evidence_reader == 'sliced':
+            produce_function = produce_evidence_batch
+            produce_evidence_local_init_baked = functools.partial(produce_evidence_batch_local_init, 
+                self.scoring_weights, self.is_direct_do_not_propagate, 
+                self.datasources_to_datatypes)
+        else:
+            produce_function = produce_evidence
+            produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
+                self.es_hosts, self.es_index_val_right,
+                self.scoring_weights, self.is_direct_do_not_propagate, 
+                self.datasources_to_datatypes)
         score_producer_local_init_baked = functools.partial(score_producer_local_init,
             self.datasources_to_datatypes, dry_run, self.es_hosts,
             self.es_index_gene, self.es_index_hpa, self.es_index_efo,
-            self.cache_target, self.cache_hpa, self.cache_efo)
+            self.cache_target, self.cache_hpa, self.cache_efo,
+            self.cache_target_fragment, self.cache_disease_fragment)
         
         #pipeline stage for making the lists of the target/disease pairs and evidence
-        pipeline_stage1 = pr.flat_map(produce_evidence, targets, 
+        pipeline_stage1 = pr.flat_map(produce_function, produce_input, 
             workers=self.workers_production,
             maxsize=self.queue_produce,
             on_start=produce_evidence_local_init_baked)
@@ -494,40 +1655,219 @@ class ScoringProcess(object):
             maxsize=self.queue_score,
             on_start=score_producer_local_init_baked)
 
+        return pipeline_stage2
+
+    def fused_pipeline(self, produce_input):
+        """
+        Each scoring process handles whole targets, from reading the evidence to
+        serializing the associations. Yields (number of associations, NDJSON bytes)
+        per target
+        """
+        score_target_local_init_baked = functools.partial(score_target_local_init,
+            self.evidence_reader, self.es_hosts, self.es_index_val_right,
+            self.weightings, self.is_direct_do_not_propagate, 
+            self.datasources_to_datatypes,
+            self.es_index_gene, self.es_index_hpa, self.es_index_efo,
+            self.cache_target, self.cache_hpa, self.cache_efo,
+            self.cache_target_fragment, self.cache_disease_fragment)
+
+        return pr.map(score_target, produce_input, 
+            workers=self.workers_score,
+            maxsize=self.queue_score,
+            on_start=score_target_local_init_baked)
+
+    def process_all(self, dry_run):
+
+        # do not pass this es object to other processess, single process only!
+        es = new_es_client(self.es_hosts)
+
+        if self.partial_datasources:
+            return self.rebuild_datasources(es, dry_run)
+
+        self.logger.info('setting up stages')
+
+        #only the manifest needs it
+        configuration = None
+        if self.manifest:
+            configuration = self.get_configuration_digest(es)
+        previous = {}
+        digests = {}
+        incremental = False
+        if self.incremental:
+            previous_configuration, previous = load_manifest(self.manifest)
+            if previous_configuration != configuration:
+                self.logger.warning("manifest %s is missing or for other settings, scoring everything",
+                    self.manifest)
+                previous = {}
+            else:
+                incremental = True
+
+        run = None
+        if self.shards > 1 and self.shard > 0:
+            run, incremental = self.join_run(es, incremental, configuration)
+            if not incremental:
+                previous = {}
+
+        if self.evidence_reader == 'sliced':
+            produce_input = self.get_evidence_batches(es)
+            if self.partials:
+                #all the targets, including the ones an incremental run skips
+                store = PartialAggregateStore(self.partials)
+                store.clear()
+                produce_input = self.get_stored_evidence_batches(produce_input, store)
+            if self.manifest:
+                produce_input = self.get_digested_evidence_batches(es, produce_input, 
+                    previous, digests, dry_run)
+        elif self.schedule == 'cost':
+            produce_input = self.get_scheduled_targets(es)
+        else:
+            produce_input = self.get_targets(es)
+
+        if self.pipeline == 'fused':
+            pipeline = self.fused_pipeline(produce_input)
+        else:
+            pipeline = self.staged_pipeline(produce_input, dry_run)
+
         with URLZSource(self.es_mappings).open() as mappings_file:
             mappings = json.load(mappings_file)
 
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
-            #load into elasticsearch
-            self.logger.info('stages created, running scoring and writing')
-            client = es
-            chunk_size = 1000 #TODO make configurable
-            actions = self.elasticsearch_actions(pipeline_stage2, self.es_index)
-            failcount = 0
-
-            if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    self.logger.debug("Using parallel bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.parallel_bulk(client, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    self.logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(client, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
 
-                if failcount:
-                    raise RuntimeError("%s relations failed to index" % failcount)
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        if self.shards > 1 and self.shard > 0:
+            #the index is created and finalized by the first shard only
+            self.write_associations(sink, pipeline, dry_run)
+            if (self.get_marker(es, 'created') or {}).get('run') != run:
+                raise RuntimeError("shard %d wrote into an index another run has replaced, "
+                    "it has to be scored again" % self.shard)
+            self.set_marker(es, 'done-%d' % self.shard, run)
+        else:
+            if self.shards > 1:
+                #markers of runs that were killed before clearing them
+                self.clear_markers(es)
+                run = uuid.uuid4().hex
+            try:
+                with contextlib.ExitStack() as indexes:
+                    #one index per weighting, the first is the main one
+                    #incremental runs update the existing indexes instead of replacing them
+                    for es_index, _ in self.weightings:
+                        indexes.enter_context(sink.index(es_index, 
+                            settings, mappings, append_data=incremental))
+                    if self.shards > 1:
+                        #the other shards follow whether this one is incremental
+                        self.set_marker(es, 'created', run, 
+                            {'incremental': incremental, 'configuration': configuration})
+                    self.write_associations(sink, pipeline, dry_run)
+                    if self.shards > 1:
+                        #finalize only once all the other shards have written for this run
+                        self.wait_for_markers(es, 
+                            ['done-%d' % i for i in range(1, self.shards)], run)
+            finally:
+                if self.shards > 1:
+                    self.clear_markers(es)
+
+        #the partials are only complete once everything has been written
+        if self.partials:
+            store.commit()
+            store.set_meta('configuration', self.get_partials_configuration())
+            store.close()
+
+        #only record the digests once everything has been written
+        if self.manifest and not dry_run:
+            save_manifest(self.manifest, configuration, digests)
+            self.logger.info("wrote digests of %d targets to %s", len(digests), self.manifest)
 
         self.logger.info("DONE")
 
+    def write_associations(self, sink, pipeline, dry_run):
+        #load into elasticsearch, or files of it
+        self.logger.info('stages created, running scoring and writing')
+        failcount = 0
+        count = 0
+        start_time = time.time()
+
+        if not dry_run:
+            results = None
+            if self.pipeline == 'fused':
+                self.logger.debug("Using NDJSON bulk writer for Elasticearch")
+                results = sink.bulk_ndjson(pipeline, 
+                        thread_count=self.workers_write,
+                        queue_size=self.queue_write)
+            else:
+                actions = self.elasticsearch_actions(pipeline, self.es_index)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
+            for success, details in results:
+                count += 1
+                if not success:
+                    failcount += 1
+
+            if failcount:
+                raise RuntimeError("%s relations failed to index" % failcount)
+
+        elapsed = time.time() - start_time
+        self.logger.info("%s pipeline wrote %d associations in %.0fs (%.1f/s)",
+            self.pipeline, count, elapsed, count / elapsed if elapsed else 0.)
+
+    def join_run(self, es, incremental, configuration):
+        """
+        Wait for the first shard to create the index and follow whether it
+        updates it incrementally. Returns the run and whether this shard is
+        incremental, and raises RuntimeError if this shard is unable to be
+        """
+        created = self.wait_for_markers(es, ['created'])
+        if created.get('incremental'):
+            if not incremental or created.get('configuration') != configuration:
+                raise RuntimeError("shard 0 updates the index incrementally but the manifest "
+                    "%s of shard %d is missing or for other settings" % (self.manifest, self.shard))
+        elif incremental:
+            self.logger.warning("shard 0 replaces the index, scoring everything")
+            incremental = False
+        return created['run'], incremental
+
+    def set_marker(self, es, marker, run, details=None):
+        """Record a step of this shard in the run for the other shards to see"""
+        body = {'shard': self.shard, 'shards': self.shards, 'run': run, 'time': time.time()}
+        body.update(details or {})
+        es.index(index=self.es_index_markers, id=marker, refresh=True, body=body)
+
+    def get_marker(self, es, marker):
+        """The body of a marker, or None if it is not there"""
+        document = es.get(index=self.es_index_markers, id=marker, ignore=[404])
+        if not document.get('found'):
+            return None
+        return document['_source']
+
+    def wait_for_markers(self, es, markers, run=None, interval=30):
+        """
+        Wait until the other shards have recorded all the given markers, in the
+        given run if any. Returns the body of the last one, and raises
+        RuntimeError if they are not all there after the shard timeout
+        """
+        start = time.time()
+        pending = list(markers)
+        found = None
+        while True:
+            waiting = []
+            for marker in pending:
+                body = self.get_marker(es, marker)
+                if body is None or (run is not None and body.get('run') != run):
+                    waiting.append(marker)
+                else:
+                    found = body
+            pending = waiting
+            if not pending:
+                return found
+            if time.time() - start > self.shard_timeout:
+                raise RuntimeError("shard %d gave up waiting for %s after %ds" % (
+                    self.shard, ", ".join(pending), self.shard_timeout))
+            self.logger.info("shard %d waiting for %s", self.shard, ", ".join(pending))
+            time.sleep(interval)
+
+    def clear_markers(self, es):
+        """Remove the markers of a previous run"""
+        es.indices.delete(index=self.es_index_markers, ignore=[404])
+
     """
     Generates elasticsearch action objects from the results iterator
 
@@ -24,7 +24,7 @@ from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer, _document_frequency
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 from mrtarget.common.DataStructure import SparseFloatDict
 
 class RelationType(object):
@@ -157,24 +157,15 @@ class OverlapDistance(object):
 Consumes the iterable passed in and loads into into provided loader
 whilst also respecting the dry run flag given
 
-Uses elasticsearch.helpers.parallel_bulk with multiple threads for high
-performance loading
+Uses the bulk sink with multiple threads for high performance loading,
+into elasticsearch or files
 """
-def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, index):
-    chunk_size = 1000 #TODO make configurable
+def store_in_elasticsearch(results, sink, dry_run, workers_write, queue_write, index):
     actions = elasticsearch_actions(results, dry_run, index)
     failcount = 0
 
     if not dry_run:
-        results = None
-        if workers_write > 0:
-            results = elasticsearch.helpers.parallel_bulk(es, actions,
-                    thread_count=workers_write,
-                    queue_size=queue_write, 
-                    chunk_size=chunk_size)
-        else:
-            results = elasticsearch.helpers.streaming_bulk(es, actions,
-                    chunk_size=chunk_size)
+        results = sink.bulk(actions, workers_write, queue_write)
         for success, details in results:
             if not success:
                 failcount += 1
@@ -322,7 +313,7 @@ spawns multiple processess as needed
 used to standardize d2d and t2t code path
 """
 def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids, 
-        threshold, buckets_number, es, dry_run, 
+        threshold, buckets_number, sink, dry_run, 
         workers_production, workers_score, workers_write,
         queue_production_score, queue_score_result, queue_write, index):
 
@@ -371,7 +362,7 @@ def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids,
 
     #store in elasticsearch
     #this could be multi process, but just use a single for now
-    store_in_elasticsearch(pipeline_stage, es, dry_run, workers_write, queue_write,
+    store_in_elasticsearch(pipeline_stage, sink, dry_run, workers_write, queue_write,
         index)
 
 """
@@ -441,11 +432,13 @@ class DataDrivenRelationProcess(object):
             ddr_queue_score_result,
             ddr_queue_write,
             score_threshold,
-            evidence_count):
+            evidence_count, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.es_index_efo = es_index_efo
         self.es_index_gen = es_index_gen
         self.es_index_assoc = es_index_assoc
@@ -489,12 +482,13 @@ class DataDrivenRelationProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
 
             #calculate and store disease-to-disease in multiple processess
             self.logger.info('handling disease-to-disease')
             handle_pairs(RelationType.SHARED_TARGET, disease_labels, disease_data, disease_keys, 
-                target_keys, 0.19, 1024, es, dry_run, 
+                target_keys, 0.19, 1024, sink, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
                 self.es_index)
@@ -503,7 +497,7 @@ class DataDrivenRelationProcess(object):
             #calculate and store target-to-target in multiple processess
             self.logger.info('handling target-to-target')
             handle_pairs(RelationType.SHARED_DISEASE, target_labels, target_data, target_keys, 
-                disease_keys, 0.19, 1024, es, dry_run, 
+                disease_keys, 0.19, 1024, sink, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
                 self.es_index)
@@ -5,12 +5,11 @@ from builtins import object
 import logging
 
 import simplejson as json
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
 from opentargets_urlzsource import URLZSource
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 from mrtarget.common.connection import new_es_client
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
 
@@ -76,11 +75,13 @@ class DrugProcess(object):
                  chembl_molecule_uris,
                  chembl_indication_uris,
                  adverse_events_uris,
-                 drugbank_uris):
+                 drugbank_uris, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.es_index_gene = es_index_gene
         self.es_index_efo = es_index_efo
         self.workers_write = workers_write
@@ -1063,21 +1064,13 @@ class DrugProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
             # write into elasticsearch
-            chunk_size = 1000  # TODO make configurable
             actions = elasticsearch_actions(list(data.items()), self.es_index)
             failcount = 0
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                                                                  thread_count=self.workers_write,
-                                                                  queue_size=self.queue_write,
-                                                                  chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                                                                   chunk_size=chunk_size)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
                 for success, details in results:
                     if not success:
                         failcount += 1
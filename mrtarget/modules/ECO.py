@@ -8,10 +8,9 @@ from mrtarget.common.LookupTables import ECOLookUpTable
 from mrtarget.common.DataStructure import JSONSerializable
 from opentargets_ontologyutils.rdf_utils import OntologyClassReader
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 import opentargets_ontologyutils.eco_so
 import logging
-import elasticsearch
 import simplejson as json
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
@@ -64,11 +63,13 @@ def elasticsearch_actions(items, index):
 class EcoProcess(object):
 
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
-            eco_uri, so_uri, workers_write, queue_write):
+            eco_uri, so_uri, workers_write, queue_write, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.eco_uri = eco_uri
         self.so_uri = so_uri
         self.workers_write = workers_write
@@ -104,23 +105,15 @@ class EcoProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             actions = elasticsearch_actions(list(self.ecos.items()), self.es_index)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
                 for success, details in results:
                     if not success:
                         failcount += 1
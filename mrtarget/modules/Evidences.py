@@ -1,38 +1,139 @@
 from builtins import str
+import bisect
+import collections
 import hashlib
 import logging
 import os
+import re
+import sqlite3
+import time
 import simplejson as json
 import pypeln.process as pr
-import addict
 import codecs
 import functools
 import itertools
 
-import elasticsearch
 
 import opentargets_validator.helpers
+import mrtarget
 import mrtarget.common.IO as IO
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.dedup import DuplicateFilter
+from mrtarget.common.esutil import new_bulk_sink
 from mrtarget.common.EvidenceString import EvidenceManager, Evidence
+from mrtarget.common.hashing import CanonicalHasher
+from mrtarget.common.validation import CompiledValidator
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
+from mrtarget.common.LookupTables import EFOLookUpTable, GeneLookUpTable
 from opentargets_urlzsource import URLZSource
 
+#keys and values of the fields checked by prefilter_evidence. The id of an object is
+#only taken when all of the members before it have plain string values, so it is
+#known to be a member of that object and not of one nested in it
+_PREFILTER_KEY = re.compile(r'\s*:\s*(\{?)')
+_PREFILTER_SOURCE_ID = re.compile(r'\s*:\s*"([^"\\]*)"')
+_PREFILTER_OBJECT_ID = re.compile(r'\s*(?:"(?!id")[^"\\]*"\s*:\s*"[^"\\]*"\s*,\s*)*"id"\s*:\s*"([^"\\]*)"')
+
+
+def _find_prefilter_fields(line):
+    """the sourceID, target.id and disease.id of the line, when their key occurs
+    once, as the key of an object for target and disease"""
+    fields = {}
+    for field, is_object in (('sourceID', False), ('target', True), ('disease', True)):
+        key = '"%s"' % field
+        value = None
+        found = False
+        start = line.find(key)
+        while start >= 0:
+            end = start + len(key)
+            match = _PREFILTER_KEY.match(line, end)
+            if match is not None and (match.group(1) or not is_object):
+                if found:
+                    value = None
+                    break
+                found = True
+                if is_object:
+                    value = _PREFILTER_OBJECT_ID.match(line, match.end())
+                else:
+                    value = _PREFILTER_SOURCE_ID.match(line, end)
+            start = line.find(key, end)
+        if value is not None:
+            fields[field] = value.group(1)
+    return fields
+
+
+def prefilter_evidence(line, luts, datasources_to_datatypes):
+    """
+    Check the sourceID, target.id and disease.id of an unparsed line, returning
+    the fields of the faulty line as validate_evidence would for an unsupported
+    datasource or an unknown target or disease, or None if they may be valid.
+
+    Values are only taken when their key occurs once in the line and they have no
+    escapes, so an evidence that would be valid is never rejected. A line that is
+    also faulty in other ways is explained by these instead of what fully
+    validating it would have found first
+    """
+    fields = _find_prefilter_fields(line)
+    data_source = fields.get('sourceID')
+    if data_source is None:
+        return None
+    if data_source not in datasources_to_datatypes:
+        return dict(data_source=data_source, explanation_type='unsupported_datasource',
+            explanation_str=data_source)
+
+    rejected = dict(data_source=data_source)
+    disease_failed = False
+    target_failed = False
+
+    efo_id = fields.get('disease')
+    if efo_id:
+        rejected['efo_id'] = efo_id
+        short_efo_id = luts.available_efos.get_ontology_code_from_url(efo_id) if '/' in efo_id else efo_id
+        if short_efo_id not in luts.available_efos:
+            rejected.update(explanation_type='invalid_disease', explanation_str=efo_id)
+            disease_failed = True
+
+    target_id = fields.get('target')
+    if target_id:
+        rejected['target_id'] = target_id
+        if 'ensembl' in target_id:
+            ensembl_id = target_id.split('/')[-1]
+            if ensembl_id not in luts.available_genes:
+                rejected.update(explanation_type='invalid_target', explanation_str=ensembl_id)
+                target_failed = True
+        elif 'uniprot' in target_id:
+            uniprot_id = target_id.split('/')[-1]
+            try:
+                if luts.available_genes.get_uniprot2ensembl(uniprot_id) is None:
+                    rejected.update(explanation_type='unknown_uniprot_entry', explanation_str=uniprot_id)
+                    target_failed = True
+            except ValueError:
+                #ambiguous, left to the full validation
+                pass
+
+    if target_failed and disease_failed:
+        rejected.update(explanation_type='target_id_and_disease_id', explanation_str='')
+
+    return rejected if target_failed or disease_failed else None
+
+
 def make_validated_evs_obj(filename, hash, line, line_n, is_valid=False, explanation_type='', explanation_str='',
                            target_id=None, efo_id=None, data_type=None, id=None):
-    return addict.Dict(is_valid=is_valid, explanation_type=explanation_type, explanation_str=explanation_str,
-                       target_id=target_id, efo_id=efo_id, data_type=data_type, id=id, line=line, line_n=line_n,
-                       filename=filename, hash=hash)
+    return dict(is_valid=is_valid, explanation_type=explanation_type, explanation_str=explanation_str,
+                target_id=target_id, efo_id=efo_id, data_type=data_type, id=id, line=line, line_n=line_n,
+                filename=filename, hash=hash)
+
 
+def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_manager, timer=None):
+    """take the parsed evidence of the line, convert into an evidence object and apply
+    a list of modifiers: fix_evidence, and if valid then score_evidence, extend data
+    and inject loci. The evidence is only serialized once it is done with
 
-def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_manager):
-    """take line as a dict, convert into an evidence object and apply a list of modifiers:
-    fix_evidence, and if valid then score_evidence, extend data and inject loci
+    With a PhaseTimer the time is split in 'fix_score' and 'extend'
     """
     left, right = None, None
-    ev = Evidence(validated_evs.line, datasources_to_datatypes)
+    ev = Evidence(validated_evs['line'], datasources_to_datatypes)
 
     (fixed_ev, _) = evidence_manager.fix_evidence(ev)
 
@@ -41,37 +142,468 @@ def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_man
     if is_valid:
         # add scoring to evidence string
         fixed_ev.score_evidence()
+        if timer is not None:
+            timer.mark('fix_score')
 
         # extend data in evidencestring
         fixed_ev_ext = evidence_manager.get_extended_evidence(fixed_ev)
 
-        validated_evs.is_valid = True
-        validated_evs.line = fixed_ev_ext.to_json()
+        validated_evs['is_valid'] = True
+        validated_evs['target_id'] = fixed_ev_ext.evidence['target']['id']
+        validated_evs['line'] = fixed_ev_ext.to_json()
         right = validated_evs
+        if timer is not None:
+            timer.mark('extend')
 
     else:
-        validated_evs.explanation_type = 'invalid_fixed_evidence'
-        validated_evs.explanation_str = problem_str
-        validated_evs.is_valid = False
+        validated_evs['explanation_type'] = 'invalid_fixed_evidence'
+        validated_evs['explanation_str'] = problem_str
+        validated_evs['is_valid'] = False
+        validated_evs['line'] = json.dumps(fixed_ev.evidence)
         left = validated_evs
+        if timer is not None:
+            timer.mark('fix_score')
 
     # return either left or right
     return left, right
 
 
-def process_evidence(line, logger, validator, luts, datasources_to_datatypes, evidence_manager):
+def process_evidence(line, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        hasher=CanonicalHasher(), stats=None, prefilter=False):
+    timer = PhaseTimer() if stats is not None else None
+
     # validate evidence
-    (left, right) = validate_evidence(line, logger, validator, luts, datasources_to_datatypes)
+    (left, right) = validate_evidence(line, logger, validator, luts, datasources_to_datatypes, hasher,
+        timer, prefilter)
+    if timer is not None:
+        timer.mark('lookups')
 
     # fix evidence 
     if right is not None:
-        # ev comes as addict.Dict
-        # too much code at the moment to move evidences to addict
-        (left, right) = fix_and_score_evidence(right, datasources_to_datatypes, evidence_manager)
+        # line of a valid evidence is still the parsed evidence
+        (left, right) = fix_and_score_evidence(right, datasources_to_datatypes, evidence_manager,
+            timer)
+
+    # only faulty lines are stored by the hash of the whole line
+    if left is not None and left['id'] is None:
+        (filename, (line_n, l)) = line
+        left['id'] = hasher.hash_line(codecs.decode(l, 'utf-8', 'replace'))
+
+    if stats is not None:
+        (filename, (line_n, l)) = line
+        stats.add(left if left is not None else right, len(l), timer.seconds)
 
     return left, right
 
 
+def process_evidence_batch(batch, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        hasher, cache=None, index_valid=None, index_invalid=None, prefilter=False, route_by_target=False):
+    """process a list of lines in a validation process and return the list of
+    elasticsearch actions for them, in the same order as the lines
+
+    With a ValidationCache the actions of lines in it are taken from it instead.
+    Returns (actions, misses, hits, spans, stats) where misses are the (key, index
+    of the action) of the lines that were processed, for the cache to be updated
+    with, spans the (filename, first line number, last line number) of the batch
+    and stats the ValidationStats of the lines that were processed
+    """
+    actions = []
+    misses = []
+    hits = 0
+    spans = []
+    stats = ValidationStats()
+    for line in batch:
+        (filename, (line_n, l)) = line
+        if spans and spans[-1][0] == filename:
+            spans[-1] = (filename, spans[-1][1], line_n)
+        else:
+            spans.append((filename, line_n, line_n))
+
+        if cache is not None:
+            key = ValidationCache.get_key(l)
+            action = cache.get_action(key, filename, line_n, index_valid, index_invalid)
+            if action is not None:
+                actions.append(action)
+                hits += 1
+                continue
+
+        result = process_evidence(line, logger, validator, luts, datasources_to_datatypes,
+            evidence_manager, hasher, stats, prefilter)
+        for action in elasticsearch_actions([result], index_valid, index_invalid, route_by_target):
+            if cache is not None:
+                misses.append((key, len(actions)))
+            actions.append(action)
+
+    return actions, misses, hits, spans, stats
+
+
+class PhaseTimer(object):
+    """seconds spent in each phase of processing a line, up to each call to mark"""
+    def __init__(self):
+        self.seconds = {}
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + now - self.last
+        self.last = now
+
+
+class ValidationStats(object):
+    """
+    Counters and timings of the processed lines by datasource, and the number of
+    lines rejected by datasource and explanation type. Lines that are not json or
+    have no sourceID are under 'unknown'.
+
+    Each validation process keeps them for a batch, and they are merged in the
+    main process. Lines taken from a ValidationCache are not in them
+    """
+    PHASES = ('prefilter', 'parse', 'schema', 'lookups', 'fix_score', 'extend')
+    #upper bounds of the buckets of the histogram of seconds per line, and one more bucket
+    HISTOGRAM_BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+    def __init__(self):
+        self.datasources = {}
+        self.rejections = {}
+
+    def _get_datasource(self, datasource):
+        if datasource not in self.datasources:
+            self.datasources[datasource] = {'lines': 0, 'valid': 0, 'bytes': 0,
+                'seconds': dict((phase, 0.0) for phase in self.PHASES),
+                'histogram': [0] * (len(self.HISTOGRAM_BOUNDS) + 1)}
+        return self.datasources[datasource]
+
+    def add(self, validated_evs, line_bytes, seconds):
+        """count a line from its left or right of process_evidence"""
+        datasource = (validated_evs or {}).get('data_source') or 'unknown'
+        counters = self._get_datasource(datasource)
+        counters['lines'] += 1
+        counters['bytes'] += line_bytes
+        for phase, phase_seconds in seconds.items():
+            counters['seconds'][phase] += phase_seconds
+        counters['histogram'][bisect.bisect_left(self.HISTOGRAM_BOUNDS, sum(seconds.values()))] += 1
+        if validated_evs is not None and validated_evs['is_valid']:
+            counters['valid'] += 1
+        else:
+            key = (datasource, (validated_evs or {}).get('explanation_type') or 'unknown')
+            self.rejections[key] = self.rejections.get(key, 0) + 1
+
+    def merge(self, other):
+        for datasource, other_counters in other.datasources.items():
+            counters = self._get_datasource(datasource)
+            for counter in ('lines', 'valid', 'bytes'):
+                counters[counter] += other_counters[counter]
+            for phase, phase_seconds in other_counters['seconds'].items():
+                counters['seconds'][phase] += phase_seconds
+            counters['histogram'] = [a + b for a, b in zip(counters['histogram'], other_counters['histogram'])]
+        for key, count in other.rejections.items():
+            self.rejections[key] = self.rejections.get(key, 0) + count
+
+    def log(self, logger):
+        for datasource in sorted(self.datasources):
+            counters = self.datasources[datasource]
+            seconds = sum(counters['seconds'].values())
+            logger.info("validation of %s: %d lines, %d invalid, %.1f lines/s per worker, %s",
+                datasource, counters['lines'], counters['lines'] - counters['valid'],
+                counters['lines'] / seconds if seconds else 0.0,
+                ", ".join("%s %.0fs" % (phase, counters['seconds'][phase]) for phase in self.PHASES))
+        for (datasource, explanation_type), count in sorted(self.rejections.items()):
+            logger.info("validation of %s: %d lines rejected as %s", datasource, count, explanation_type)
+
+    def metrics(self):
+        """QC metrics, the histogram is the count of lines up to each bound in seconds"""
+        metrics = dict()
+        for datasource, counters in self.datasources.items():
+            prefix = "evidence.validation.%s." % datasource
+            seconds = sum(counters['seconds'].values())
+            metrics[prefix + "lines"] = counters['lines']
+            metrics[prefix + "valid"] = counters['valid']
+            metrics[prefix + "invalid"] = counters['lines'] - counters['valid']
+            metrics[prefix + "bytes"] = counters['bytes']
+            metrics[prefix + "lines_per_worker_second"] = counters['lines'] / seconds if seconds else 0.0
+            for phase in self.PHASES:
+                metrics[prefix + "seconds." + phase] = counters['seconds'][phase]
+            metrics[prefix + "histogram"] = tuple(counters['histogram'])
+        for (datasource, explanation_type), count in self.rejections.items():
+            metrics["evidence.rejected.%s.%s" % (datasource, explanation_type)] = count
+        return metrics
+
+
+def collect_validation_stats(results, stats, logger, log_seconds=600):
+    """
+    Pass on the batches from process_evidence_batch, merging their
+    ValidationStats into `stats` and logging them every `log_seconds`
+    """
+    logged = time.time()
+    for result in results:
+        stats.merge(result[4])
+        if time.time() - logged > log_seconds:
+            stats.log(logger)
+            logged = time.time()
+        yield result
+
+
+class ValidationCache(object):
+    """
+    Local SQLite file of the elasticsearch actions of validated lines, keyed by
+    a hash of the raw line, so lines that have not changed since a previous run
+    are not validated, fixed, scored and extended again.
+
+    Only the main process writes to it, validation processes open it read only.
+    It is only valid for the configuration digest in its meta table, see
+    get_validation_configuration
+    """
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        if read_only:
+            self.connection = sqlite3.connect("file:%s?mode=ro" % os.path.abspath(filename), uri=True)
+        else:
+            #written from the thread reading the validated batches
+            self.connection = sqlite3.connect(filename, check_same_thread=False)
+            #so validation processes can read while it is written
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS actions ("
+                "key TEXT PRIMARY KEY, is_valid INTEGER, id TEXT, source TEXT, routing TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(actions)")]
+            if "routing" not in columns:
+                #written before actions were routed, start again
+                self.connection.execute("DROP TABLE actions")
+                self.connection.execute("CREATE TABLE actions ("
+                    "key TEXT PRIMARY KEY, is_valid INTEGER, id TEXT, source TEXT, routing TEXT)")
+                self.connection.execute("DELETE FROM meta")
+            self.connection.commit()
+
+    @staticmethod
+    def get_key(line):
+        return hashlib.sha1(line).hexdigest()
+
+    def close(self):
+        self.connection.close()
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM actions")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def get_action(self, key, filename, line_n, index_valid, index_invalid):
+        row = self.connection.execute("SELECT is_valid, id, source, routing FROM actions WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        is_valid, _id, source, routing = row
+        if not is_valid:
+            #the same line may now be somewhere else
+            left = json.loads(source)
+            left['filename'] = filename
+            left['line_n'] = line_n
+            source = json.dumps(left)
+        action = {"_index": index_valid if is_valid else index_invalid, "_id": _id, "_source": source}
+        if routing is not None:
+            action["_routing"] = routing
+        return action
+
+    def put(self, key, action, index_valid):
+        source = action["_source"]
+        if not isinstance(source, str):
+            source = json.dumps(source)
+        self.connection.execute("INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?, ?)",
+            (key, int(action["_index"] == index_valid), action["_id"], source, action.get("_routing")))
+
+
+def get_validation_configuration(schema_uri, eco_scores_uri, excluded_biotypes,
+        datasources_to_datatypes, hash_algorithm, gene_universe, efo_universe, route_by_target=False):
+    """
+    Digest of everything but the line the indexed document of a line depends on,
+    the schema, eco scores, settings, version and the target and disease ids, so
+    a ValidationCache written with a different one is not used. The prefilter
+    does not change the documents, so caches are shared with and without it
+    """
+    with URLZSource(eco_scores_uri).open() as eco_scores_file:
+        eco_scores = eco_scores_file.read()
+    if not isinstance(eco_scores, bytes):
+        eco_scores = eco_scores.encode('utf-8')
+    gene_ids, uniprot2ensembl, uniprot_ambiguous = gene_universe
+    universes = hashlib.md5()
+    for ids in (sorted(gene_ids), sorted(uniprot2ensembl.items()), sorted(uniprot_ambiguous), sorted(efo_universe)):
+        universes.update(json.dumps(ids).encode('utf-8'))
+    configuration = {
+        'version': mrtarget.__version__,
+        'schema_uri': schema_uri,
+        'schema': opentargets_validator.helpers.generate_validator_from_schema(schema_uri).schema,
+        'eco_scores': hashlib.md5(eco_scores).hexdigest(),
+        'excluded_biotypes': sorted(excluded_biotypes),
+        'datasources_to_datatypes': datasources_to_datatypes,
+        'hash_algorithm': hash_algorithm,
+        #rejected lines used to be stored by a hash of the line as it is with the prefilter
+        'rejected_ids': 'canonical',
+        'route_by_target': route_by_target,
+        'universes': universes.hexdigest(),
+    }
+    return hashlib.md5(json.dumps(configuration, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_cached_actions(results, cache, index_valid, logger, log_lines=1000000, commit_actions=10000):
+    """
+    Yields the actions of the batches from process_evidence_batch, storing the
+    ones that were not in the cache, and logs how many lines were found in it
+    """
+    lines = 0
+    hits = 0
+    uncommitted = 0
+    for result in results:
+        actions, misses, batch_hits = result[:3]
+        for key, i in misses:
+            cache.put(key, actions[i], index_valid)
+        uncommitted += len(misses)
+        if cache is not None and uncommitted >= commit_actions:
+            cache.commit()
+            uncommitted = 0
+
+        previous_lines = lines
+        lines += len(actions)
+        hits += batch_hits
+        if cache is not None and lines // log_lines > previous_lines // log_lines:
+            logger.info("validation cache hits %d of %d lines (%.1f%%)", hits, lines, 100.0 * hits / lines)
+
+        for action in actions:
+            yield action
+
+    if cache is not None:
+        cache.commit()
+        if lines:
+            logger.info("validation cache hits %d of %d lines (%.1f%%)", hits, lines, 100.0 * hits / lines)
+
+
+class ValidationCheckpoint(object):
+    """
+    Durable record of the lines of each evidence file that are in the indexes,
+    as sorted lists of [first, last] line numbers, so a run that died partway
+    through can be resumed without validating and indexing them again.
+
+    Batches are tracked as their actions are sent, and their lines recorded once
+    elasticsearch has acknowledged all of their actions, which it does in the
+    order they were sent. The file is only replaced once it has been completely
+    written, and only after the indexes have been flushed, as they are loaded
+    with an asynchronous translog
+    """
+    def __init__(self, filename, configuration):
+        self.filename = filename
+        self.configuration = configuration
+        self.lines = {}
+        #(number of actions sent up to the end of the batch, spans of the batch)
+        self.pending = collections.deque()
+        self.sent = 0
+
+    def load(self):
+        """read the lines of a previous run with the same configuration"""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint['configuration'] != self.configuration:
+            raise RuntimeError('checkpoint %s is for another configuration, unable to resume from it'
+                % self.filename)
+        self.lines = checkpoint['lines']
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as checkpoint_file:
+            json.dump({'configuration': self.configuration, 'lines': self.lines}, checkpoint_file)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def contains(self, filename, line_n):
+        intervals = self.lines.get(filename, [])
+        i = bisect.bisect_right(intervals, [line_n, float('inf')]) - 1
+        return i >= 0 and intervals[i][1] >= line_n
+
+    def count(self):
+        return sum(last - first + 1 for intervals in self.lines.values() for first, last in intervals)
+
+    def add(self, filename, first, last):
+        intervals = self.lines.setdefault(filename, [])
+        i = bisect.bisect_left(intervals, [first, last])
+        intervals.insert(i, [first, last])
+        #merge with the ones before and after it that touch it
+        if i > 0 and intervals[i - 1][1] + 1 >= first:
+            i -= 1
+        while i + 1 < len(intervals) and intervals[i][1] + 1 >= intervals[i + 1][0]:
+            intervals[i][1] = max(intervals[i][1], intervals[i + 1][1])
+            del intervals[i + 1]
+
+    def track(self, results):
+        """pass on the batches from process_evidence_batch, noting their spans"""
+        for result in results:
+            actions, spans = result[0], result[3]
+            self.sent += len(actions)
+            self.pending.append((self.sent, spans))
+            yield result
+
+    def acknowledge(self, acknowledged):
+        """record the batches of the first `acknowledged` actions sent"""
+        while self.pending and self.pending[0][0] <= acknowledged:
+            _, spans = self.pending.popleft()
+            for filename, first, last in spans:
+                self.add(filename, first, last)
+
+
+def get_checkpoint_configuration(filenames, index_valid, index_invalid):
+    """
+    Digest of what the lines of a ValidationCheckpoint are for, as resuming into
+    other indexes or from other files would leave lines out of them
+    """
+    configuration = {
+        'filenames': sorted(filenames),
+        'index_valid': index_valid,
+        'index_invalid': index_invalid,
+    }
+    return hashlib.md5(json.dumps(configuration, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def drop_duplicate_actions(results, duplicates, index_valid, counts):
+    """
+    Pass on the batches from process_evidence_batch without the actions of
+    documents that were already sent, counting the valid ones dropped by
+    datasource and the invalid ones as 'invalid'. The first of the repeats is
+    the one that is kept
+    """
+    for result in results:
+        actions, misses = result[:2]
+        kept = []
+        positions = {}
+        for i, action in enumerate(actions):
+            if duplicates.add(action["_index"] + "/" + action["_id"]):
+                if action["_index"] == index_valid:
+                    source = action["_source"]
+                    if not isinstance(source, dict):
+                        source = json.loads(source)
+                    counts[source.get('sourceID')] += 1
+                else:
+                    counts['invalid'] += 1
+            else:
+                positions[i] = len(kept)
+                kept.append(action)
+        misses = [(key, positions[i]) for key, i in misses if i in positions]
+        yield (kept, misses) + tuple(result[2:])
+
+
+def save_checkpoint(sink, checkpoint, acknowledged, indexes):
+    """record the lines of the first `acknowledged` actions once they are on disk"""
+    checkpoint.acknowledge(acknowledged)
+    sink.flush(indexes)
+    checkpoint.save()
+
+
 """
 This function is called once in each child process to do local setup for 
 validation
@@ -79,10 +611,13 @@ validation
 def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes, 
         datasources_to_datatypes, es_hosts, es_index_gene, es_index_eco, es_index_efo,
         cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains):
+        cache_eco, cache_efo, cache_efo_contains, hash_algorithm,
+        gene_universe=None, efo_universe=None, validation_cache=None):
     logger = logging.getLogger(__name__)
 
-    validator = opentargets_validator.helpers.generate_validator_from_schema(schema_uri)
+    # compiled once here, for each validation process
+    validator = CompiledValidator(
+        opentargets_validator.helpers.generate_validator_from_schema(schema_uri))
 
     lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
         gene_index=es_index_gene,
@@ -93,7 +628,9 @@ def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes,
         eco_cache_size = cache_efo_contains,
         efo_index=es_index_efo,
         efo_cache_size = cache_efo,
-        efo_cache_contains_size = cache_efo_contains
+        efo_cache_contains_size = cache_efo_contains,
+        gene_universe = gene_universe,
+        efo_universe = efo_universe
         ).lookup
 
 
@@ -101,14 +638,30 @@ def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes,
     evidence_manager = EvidenceManager(lookup_data, eco_scores_uri, 
         excluded_biotypes, datasources_to_datatypes)
 
-    return logger, validator, lookup_data, datasources_to_datatypes, evidence_manager
+    hasher = CanonicalHasher(hash_algorithm)
 
-def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
+    cache = None
+    if validation_cache:
+        cache = ValidationCache(validation_cache, read_only=True)
+
+    return logger, validator, lookup_data, datasources_to_datatypes, evidence_manager, hasher, cache
+
+def validate_evidence(line, logger, validator, luts, datasources_to_datatypes, hasher=CanonicalHasher(),
+        timer=None, prefilter=False):
     """this function is called once per line until number of lines is exhausted. 
 
     It returns a tuple with (left, right) where left is the faulty line and the
     right is the fully validated and processed. There is a specific case where you
     get (None, None) which means we are not quetting the right expected input
+
+    The id of a faulty line, a hash of the whole line, is not computed here but
+    by process_evidence once the line is known to be faulty
+
+    With prefilter, lines that prefilter_evidence rejects are not parsed here, and
+    get the same id from process_evidence as when they are fully validated.
+
+    With a PhaseTimer the time is split in 'prefilter', 'parse' and 'schema', what
+    follows is up to the caller
     """
     if not line or line is None or len(line) != 2:
         logger.error('line != triple and this is weird as if any line you must have a triple')
@@ -118,6 +671,14 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
     decoded_line = codecs.decode(l, 'utf-8', 'replace')
     validated_evs = make_validated_evs_obj(filename=filename, hash='', line=decoded_line, line_n=line_n)
 
+    if prefilter:
+        rejected = prefilter_evidence(decoded_line, luts, datasources_to_datatypes)
+        if timer is not None:
+            timer.mark('prefilter')
+        if rejected is not None:
+            validated_evs.update(rejected)
+            return validated_evs, None
+
     try:
         data_type = None
         data_source = None
@@ -125,12 +686,12 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
 
         try:
             parsed_line = json.loads(decoded_line)
-            hash_line = hashlib.md5(json.dumps(parsed_line, sort_keys=True).encode("utf-8")).hexdigest()
-            validated_evs['id'] = str(hash_line)
         except Exception as e:
-            validated_evs.explanation_type = 'unparseable_json'
-            validated_evs['id'] = str(hashlib.md5(decoded_line).hexdigest())
+            validated_evs['explanation_type'] = 'unparseable_json'
             return validated_evs, None
+        finally:
+            if timer is not None:
+                timer.mark('parse')
 
         if 'label' in parsed_line or 'type' in parsed_line:
             # setting type from label in case we have label??
@@ -138,58 +699,59 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
                 parsed_line['type'] = parsed_line.pop('label', None)
 
             data_type = parsed_line['type']
-            validated_evs.data_type = data_type
+            validated_evs['data_type'] = data_type
 
         else:
-            validated_evs.explanation_type = 'key_fields_missing'
+            validated_evs['explanation_type'] = 'key_fields_missing'
             return validated_evs, None
 
         if data_type is None:
-            validated_evs.explanation_type = 'missing_datatype'
+            validated_evs['explanation_type'] = 'missing_datatype'
             return validated_evs, None
 
         if 'sourceID' not in parsed_line:
-            validated_evs.explanation_type = 'missing_datasource'
+            validated_evs['explanation_type'] = 'missing_datasource'
             return validated_evs, None
 
         data_source = parsed_line['sourceID']
-        validated_evs.data_source = data_source
+        validated_evs['data_source'] = data_source
 
         if data_source not in datasources_to_datatypes:
-            validated_evs.explanation_type = 'unsupported_datasource'
-            validated_evs.explanation_str = data_source
+            validated_evs['explanation_type'] = 'unsupported_datasource'
+            validated_evs['explanation_str'] = data_source
             return validated_evs, None
 
         # validate line
         validation_errors = \
             [str(e) for e in validator.iter_errors(parsed_line)]
+        if timer is not None:
+            timer.mark('schema')
 
         if validation_errors:
             # here I have to log all fails to logger and elastic
             error_messages = ' '.join(validation_errors).replace('\n', ' ; ').replace('\r', '')
 
-            validated_evs.explanation_type = 'validation_error'
-            validated_evs.explanation_str = error_messages
+            validated_evs['explanation_type'] = 'validation_error'
+            validated_evs['explanation_str'] = error_messages
 
             return validated_evs, None
 
         target_id = None
         efo_id = None
-        # generate fantabulous dict from addict
-        evidence_obj = addict.Dict(parsed_line)
-        evidence_obj.unique_association_fields['datasource'] = data_source
+        # the parsed line is the evidence from now on, without copying it
+        evidence_obj = parsed_line
+        evidence_obj.setdefault('unique_association_fields', {})['datasource'] = data_source
 
-        if evidence_obj.target.id:
-            target_id = evidence_obj.target.id
-            validated_evs.target_id = evidence_obj.target.id
-        if evidence_obj.disease.id:
-            efo_id = evidence_obj.disease.id
-            validated_evs.efo_id = evidence_obj.disease.id
+        if evidence_obj.get('target', {}).get('id'):
+            target_id = evidence_obj['target']['id']
+            validated_evs['target_id'] = target_id
+        if evidence_obj.get('disease', {}).get('id'):
+            efo_id = evidence_obj['disease']['id']
+            validated_evs['efo_id'] = efo_id
 
         # flatten but is it always valid unique_association_fields?
-        validated_evs.hash = hashlib.md5(json.dumps(evidence_obj.unique_association_fields, 
-            sort_keys=True).encode("utf-8")).hexdigest()
-        evidence_obj['id'] = str(validated_evs.hash)
+        validated_evs['hash'] = hasher.hash_object(evidence_obj['unique_association_fields'])
+        evidence_obj['id'] = str(validated_evs['hash'])
 
         disease_failed = False
         target_failed = False
@@ -205,13 +767,13 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
 
             #if its not in the efo lookup table, fail
             if short_efo_id not in luts.available_efos:
-                validated_evs.explanation_type = 'invalid_disease'
-                validated_evs.explanation_str = efo_id
+                validated_evs['explanation_type'] = 'invalid_disease'
+                validated_evs['explanation_str'] = efo_id
                 disease_failed = True
         else:
             #disease is missing entirely
             #should never happen because it will fail validation, but...
-            validated_evs.explanation_type = 'missing_disease'
+            validated_evs['explanation_type'] = 'missing_disease'
             disease_failed = True
 
         # CHECK GENE/PROTEIN IDENTIFIER Check Ensembl ID, UniProt ID
@@ -221,8 +783,8 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
             if 'ensembl' in target_id:
                 ensembl_id = target_id.split('/')[-1]
                 if not ensembl_id in luts.available_genes:
-                    validated_evs.explanation_type = 'invalid_target'
-                    validated_evs.explanation_str = ensembl_id
+                    validated_evs['explanation_type'] = 'invalid_target'
+                    validated_evs['explanation_str'] = ensembl_id
                     target_failed = True
 
                 elif ensembl_id in luts.non_reference_genes:
@@ -234,16 +796,16 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
                 ensembl_id = luts.available_genes.get_uniprot2ensembl(uniprot_id)
 
                 if ensembl_id is None:
-                    validated_evs.explanation_type = 'unknown_uniprot_entry'
-                    validated_evs.explanation_str = uniprot_id
+                    validated_evs['explanation_type'] = 'unknown_uniprot_entry'
+                    validated_evs['explanation_str'] = uniprot_id
                     target_failed = True
 
                 elif (ensembl_id is not None) and \
                         ensembl_id in luts.available_genes and \
                         'is_reference' in luts.available_genes.get_gene(ensembl_id) and \
                         (not luts.available_genes.get_gene(ensembl_id)['is_reference'] is True):
-                    validated_evs.explanation_type = 'nonref_ensembl_xref_for_uniprot_entry'
-                    validated_evs.explanation_str = uniprot_id
+                    validated_evs['explanation_type'] = 'nonref_ensembl_xref_for_uniprot_entry'
+                    validated_evs['explanation_str'] = uniprot_id
                     target_failed = True
                 else:
                     try:
@@ -256,30 +818,31 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
                     else:
                         target_id = ensembl_id
                     if target_id is None:
-                        validated_evs.explanation_type = 'missing_target_id_for_protein'
-                        validated_evs.explanation_str = uniprot_id
+                        validated_evs['explanation_type'] = 'missing_target_id_for_protein'
+                        validated_evs['explanation_str'] = uniprot_id
                         target_failed = True
 
         # If there is no target id after the processing step
         if target_id is None:
-            validated_evs.explanation_type = 'missing_target_id'
+            validated_evs['explanation_type'] = 'missing_target_id'
             target_failed = True
 
         if target_failed or disease_failed:
 
             if target_failed and disease_failed:
-                validated_evs.explanation_type = 'target_id_and_disease_id'
-                validated_evs.explanation_str = ''
+                validated_evs['explanation_type'] = 'target_id_and_disease_id'
+                validated_evs['explanation_str'] = ''
 
             return validated_evs, None
 
-        validated_evs.line = json.dumps(evidence_obj.to_dict())
-        validated_evs.is_valid = True
+        #serialized once fixed, scored and extended
+        validated_evs['line'] = evidence_obj
+        validated_evs['is_valid'] = True
         return None, validated_evs
 
     except Exception as e:
-        validated_evs.explanation_type = 'exception'
-        validated_evs.explanation_str = str(e)
+        validated_evs['explanation_type'] = 'exception'
+        validated_evs['explanation_str'] = str(e)
         return validated_evs, None
 
 """
@@ -287,7 +850,7 @@ Generates elasticsearch action objects from the results iterator
 
 Output suitable for use with elasticsearch.helpers 
 """
-def elasticsearch_actions(lines, index_valid, index_invalid):
+def elasticsearch_actions(lines, index_valid, index_invalid, route_by_target=False):
     for line in lines:
         (left, right) = line
         if right is not None:
@@ -296,6 +859,9 @@ def elasticsearch_actions(lines, index_valid, index_invalid):
             action["_index"] = index_valid
             action["_id"] = right['hash']
             action["_source"] = right['line']
+            if route_by_target:
+                #all the evidence of a target in one shard
+                action["_routing"] = right['target_id']
             #print("  valid %s" % action["_id"])
             yield action
         elif left is not None:
@@ -317,13 +883,27 @@ def process_evidences_pipeline(
         dry_run,
         append_data,
         workers_validation, queue_validation, workers_write, queue_write,
+        batch_lines, batch_bytes, workers_read, split_bytes,
         cache_target, cache_target_u2e, cache_target_contains,
         cache_eco, cache_efo, cache_efo_contains,
         eco_scores_uri, schema_uri, excluded_biotypes, 
-        datasources_to_datatypes):
+        datasources_to_datatypes, hash_algorithm, preload, validation_cache,
+        checkpoint_filename=None, resume=False, dedup=False, dedup_capacity=10000000,
+        prefilter=False, route_by_target=False, index_sort=False, checkpoint_seconds=60,
+        es_folder=None, es_bulk=None):
+    """
+    Validate, fix, score and extend the evidence lines of the files and load them
+    into the indexes of valid and invalid evidence, or into files of them in
+    es_folder to load later.
+
+    Returns a dictionary of string QC metric names and values
+    """
 
     logger = logging.getLogger(__name__)
 
+    if resume and not checkpoint_filename:
+        raise RuntimeError('unable to resume without a checkpoint file')
+
     # do not pass this es object to other processess, single process only!
     es = new_es_client(es_hosts)
 
@@ -343,18 +923,64 @@ def process_evidences_pipeline(
 
     logger.info('start evidence processing pipeline')
 
-    #create a iterable of lines from all file handles
-    evs = IO.make_iter_lines(checked_filenames, first_n)
+    checkpoint, committed = None, None
+    if checkpoint_filename:
+        configuration = get_checkpoint_configuration(checked_filenames, es_index_valid, es_index_invalid)
+        checkpoint = ValidationCheckpoint(checkpoint_filename, configuration)
+        if resume:
+            checkpoint.load()
+            #the lines to skip are read from another copy, this one keeps changing
+            committed = ValidationCheckpoint(checkpoint_filename, configuration)
+            committed.load()
+            logger.info('resuming from checkpoint %s, skipping %d lines', checkpoint_filename, committed.count())
+    skip = committed.contains if committed is not None else None
+
+    #lines are sent to validation processes in batches, and come back as
+    #batches of actions, to not pay the queue overhead for every line
+    if workers_read > 0 and not first_n:
+        #files, and ranges of large files, are read by their own processes
+        ev_batches = IO.make_parallel_iter_batches(checked_filenames, batch_lines, batch_bytes,
+            workers_read, split_bytes, queue_validation, skip)
+    else:
+        #create a iterable of lines from all file handles
+        evs = IO.make_iter_lines(checked_filenames, first_n)
+        if skip is not None:
+            evs = (line for line in evs if not skip(line[0], line[1][0]))
+        ev_batches = IO.make_iter_batches(evs, batch_lines, batch_bytes)
+    process_evidence_batch_baked = functools.partial(process_evidence_batch,
+        index_valid=es_index_valid, index_invalid=es_index_invalid, prefilter=prefilter,
+        route_by_target=route_by_target)
+
+    #all the target and disease ids are read once here, before the validation
+    #processes are forked, so they share them instead of querying for each line
+    gene_universe, efo_universe = None, None
+    #the cache depends on the ids of targets and diseases
+    if preload or validation_cache:
+        gene_universe = GeneLookUpTable.load_universe(es, es_index_gene)
+        efo_universe = EFOLookUpTable.load_universe(es, es_index_efo)
+        logger.info('preloaded %d targets, %d uniprot accessions and %d diseases',
+            len(gene_universe[0]), len(gene_universe[1]), len(efo_universe))
+
+    cache = None
+    if validation_cache:
+        cache = ValidationCache(validation_cache)
+        configuration = get_validation_configuration(schema_uri, eco_scores_uri, excluded_biotypes,
+            datasources_to_datatypes, hash_algorithm, gene_universe, efo_universe, route_by_target)
+        if cache.get_meta('configuration') != configuration:
+            logger.info('validation cache %s is for another configuration, clearing it', validation_cache)
+            cache.clear()
+            cache.set_meta('configuration', configuration)
 
     #create functions with pre-baked arguments
     validation_on_start_baked = functools.partial(validation_on_start, 
         eco_scores_uri, schema_uri, excluded_biotypes, datasources_to_datatypes,
         es_hosts, es_index_gene, es_index_eco, es_index_efo,
         cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains)
+        cache_eco, cache_efo, cache_efo_contains, hash_algorithm,
+        gene_universe, efo_universe, validation_cache)
 
     #here is the pipeline definition
-    pl_stage = pr.map(process_evidence, evs, 
+    pl_stage = pr.map(process_evidence_batch_baked, ev_batches, 
         workers=workers_validation, maxsize=queue_validation,
         on_start=validation_on_start_baked)
 
@@ -372,31 +998,66 @@ def process_evidences_pipeline(
     with URLZSource(es_settings_invalid).open() as settings_file:
         settings_invalid = json.load(settings_file)
 
-    with ElasticsearchBulkIndexManager(es, es_index_invalid, settings_invalid, mappings_invalid, append_data):
-        with ElasticsearchBulkIndexManager(es, es_index_valid, settings_valid, mappings_valid, append_data):
+    if route_by_target:
+        #readers of the evidence of a target know to route by it from this
+        mappings_valid["_routing"] = {"required": True}
+    if index_sort:
+        #segments are sorted so the evidence of a target is contiguous
+        settings_valid.setdefault("index", {})["sort"] = {
+            "field": ["target.id", "disease.id"], "order": ["asc", "asc"]}
+
+    metrics = dict()
+    stats = ValidationStats()
+    pl_stage = collect_validation_stats(pl_stage, stats, logger)
+
+    duplicates = None
+    duplicate_counts = collections.Counter()
+    if dedup:
+        #repeats of the same evidence would only overwrite each other in the index
+        duplicates = DuplicateFilter(dedup_capacity)
+        pl_stage = drop_duplicate_actions(pl_stage, duplicates, es_index_valid, duplicate_counts)
+
+    #a run that is checkpointed leaves the indexes in bulk mode if it fails, to be resumed
+    keep_on_error = checkpoint is not None and not dry_run
+    sink = new_bulk_sink(es, es_folder, es_bulk)
+    with sink.index(es_index_invalid, settings_invalid, mappings_invalid,
+            append_data, resume, keep_on_error):
+        with sink.index(es_index_valid, settings_valid, mappings_valid,
+                append_data, resume, keep_on_error):
+            if sink.is_routing_required(es_index_valid) != route_by_target:
+                raise RuntimeError("%s is %srouted by target, unable to load into it otherwise" % (
+                    es_index_valid, "" if not route_by_target else "not "))
+
             #load into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(pl_stage, 
-                es_index_valid, es_index_invalid)
+            #checkpoints are considered every this many actions
+            checkpoint_actions = 1000
+            if checkpoint is not None and not dry_run:
+                #unless resuming, the lines of the previous checkpoint are gone with its indexes
+                checkpoint.save()
+                pl_stage = checkpoint.track(pl_stage)
+            else:
+                checkpoint = None
+            actions = get_cached_actions(pl_stage, cache, es_index_valid, logger)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if workers_write > 0:
-                    logger.debug("Using parallel bulk writer for Elasticearch")
-                    # this can silently crash ?
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=workers_write,
-                            queue_size=queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = sink.bulk(actions, workers_write, queue_write)
 
+                acknowledged = 0
+                saved = time.time()
                 for success, details in results:
                     if not success:
                         failcount += 1
+                    elif not failcount:
+                        #lines after a failed one are not recorded as loaded
+                        acknowledged += 1
+                        if checkpoint is not None and acknowledged % checkpoint_actions == 0 \
+                                and time.time() - saved > checkpoint_seconds:
+                            save_checkpoint(sink, checkpoint, acknowledged, [es_index_valid, es_index_invalid])
+                            saved = time.time()
+
+                if checkpoint is not None and not failcount:
+                    save_checkpoint(sink, checkpoint, acknowledged, [es_index_valid, es_index_invalid])
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
@@ -404,7 +1065,23 @@ def process_evidences_pipeline(
             logger.info('stages created, ran scoring and writing')
 
 
+    if cache is not None:
+        cache.close()
+
+    stats.log(logger)
+    metrics.update(stats.metrics())
+
+    if duplicates is not None:
+        logger.info('dropped %d duplicate evidence, %d false positives of the filter',
+            duplicates.duplicates, duplicates.false_positives)
+        duplicates.close()
+        metrics["evidence.duplicates"] = duplicates.duplicates
+        for datasource, count in duplicate_counts.items():
+            metrics["evidence.duplicates.%s" % datasource] = count
+
     if failed_filenames:
         raise RuntimeError('unable to handle %s', str(failed_filenames))
 
+    return metrics
+
 
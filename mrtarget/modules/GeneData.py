@@ -6,12 +6,11 @@ import logging
 from collections import OrderedDict
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 from opentargets_urlzsource import URLZSource
 
 import simplejson as json
 from yapsy.PluginManager import PluginManager
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
@@ -250,12 +249,14 @@ class GeneManager(object):
     def __init__(self, es_hosts, es_index, es_mappings, 
             es_settings, plugin_paths, plugin_order, 
             data_config, es_config,
-            workers_write, queue_write):
+            workers_write, queue_write, es_folder=None, es_bulk=None):
 
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.plugin_order = plugin_order
         self.data_config = data_config
         self.es_config = es_config
@@ -301,23 +302,15 @@ class GeneManager(object):
             gene._create_suggestions()
             gene._create_facets()
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             actions = elasticsearch_actions(self.genes, self.es_index)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
                 for success, details in results:
                     if not success:
                         failcount += 1
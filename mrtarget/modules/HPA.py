@@ -13,12 +13,11 @@ import codecs
 import petl
 import more_itertools
 from opentargets_urlzsource import URLZSource
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 from mrtarget.common.connection import new_es_client
 from addict import Dict
 from mrtarget.common.DataStructure import JSONSerializable, json_serialize, PipelineEncoder
@@ -506,11 +505,13 @@ class HPAProcess(object):
             tissue_curation_map_url,
             normal_tissue_url,
             rna_level_url, rna_value_url, rna_zscore_url, 
-            workers_write, queue_write):
+            workers_write, queue_write, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
 
         self.workers_write = workers_write
         self.queue_write = queue_write
@@ -552,23 +553,15 @@ class HPAProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
   
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             actions = elasticsearch_actions(self.hpa_merged_table, dry_run, self.es_index)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
                 for success, details in results:
                     if not success:
                         failcount += 1
@@ -8,10 +8,9 @@ from networkx.algorithms import all_simple_paths
 
 from mrtarget.common.DataStructure import TreeNode, JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
@@ -124,11 +123,13 @@ def elasticsearch_actions(reactions, index):
 class ReactomeProcess(object):
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
             pathway_data_url, pathway_relation_url,
-            workers_write, queue_write):
+            workers_write, queue_write, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.downloader = ReactomeDataDownloader(pathway_data_url, pathway_relation_url)
 
         self.logger = logging.getLogger(__name__)
@@ -160,23 +161,15 @@ class ReactomeProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             docs = generate_documents(self.g)
             actions = elasticsearch_actions(docs, self.es_index)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = sink.bulk(actions, self.workers_write, self.queue_write)
                 for success, _ in results:
                     if not success:
                         failcount += 1
@@ -8,11 +8,10 @@ from collections import defaultdict
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.chembl_lookup import ChEMBLLookup
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import new_bulk_sink
 
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll,ConstantScore
 
@@ -184,22 +183,13 @@ def elasticsearch_actions(items, dry_run, index):
 
             yield action
 
-def store_in_elasticsearch(so_it, dry_run, es, index, workers_write, queue_write):
+def store_in_elasticsearch(so_it, dry_run, sink, index, workers_write, queue_write):
         #write into elasticsearch
-        chunk_size = 1000 #TODO make configurable
         actions = elasticsearch_actions(so_it, dry_run, index)
         failcount = 0
 
         if not dry_run:
-            results = None
-            if workers_write > 0:
-                results = elasticsearch.helpers.parallel_bulk(es, actions,
-                        thread_count=workers_write,
-                        queue_size=queue_write, 
-                        chunk_size=chunk_size)
-            else:
-                results = elasticsearch.helpers.streaming_bulk(es, actions,
-                        chunk_size=chunk_size)
+            results = sink.bulk(actions, workers_write, queue_write)
             for success, details in results:
                 if not success:
                     failcount += 1
@@ -215,11 +205,13 @@ class SearchObjectProcess(object):
             chembl_mechanism_uri, 
             chembl_component_uri, 
             chembl_protein_uri, 
-            chembl_molecule_set_uri_pattern):
+            chembl_molecule_set_uri_pattern, es_folder=None, es_bulk=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
+        self.es_folder = es_folder
+        self.es_bulk = es_bulk
         self.es_index_gene = es_index_gene
         self.es_index_efo = es_index_efo
         self.es_index_val_right = es_index_val_right
@@ -269,19 +261,20 @@ class SearchObjectProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        sink = new_bulk_sink(es, self.es_folder, self.es_bulk)
+        with sink.index(self.es_index, settings, mappings):
             #process targets
             self.logger.info('handling targets')
             targets = self.get_targets(es)
             so_it = self.handle_search_object(targets, es, SearchObjectTypes.TARGET)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
+            store_in_elasticsearch(so_it, dry_run, sink, self.es_index, 
                 self.workers_write, self.queue_write)
 
             #process diseases
             self.logger.info('handling diseases')
             diseases = self.get_diseases(es)
             so_it = self.handle_search_object(diseases, es, SearchObjectTypes.DISEASE)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
+            store_in_elasticsearch(so_it, dry_run, sink, self.es_index, 
                 self.workers_write, self.queue_write)
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of the staged and fused --as process layouts, and the
+memory and serialization time of full and compact association objects.
+
+Runs the same association functions as ScoringProcess on synthetic evidence, 
+with in-memory lookups instead of elasticsearch, so only the CPU and 
+inter-process costs are measured.
+
+    python scripts/benchmark_association.py --targets 200 --workers 4
+"""
+from __future__ import print_function
+import argparse
+import functools
+import random
+import time
+import tracemalloc
+
+import pypeln.process as pr
+
+from mrtarget.modules.Association import produce_evidence_batch, score_producer, \
+    score_target, Scorer, AssociationEnricher, LookUpDataRetriever, group_evidence
+
+DATASOURCES_TO_DATATYPES = {
+    'europepmc': 'literature',
+    'gwas_catalog': 'genetic_association',
+    'eva': 'genetic_association',
+    'chembl': 'known_drug',
+    'expression_atlas': 'rna_expression',
+    'phenodigm': 'animal_model',
+    'reactome': 'affected_pathway',
+}
+
+
+class MemoryLookup(object):
+    def get_gene(self, target):
+        return {'id': target, 'approved_symbol': target, 'approved_name': target}
+
+    def get_hpa(self, target):
+        return None
+
+    def get_efo(self, disease):
+        return {'code': disease, 'label': disease, 'path_codes': [[disease]],
+                'therapeutic_codes': [], 'therapeutic_labels': []}
+
+
+def memory_enricher():
+    lookup = LookUpDataRetriever(None).lookup
+    lookup.available_genes = lookup.available_hpa = lookup.available_efos = MemoryLookup()
+    return AssociationEnricher(lookup, 1024, 1024*16)
+
+
+def make_batches(n_targets, max_evidence, seed):
+    rng = random.Random(seed)
+    datasources = sorted(DATASOURCES_TO_DATATYPES)
+    for t in range(n_targets):
+        target = 'ENSG%011d' % t
+        evidence = []
+        #heavy tailed number of evidence per target
+        for _ in range(min(max_evidence, int(rng.paretovariate(1.2) * 10))):
+            disease = 'EFO_%07d' % rng.randint(0, 2000)
+            evidence.append({'target': {'id': target},
+                'disease': {'id': disease},
+                'sourceID': rng.choice(datasources),
+                'scores': {'association_score': rng.random()},
+                'private': {'efo_codes': [disease] + ['EFO_%07d' % rng.randint(0, 50) for _ in range(3)]}})
+        yield target, evidence
+
+
+def staged_init_produce():
+    return {}, [], DATASOURCES_TO_DATATYPES
+
+def staged_init_score():
+    return Scorer(), memory_enricher(), DATASOURCES_TO_DATATYPES, False
+
+def fused_init():
+    return (None, None, [('benchmark', {})], [], DATASOURCES_TO_DATATYPES, 
+        Scorer(), memory_enricher())
+
+
+def run_staged(batches, workers, queue):
+    stage1 = pr.flat_map(produce_evidence_batch, batches, workers=workers,
+        maxsize=queue, on_start=staged_init_produce)
+    stage2 = pr.map(score_producer, stage1, workers=workers,
+        maxsize=queue, on_start=staged_init_score)
+    return sum(1 for r in stage2 if r is not None)
+
+
+def run_fused(batches, workers, queue):
+    stage = pr.map(score_target, batches, workers=workers, 
+        maxsize=queue, on_start=fused_init)
+    return sum(count for count, _ in stage)
+
+
+def compare_objects(batches):
+    """
+    Score and enrich the same associations in one process as Association and 
+    as AssociationRecord objects, measuring the memory held by them and the 
+    time spent serializing them
+    """
+    evidence_sets = []
+    for _, evidence in batches:
+        evidence_sets.extend(group_evidence(evidence, {}, [], DATASOURCES_TO_DATATYPES))
+
+    for name, method in (('full', Scorer.score_many), ('compact', Scorer.score_records)):
+        scorer = Scorer()
+        enricher = memory_enricher()
+        #build the fragments beforehand so they are not measured
+        for association in method(scorer, evidence_sets[:1], DATASOURCES_TO_DATATYPES):
+            enricher.enrich(association)
+        for association in method(scorer, evidence_sets, DATASOURCES_TO_DATATYPES):
+            enricher.enrich(association)
+
+        tracemalloc.start()
+        associations = method(scorer, evidence_sets, DATASOURCES_TO_DATATYPES)
+        for association in associations:
+            enricher.enrich(association)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.time()
+        for association in associations:
+            association.to_json()
+        elapsed = time.time() - start
+        print('%-7s %8d associations %7.0f bytes/association %7.1fus/serialization' % (
+            name, len(associations), float(size) / len(associations), 
+            elapsed * 1e6 / len(associations)))
+        del associations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--targets', type=int, default=200)
+    parser.add_argument('--max-evidence', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    batches = list(make_batches(args.targets, args.max_evidence, args.seed))
+    print('%d targets, %d evidence' % (len(batches), sum(len(e) for _, e in batches)))
+
+    for name, run in (('staged', run_staged), ('fused', run_fused)):
+        start = time.time()
+        count = run(iter(batches), args.workers, args.queue)
+        elapsed = time.time() - start
+        print('%-7s %8d associations %7.2fs %9.1f associations/s' % (
+            name, count, elapsed, count / elapsed))
+
+    compare_objects(batches)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of hashing evidence, in microseconds per hash.
+
+For each hash algorithm it times the id of an evidence, a hash of its unique
+association fields, and the hash of a whole line at typical evidence sizes.
+The "before" rows are how validate_evidence hashed before CanonicalHasher:
+simplejson.dumps(sort_keys=True) and md5.
+
+    python scripts/benchmark_hashing.py
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import timeit
+
+import simplejson as json
+
+from mrtarget.common.hashing import CanonicalHasher, HASH_ALGORITHMS
+
+
+def make_evidence(mined_sentences):
+    pmid = 'http://europepmc.org/abstract/MED/29925950'
+    target = 'http://identifiers.org/ensembl/ENSG00000157764'
+    disease = 'http://www.ebi.ac.uk/efo/EFO_0000311'
+    return {'sourceID': 'europepmc', 'type': 'literature', 'access_level': 'public',
+        'target': {'id': target, 'target_type': 'http://identifiers.org/cttv.target/gene_evidence',
+                   'activity': 'http://identifiers.org/cttv.activity/unknown'},
+        'disease': {'id': disease, 'name': 'cancer'},
+        'unique_association_fields': {'publicationIDs': pmid, 'target': target,
+                                      'disease_id': disease, 'datasource': 'europepmc'},
+        'evidence': {'date_asserted': '2019-06-01T00:00:00', 'is_associated': True,
+            'evidence_codes': ['http://purl.obolibrary.org/obo/ECO_0000213'],
+            'resource_score': {'type': 'summed_total', 'value': 3.5},
+            'literature_ref': {'lit_id': pmid, 'mined_sentences': [
+                {'text': 'sentence %d about the target and the disease' % s, 'section': 'abstract',
+                 't_start': 10, 't_end': 20, 'd_start': 30, 'd_end': 40} for s in range(mined_sentences)]}}}
+
+
+def timed(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    algorithms = [a for a in HASH_ALGORITHMS if a != 'xxhash']
+    try:
+        CanonicalHasher('xxhash')
+        algorithms.append('xxhash')
+    except ValueError:
+        pass
+
+    print('%-12s %-8s %8s %10s %10s' % ('', 'bytes', 'before', 'algorithm', 'us'))
+    for mined_sentences in (0, 10, 100):
+        evidence = make_evidence(mined_sentences)
+        line = json.dumps(evidence)
+        unique_fields = evidence['unique_association_fields']
+
+        before_unique = timed(lambda: hashlib.md5(json.dumps(unique_fields,
+            sort_keys=True).encode("utf-8")).hexdigest(), args.number)
+        before_line = timed(lambda: hashlib.md5(json.dumps(json.loads(line),
+            sort_keys=True).encode("utf-8")).hexdigest(), args.number)
+
+        for algorithm in algorithms:
+            hasher = CanonicalHasher(algorithm)
+            print('%-12s %-8d %8.2f %10s %10.2f' % ('unique', len(json.dumps(unique_fields)),
+                before_unique, algorithm, timed(lambda: hasher.hash_object(unique_fields), args.number)))
+        for algorithm in algorithms:
+            hasher = CanonicalHasher(algorithm)
+            print('%-12s %-8d %8.2f %10s %10.2f' % ('line', len(line),
+                before_line, algorithm, timed(lambda: hasher.hash_line(line), args.number)))
+
+
+if __name__ == '__main__':
+    main()
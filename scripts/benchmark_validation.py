@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Measure the lines per second of one --val worker.
+
+Runs process_evidence, as each validation process does, on evidence lines with
+in-memory lookups instead of elasticsearch, so only the CPU cost of validating,
+fixing, scoring and extending evidence is measured. Without --evidence,
+synthetic literature and known drug evidence is used, and without --schema
+lines are checked against an empty schema.
+
+    python scripts/benchmark_validation.py --lines 20000
+    python scripts/benchmark_validation.py --evidence sample.json.gz --schema evidence.json
+    python scripts/benchmark_validation.py --workers 4 --batch-lines 1
+    python scripts/benchmark_validation.py --unknown 0.5 --prefilter
+"""
+from __future__ import print_function
+import argparse
+import functools
+import gzip
+import itertools
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import jsonschema
+import pypeln.process as pr
+import simplejson as json
+
+import mrtarget.common.IO as IO
+
+from mrtarget.common.EvidenceString import EvidenceManager
+from mrtarget.common.hashing import CanonicalHasher, HASH_ALGORITHMS
+from mrtarget.common.validation import CompiledValidator
+from mrtarget.common.LookupHelpers import LookUpDataRetriever
+from mrtarget.common.LookupTables import EFOLookUpTable
+from mrtarget.modules.Evidences import ValidationCache, get_cached_actions, process_evidence_batch
+
+DATASOURCES_TO_DATATYPES = {
+    'europepmc': 'literature',
+    'chembl': 'known_drug',
+}
+
+ECO_LITERATURE = 'http://purl.obolibrary.org/obo/ECO_0000213'
+ECO_DRUG = 'http://purl.obolibrary.org/obo/ECO_0000360'
+
+
+class MemoryGenes(object):
+    def __contains__(self, gene_id):
+        return gene_id.startswith('ENSG')
+
+    def get_gene(self, gene_id):
+        return {'id': gene_id, 'approved_symbol': gene_id, 'approved_name': gene_id,
+                'biotype': 'protein_coding', 'is_reference': True,
+                'go': [{'id': 'GO:%07d' % i, 'value': {'term': 'P:process %d' % i}} for i in range(10)],
+                'uniprot_keywords': ['Kinase', 'Membrane'],
+                'protein_classification': {'chembl': [{'l1': 'Enzyme', 'l2': 'Kinase'}]},
+                '_private': {'facets': {'reactome': {'pathway_type_code': ['R-HSA-1'],
+                                                     'pathway_code': ['R-HSA-2', 'R-HSA-3']}}}}
+
+    def get_uniprot2ensembl(self, uniprot_id):
+        return 'ENSG' + uniprot_id
+
+
+class MemoryEfos(object):
+    get_ontology_code_from_url = staticmethod(EFOLookUpTable.get_ontology_code_from_url)
+
+    def __contains__(self, efo_id):
+        return efo_id.startswith('EFO_')
+
+    def get_efo(self, efo_id):
+        return {'code': efo_id, 'label': efo_id,
+                'path_codes': [['EFO_0000408', 'EFO_0000001', efo_id], ['EFO_0000651', efo_id]],
+                'therapeutic_codes': ['EFO_0000408'], 'therapeutic_labels': ['disease']}
+
+
+class MemoryEcos(object):
+    def get_eco(self, eco_id):
+        return {'code': eco_id, 'label': eco_id}
+
+
+def memory_lookup():
+    lookup = LookUpDataRetriever(None).lookup
+    lookup.available_genes = MemoryGenes()
+    lookup.available_efos = MemoryEfos()
+    lookup.available_ecos = MemoryEcos()
+    lookup.non_reference_genes = {}
+    return lookup
+
+
+def make_evidence(rng, i, unknown=0.0):
+    target = 'http://identifiers.org/ensembl/ENSG%011d' % rng.randint(0, 20000)
+    disease = 'http://www.ebi.ac.uk/efo/EFO_%07d' % rng.randint(0, 10000)
+    if unknown and rng.random() < unknown:
+        #from an ontology that is not in the lookups
+        disease = 'http://purl.obolibrary.org/obo/MONDO_%07d' % rng.randint(0, 10000)
+    if i % 4:
+        pmid = 'http://europepmc.org/abstract/MED/%d' % rng.randint(1, 30000000)
+        return {'sourceID': 'europepmc', 'type': 'literature', 'access_level': 'public',
+            'validated_against_schema_version': '1.6.0',
+            'target': {'id': target, 'target_type': 'http://identifiers.org/cttv.target/gene_evidence',
+                       'activity': 'http://identifiers.org/cttv.activity/unknown'},
+            'disease': {'id': disease, 'name': 'disease %d' % i},
+            'unique_association_fields': {'publicationIDs': pmid, 'target': target, 'disease_id': disease},
+            'literature': {'references': [{'lit_id': pmid}]},
+            'evidence': {'date_asserted': '2019-06-01T00:00:00', 'is_associated': True,
+                'evidence_codes': [ECO_LITERATURE],
+                'resource_score': {'type': 'summed_total', 'method': {'description': 'text mining'},
+                                   'value': rng.random() * 10},
+                'provenance_type': {'database': {'id': 'EuropePMC', 'version': '2019'}},
+                'literature_ref': {'lit_id': pmid, 'mined_sentences': [
+                    {'text': 'sentence %d about the target and the disease' % s, 'section': 'abstract',
+                     't_start': 10, 't_end': 20, 'd_start': 30, 'd_end': 40} for s in range(5)]}}}
+    molecule = 'http://identifiers.org/chembl.compound/CHEMBL%d' % rng.randint(1, 100000)
+    return {'sourceID': 'chembl', 'type': 'known_drug', 'access_level': 'public',
+        'validated_against_schema_version': '1.6.0',
+        'target': {'id': target, 'target_type': 'http://identifiers.org/cttv.target/protein_evidence',
+                   'activity': 'http://identifiers.org/cttv.activity/negative_modulator'},
+        'disease': {'id': disease, 'name': 'disease %d' % i},
+        'drug': {'id': molecule, 'molecule_type': 'Small molecule', 'max_phase_for_all_diseases': {
+            'label': 'Phase IV', 'numeric_index': 4}},
+        'unique_association_fields': {'chembl_molecules': molecule, 'target': target, 'disease': disease},
+        'evidence': {
+            'target2drug': {'evidence_codes': [ECO_DRUG], 'is_associated': True,
+                'date_asserted': '2019-06-01T00:00:00', 'mechanism_of_action': 'inhibitor',
+                'resource_score': {'type': 'probability', 'value': 1},
+                'provenance_type': {'database': {'id': 'ChEMBL', 'version': '2019'}}},
+            'drug2clinic': {'evidence_codes': [ECO_DRUG], 'is_associated': True,
+                'date_asserted': '2019-06-01T00:00:00', 'clinical_trial_phase': {
+                    'label': 'Phase IV', 'numeric_index': 4},
+                'resource_score': {'type': 'probability', 'value': rng.random()},
+                'provenance_type': {'database': {'id': 'ChEMBL', 'version': '2019'}}}}}
+
+
+def read_lines(evidence, n_lines, seed, unknown=0.0):
+    if evidence:
+        opener = gzip.open if evidence.endswith('.gz') else open
+        with opener(evidence, 'rb') as evidence_file:
+            for i, line in enumerate(evidence_file):
+                if i >= n_lines:
+                    break
+                yield ('benchmark', (i, line))
+    else:
+        rng = random.Random(seed)
+        for i in range(n_lines):
+            yield ('benchmark', (i, json.dumps(make_evidence(rng, i, unknown)).encode('utf-8')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--evidence', help='evidence file to read lines from, instead of synthetic ones')
+    parser.add_argument('--schema', help='JSON schema file to validate against')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--hash', default='md5', choices=HASH_ALGORITHMS)
+    parser.add_argument('--interpreted', action='store_true',
+        help='validate with jsonschema only, without compiling the schema')
+    parser.add_argument('--workers', type=int, default=0,
+        help='validation processes, or 0 to validate in this process')
+    parser.add_argument('--batch-lines', type=int, default=500)
+    parser.add_argument('--batch-bytes', type=int, default=1024*1024)
+    parser.add_argument('--cache', help='validation cache file, run twice to measure cache hits')
+    parser.add_argument('--unknown', type=float, default=0.0,
+        help='fraction of synthetic lines with a disease that is not known')
+    parser.add_argument('--prefilter', action='store_true',
+        help='reject lines with unknown datasources, targets or diseases before parsing them')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+
+    schema = {}
+    if args.schema:
+        with open(args.schema) as schema_file:
+            schema = json.load(schema_file)
+    validator = jsonschema.validators.validator_for(schema)(schema)
+    if not args.interpreted:
+        validator = CompiledValidator(validator)
+
+    lines = list(read_lines(args.evidence, args.lines, args.seed, args.unknown))
+    lookup = memory_lookup()
+    hasher = CanonicalHasher(args.hash)
+    directory = tempfile.mkdtemp()
+    try:
+        eco_scores = os.path.join(directory, 'eco_scores.tsv')
+        with open(eco_scores, 'w') as eco_scores_file:
+            eco_scores_file.write('%s\tECO_0000213\t1.0\n' % ECO_LITERATURE)
+        evidence_manager = EvidenceManager(lookup, eco_scores, {}, DATASOURCES_TO_DATATYPES)
+
+        process_batch = functools.partial(process_evidence_batch,
+            index_valid='valid', index_invalid='invalid', prefilter=args.prefilter)
+        cache = ValidationCache(args.cache) if args.cache else None
+        worker_cache = ValidationCache(args.cache, read_only=True) if args.cache else None
+        worker_args = (logger, validator, lookup, DATASOURCES_TO_DATATYPES, evidence_manager, hasher,
+            worker_cache)
+
+        start = time.time()
+        batches = IO.make_iter_batches(lines, args.batch_lines, args.batch_bytes)
+        if args.workers > 0:
+            results = pr.map(process_batch, batches, workers=args.workers,
+                maxsize=100, on_start=lambda: worker_args)
+        else:
+            results = (process_batch(batch, *worker_args) for batch in batches)
+        valid = sum(1 for action in get_cached_actions(results, cache, 'valid', logger)
+                    if action['_index'] == 'valid')
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d lines, %d valid, %.2fs, %.1f lines/s per worker' % (
+        len(lines), valid, elapsed, len(lines) / elapsed / max(args.workers, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ setup(name=p.__pkgname__, version=p.__version__,
 "requests",
 "jsonpickle",
 "simplejson",
+"fastjsonschema",
 #when installing from GitHub, a specific commit must be used for consistency
 #and to ensure dependency caching works as intended
 #git+https://github.com/opentargets/ontology-utils.git@f92222b5abf89b0c3a9c2d3cd0e683676620b380#egg=opentargets-ontologyutils
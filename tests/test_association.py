@@ -0,0 +1,465 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from mrtarget.common.LookupHelpers import LookUpDataRetriever
+from mrtarget.modules import Association
+from mrtarget.modules.EFO import EFO
+from mrtarget.modules.GeneData import Gene
+from mrtarget.modules.HPA import HPAExpression
+
+DATASOURCES_TO_DATATYPES = {'europepmc': 'literature', 'chembl': 'known_drug'}
+
+
+def evidence(target, disease, source='europepmc', score=0.5, efo_codes=None):
+    return {'target': {'id': target},
+            'disease': {'id': disease},
+            'sourceID': source,
+            'scores': {'association_score': score},
+            'private': {'efo_codes': efo_codes or [disease]}}
+
+
+class EvidenceReaderTestCase(unittest.TestCase):
+
+    def test_get_evidence_by_target(self):
+        '''sorted slices are merged and grouped into one batch per target'''
+        slices = [
+            [evidence('ENSG1', 'EFO_1'), evidence('ENSG3', 'EFO_1')],
+            [evidence('ENSG1', 'EFO_2'), evidence('ENSG2', 'EFO_1'), evidence('ENSG3', 'EFO_2')],
+            [],
+        ]
+
+        def get_evidence_slice(es, index, slice_id, n_slices, datasources=None):
+            return iter(slices[slice_id])
+
+        with mock.patch.object(Association, 'get_evidence_slice', get_evidence_slice):
+            batches = list(Association.get_evidence_by_target(None, 'index', len(slices), 1))
+
+        self.assertEqual([target for target, _ in batches], ['ENSG1', 'ENSG2', 'ENSG3'])
+        self.assertEqual(sorted(ev['disease']['id'] for ev in batches[0][1]), ['EFO_1', 'EFO_2'])
+
+    def test_get_evidence_by_target_failure(self):
+        '''errors reading a slice reach the consumer'''
+        def get_evidence_slice(es, index, slice_id, n_slices, datasources=None):
+            raise ValueError('slice failed')
+            yield
+
+        with mock.patch.object(Association, 'get_evidence_slice', get_evidence_slice):
+            with self.assertRaises(ValueError):
+                list(Association.get_evidence_by_target(None, 'index', 2, 1))
+
+    def test_group_evidence(self):
+        datasources_to_datatypes = {'europepmc': 'literature', 'chembl': 'known_drug'}
+        rows = Association.group_evidence([
+                evidence('ENSG1', 'EFO_1', efo_codes=['EFO_1', 'EFO_0']),
+                evidence('ENSG1', 'EFO_2', source='chembl', efo_codes=['EFO_2', 'EFO_0']),
+            ], {'chembl': 0.5}, ['chembl'], datasources_to_datatypes)
+        pairs = dict(((target, disease), (scores, is_direct))
+            for target, disease, scores, is_direct in rows)
+
+        self.assertEqual(sorted(pairs), [('ENSG1', 'EFO_0'), ('ENSG1', 'EFO_1'), ('ENSG1', 'EFO_2')])
+        self.assertFalse(pairs[('ENSG1', 'EFO_0')][1])
+        self.assertTrue(pairs[('ENSG1', 'EFO_2')][1])
+        self.assertEqual(pairs[('ENSG1', 'EFO_2')][0][0].score, 0.25)
+
+
+class MemoryLookup(object):
+    def get_gene(self, target):
+        return {'id': target, 'approved_symbol': 'SYMBOL', 'approved_name': 'name',
+                'go': [{'id': 'GO:1', 'value': {'term': 'P:process'}},
+                       {'id': 'GO:2', 'value': {'term': 'F:function'}}],
+                'uniprot_keywords': ['Kinase'],
+                'tractability': {'smallmolecule': {'categories': {'clinical_precedence': 1, 'predicted': 0}},
+                                 'antibody': {'categories': {'predicted': 1}}},
+                'protein_classification': {'chembl': [{'l1': 'Enzyme', 'l2': 'Kinase'}]},
+                '_private': {'facets': {'reactome': {'pathway_type_code': ['R-1'],
+                                                     'pathway_code': ['R-2']}}}}
+
+    def get_hpa(self, target):
+        return {'tissues': [{'efo_code': 'UBERON_1', 'rna': {'level': 2, 'zscore': 1},
+                             'protein': {'level': 1}}]}
+
+    def get_efo(self, disease):
+        return {'code': disease, 'label': disease, 'path_codes': [[disease]],
+                'therapeutic_codes': ['EFO_TA'], 'therapeutic_labels': ['area']}
+
+
+class AssociationEnricherTestCase(unittest.TestCase):
+
+    def test_enrich_matches_set_data(self):
+        '''shared fragments give the same document as setting the data on each association'''
+        lookup = LookUpDataRetriever(None).lookup
+        lookup.available_genes = lookup.available_hpa = lookup.available_efos = MemoryLookup()
+        enricher = Association.AssociationEnricher(lookup, 16, 16)
+        scorer = Association.Scorer()
+        scores = [Association.EvidenceScore(0.5, 'literature', 'europepmc', True)]
+
+        for disease in ['EFO_1', 'EFO_2', 'EFO_1']:
+            expected = scorer.score('ENSG1', disease, scores, True, DATASOURCES_TO_DATATYPES)
+            gene = Gene()
+            gene.load_json(lookup.available_genes.get_gene('ENSG1'))
+            expected.set_target_data(gene)
+            expected.set_hpa_data(HPAExpression(lookup.available_hpa.get_hpa('ENSG1')))
+            efo = EFO()
+            efo.load_json(lookup.available_efos.get_efo(disease))
+            expected.set_disease_data(efo)
+
+            association = scorer.score('ENSG1', disease, scores, True, DATASOURCES_TO_DATATYPES)
+            enricher.enrich(association)
+            self.assertEqual(association.to_json(), expected.to_json())
+
+        self.assertEqual(len(enricher.target_fragments), 1)
+        self.assertEqual(len(enricher.disease_fragments), 2)
+
+
+class AssociationRecordTestCase(unittest.TestCase):
+
+    def test_record_matches_association(self):
+        '''compact records serialize to the same bytes as full associations'''
+        lookup = LookUpDataRetriever(None).lookup
+        lookup.available_genes = lookup.available_hpa = lookup.available_efos = MemoryLookup()
+        enricher = Association.AssociationEnricher(lookup, 16, 16)
+        evidence_sets = [
+            ('ENSG1', 'EFO_1', [Association.EvidenceScore(0.5, 'literature', 'europepmc', True),
+                                Association.EvidenceScore(0.7, 'known_drug', 'chembl', True),
+                                Association.EvidenceScore(0.25, 'literature', 'europepmc', False)], True),
+            ('ENSG1', 'EFO_2', [Association.EvidenceScore(3.0, 'known_drug', 'chembl', False)], False),
+            ('ENSG1', 'EFO_3', [Association.EvidenceScore(0., 'literature', 'europepmc', False)], False),
+        ]
+        scorer = Association.Scorer()
+        associations = scorer.score_many(evidence_sets, DATASOURCES_TO_DATATYPES)
+        records = scorer.score_records(evidence_sets, DATASOURCES_TO_DATATYPES)
+
+        for association, record in zip(associations, records):
+            self.assertEqual(record.id, association.id)
+            self.assertEqual(record.to_json(), association.to_json())
+            enricher.enrich(association)
+            enricher.enrich(record)
+            self.assertEqual(record.target, association.target)
+            self.assertEqual(record.to_json(), association.to_json())
+
+
+class FusedPipelineTestCase(unittest.TestCase):
+
+    def test_score_target_matches_staged(self):
+        '''fused NDJSON output holds the same documents as the staged pipeline'''
+        lookup = LookUpDataRetriever(None).lookup
+        lookup.available_genes = lookup.available_hpa = lookup.available_efos = MemoryLookup()
+        enricher = Association.AssociationEnricher(lookup, 0, 0)
+        batch = ('ENSG1', [
+            evidence('ENSG1', 'EFO_1', efo_codes=['EFO_1', 'EFO_0']),
+            evidence('ENSG1', 'EFO_2', source='chembl', efo_codes=['EFO_2', 'EFO_0']),
+            evidence('ENSG1', 'EFO_3', score=0., efo_codes=['EFO_3']),
+        ])
+
+        staged = {}
+        for row in Association.produce_evidence_batch(batch, {}, [], DATASOURCES_TO_DATATYPES):
+            result = Association.score_producer(row, Association.Scorer(), enricher, 
+                DATASOURCES_TO_DATATYPES, False)
+            if result is not None:
+                staged[result[0]] = result[1]
+
+        count, data = Association.score_target(batch, None, None, [('index', {})], [], 
+            DATASOURCES_TO_DATATYPES, Association.Scorer(), 
+            Association.AssociationEnricher(lookup, 16, 16))
+        lines = data.decode('utf-8').splitlines()
+
+        self.assertEqual(count, 3)
+        self.assertEqual(len(lines), 2 * count)
+        fused = {}
+        for action, source in zip(lines[::2], lines[1::2]):
+            action = json.loads(action)
+            self.assertEqual(action['index']['_index'], 'index')
+            fused[action['index']['_id']] = source
+        self.assertEqual(fused, staged)
+
+
+def scoring_process(**kwargs):
+    arguments = dict(es_hosts=None, es_index='index', es_mappings=None, es_settings=None,
+        es_index_gene='gene', es_index_val_right='evidence', es_index_hpa='hpa', es_index_efo='efo',
+        workers_write=0, workers_production=1, workers_score=1,
+        queue_score=1, queue_produce=1, queue_write=1,
+        cache_hpa=0, cache_efo=0, cache_target=0,
+        cache_target_fragment=0, cache_disease_fragment=0,
+        scoring_weights={}, is_direct_do_not_propagate=[],
+        datasources_to_datatypes=DATASOURCES_TO_DATATYPES,
+        evidence_reader='sliced', evidence_slices=1, queue_evidence=1,
+        pipeline='fused', manifest=None, incremental=False, shard=0, shards=1,
+        schedule='index', split_evidence=0, weightings=None,
+        partials=None, partial_datasources=None)
+    arguments.update(kwargs)
+    return Association.ScoringProcess(**arguments)
+
+
+class IncrementalTestCase(unittest.TestCase):
+
+    def test_evidence_digest(self):
+        '''digests do not depend on the order evidence is read in'''
+        first = evidence('ENSG1', 'EFO_1')
+        second = evidence('ENSG1', 'EFO_2', source='chembl')
+        self.assertEqual(Association.evidence_digest([first, second]),
+            Association.evidence_digest([second, first]))
+        self.assertNotEqual(Association.evidence_digest([first, second]),
+            Association.evidence_digest([first, evidence('ENSG1', 'EFO_2', source='chembl', score=0.1)]))
+
+    def test_manifest(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'manifest', 'as.tsv')
+            self.assertEqual(Association.load_manifest(filename), (None, {}))
+            Association.save_manifest(filename, 'abc', {'ENSG2': '2', 'ENSG1': '1'})
+            self.assertEqual(Association.load_manifest(filename), ('abc', {'ENSG1': '1', 'ENSG2': '2'}))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_configuration_digest(self):
+        '''reloading a lookup index changes the digest'''
+        process = scoring_process()
+        es = mock.Mock()
+        uuids = {'gene': 'a', 'hpa': 'b', 'efo': 'c'}
+        es.indices.get_settings.side_effect = lambda index, name: {index + '-1': {'settings': {
+            'index': {'uuid': uuids[index], 'creation_date': '1'}}}}
+        digest = process.get_configuration_digest(es)
+        self.assertEqual(process.get_configuration_digest(es), digest)
+
+        uuids['hpa'] = 'd'
+        self.assertNotEqual(process.get_configuration_digest(es), digest)
+
+    def test_digested_evidence_batches(self):
+        '''only changed targets are rescored, after deleting their previous associations'''
+        process = scoring_process(manifest='manifest.tsv', incremental=True)
+        unchanged = ('ENSG1', [evidence('ENSG1', 'EFO_1')])
+        changed = ('ENSG2', [evidence('ENSG2', 'EFO_1')])
+        added = ('ENSG3', [evidence('ENSG3', 'EFO_1')])
+        previous = {'ENSG1': Association.evidence_digest(unchanged[1]),
+                    'ENSG2': 'old', 'ENSG4': 'removed'}
+        es = mock.Mock()
+        digests = {}
+
+        batches = list(process.get_digested_evidence_batches(es, 
+            iter([unchanged, changed, added]), previous, digests, False))
+
+        self.assertEqual([target for target, _ in batches], ['ENSG2', 'ENSG3'])
+        self.assertEqual(sorted(digests), ['ENSG1', 'ENSG2', 'ENSG3'])
+        deleted = [c[1]['body']['query']['terms']['target.id'] for c in es.delete_by_query.call_args_list]
+        self.assertEqual(deleted, [['ENSG2'], ['ENSG4']])
+
+
+def markers_client(markers, created=None):
+    '''a mock client holding the run of each shard marker'''
+    es = mock.Mock()
+    es.markers = dict(markers)
+
+    def get(index, id, ignore):
+        if id not in es.markers:
+            return {'found': False}
+        body = {'run': es.markers[id]}
+        if id == 'created':
+            body.update(created or {})
+        return {'found': True, '_source': body}
+
+    es.get.side_effect = get
+    return es
+
+
+class ShardTestCase(unittest.TestCase):
+
+    def test_shards_are_disjoint(self):
+        targets = ['ENSG%011d' % i for i in range(1000)]
+        processes = [scoring_process(shard=i, shards=3) for i in range(3)]
+        shards = [[t for t in targets if p.in_shard(t)] for p in processes]
+
+        self.assertEqual(sorted(sum(shards, [])), targets)
+        for shard in shards:
+            self.assertGreater(len(shard), 250)
+        #the same on every machine
+        self.assertEqual(Association.target_shard('ENSG00000157764', 3), 
+            Association.target_shard(u'ENSG00000157764', 3))
+
+    def test_invalid_shard(self):
+        with self.assertRaises(ValueError):
+            scoring_process(shard=3, shards=3)
+
+    def test_wait_for_markers(self):
+        process = scoring_process(shard=0, shards=3)
+        es = markers_client({'done-1': 'run'})
+
+        def sleep(interval):
+            es.markers['done-2'] = 'run'
+
+        with mock.patch.object(Association.time, 'sleep', sleep):
+            self.assertEqual(process.wait_for_markers(es, ['done-1', 'done-2'], 'run')['run'], 'run')
+
+        self.assertEqual(es.get.call_args_list[-1][1], 
+            {'index': 'index-shards', 'id': 'done-2', 'ignore': [404]})
+
+    def test_stale_markers_ignored(self):
+        '''markers left by another run do not count'''
+        process = scoring_process(shard=0, shards=2)
+        es = markers_client({'done-1': 'old'})
+
+        def sleep(interval):
+            es.markers['done-1'] = 'run'
+
+        with mock.patch.object(Association.time, 'sleep', sleep):
+            self.assertEqual(process.wait_for_markers(es, ['done-1'], 'run')['run'], 'run')
+
+    def test_join_run(self):
+        '''the other shards follow whether the first one is incremental'''
+        process = scoring_process(shard=1, shards=2, manifest='manifest.tsv', incremental=True)
+        es = markers_client({'created': 'run'}, {'incremental': False, 'configuration': 'abc'})
+        self.assertEqual(process.join_run(es, True, 'abc'), ('run', False))
+
+        es = markers_client({'created': 'run'}, {'incremental': True, 'configuration': 'abc'})
+        self.assertEqual(process.join_run(es, True, 'abc'), ('run', True))
+        for incremental, configuration in [(False, 'abc'), (True, 'def')]:
+            with self.assertRaises(RuntimeError):
+                process.join_run(es, incremental, configuration)
+
+    def test_wait_for_markers_timeout(self):
+        process = scoring_process(shard=1, shards=2, shard_timeout=60)
+        es = markers_client({})
+        clock = [0]
+
+        def sleep(interval):
+            clock[0] += interval
+
+        with mock.patch.object(Association.time, 'sleep', sleep), \
+                mock.patch.object(Association.time, 'time', lambda: clock[0]):
+            with self.assertRaises(RuntimeError):
+                process.wait_for_markers(es, ['created'])
+        self.assertEqual(clock[0], 90)
+
+
+class ScheduleTestCase(unittest.TestCase):
+
+    def test_split_disease_ranges(self):
+        ranges = Association.split_disease_ranges(
+            [('EFO_1', 5), ('EFO_2', 5), ('EFO_3', 5), ('EFO_4', 5)], 2)
+        self.assertEqual(ranges, [((None, 'EFO_3'), 10), (('EFO_3', None), 10)])
+
+    def test_disease_ranges_group_all_pairs(self):
+        '''the parts of a target group the same pairs as the whole target'''
+        rows = [
+            evidence('ENSG1', 'EFO_1', efo_codes=['EFO_1', 'EFO_0']),
+            evidence('ENSG1', 'EFO_2', source='chembl', efo_codes=['EFO_2', 'EFO_0']),
+            evidence('ENSG1', 'EFO_3', efo_codes=['EFO_3', 'EFO_1']),
+        ]
+
+        def pairs(diseases):
+            return sorted((disease, len(scores)) for _, disease, scores, _ in Association.group_evidence(
+                rows, {}, [], DATASOURCES_TO_DATATYPES, diseases))
+
+        parts = pairs((None, 'EFO_1')) + pairs(('EFO_1', 'EFO_3')) + pairs(('EFO_3', None))
+        self.assertEqual(sorted(parts), pairs(None))
+
+    def test_scheduled_targets(self):
+        '''heaviest targets first, big ones split, targets without evidence skipped'''
+        process = scoring_process(evidence_reader='target', schedule='cost', split_evidence=10)
+        counts = {'target.id': [('ENSG1', 2), ('ENSG2', 20), ('ENSG3', 5)],
+                  'private.efo_codes': [('EFO_1', 10), ('EFO_2', 10), ('EFO_3', 10)]}
+
+        def get_evidence_counts(es, index, field, query=None):
+            return iter(counts[field])
+
+        with mock.patch.object(process, 'get_targets', lambda es: iter(['ENSG0', 'ENSG1', 'ENSG2', 'ENSG3'])):
+            with mock.patch.object(Association, 'get_evidence_counts', get_evidence_counts):
+                tasks = list(process.get_scheduled_targets(None))
+
+        self.assertEqual(tasks, [('ENSG2', ('EFO_2', None)), ('ENSG2', (None, 'EFO_2')), 'ENSG3', 'ENSG1'])
+
+
+class WeightingsTestCase(unittest.TestCase):
+
+    def test_score_columns_matches_weighted_grouping(self):
+        '''weights applied to the columns give the same documents as weighting when grouping'''
+        rows = [
+            evidence('ENSG1', 'EFO_1', efo_codes=['EFO_1', 'EFO_0']),
+            evidence('ENSG1', 'EFO_2', source='chembl', score=0.9, efo_codes=['EFO_2', 'EFO_0']),
+            evidence('ENSG1', 'EFO_2', source='chembl', score=0.3, efo_codes=['EFO_2']),
+        ]
+        scorer = Association.Scorer()
+        columns = scorer.get_columns(Association.group_evidence(rows, {}, [], DATASOURCES_TO_DATATYPES),
+            DATASOURCES_TO_DATATYPES)
+
+        for weights in [{}, {'chembl': 0.2}, {'chembl': 3., 'europepmc': 0.}]:
+            expected = scorer.score_records(Association.group_evidence(rows, weights, [], 
+                DATASOURCES_TO_DATATYPES), DATASOURCES_TO_DATATYPES)
+            records = scorer.score_columns(columns, weights)
+            self.assertEqual([r.to_json() for r in records], [r.to_json() for r in expected])
+
+    def test_score_target_weightings(self):
+        '''each weighting is written to its own index'''
+        lookup = LookUpDataRetriever(None).lookup
+        lookup.available_genes = lookup.available_hpa = lookup.available_efos = MemoryLookup()
+        batch = ('ENSG1', [evidence('ENSG1', 'EFO_1'), 
+            evidence('ENSG1', 'EFO_1', source='chembl', score=0.8)])
+
+        count, data = Association.score_target(batch, None, None, 
+            [('index', {}), ('index-nochembl', {'chembl': 0.})], [], DATASOURCES_TO_DATATYPES, 
+            Association.Scorer(), Association.AssociationEnricher(lookup, 16, 16))
+        lines = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+        self.assertEqual(count, 2)
+        self.assertEqual([line['index']['_index'] for line in lines[::2]], ['index', 'index-nochembl'])
+        self.assertEqual(lines[1]['harmonic-sum']['datasources']['chembl'], 0.8)
+        self.assertEqual(lines[3]['harmonic-sum']['datasources']['chembl'], 0.)
+
+
+class PartialAggregateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        self.rows = [evidence('ENSG1', 'EFO_%d' % rng.randint(0, 3), 
+                source=rng.choice(['europepmc', 'chembl']), score=rng.random(),
+                efo_codes=['EFO_%d' % rng.randint(0, 3), 'EFO_9'])
+            for _ in range(500)]
+        self.evidence_sets = Association.group_evidence(self.rows, {}, [], DATASOURCES_TO_DATATYPES)
+
+    def assertSameDocuments(self, first, second):
+        for a, b in zip(first, second):
+            a, b = json.loads(a.to_json()), json.loads(b.to_json())
+            for facet in ['datasource', 'datatype', 'free_text_search']:
+                self.assertEqual(sorted(a['private']['facets'].pop(facet)),
+                    sorted(b['private']['facets'].pop(facet)))
+            self.assertEqual(a, b)
+
+    def test_partials_score_as_evidence(self):
+        '''partials keep what the scores depend on, even with more than 100 evidence'''
+        self.assertTrue(any(len(e[2]) > Association.PARTIAL_SCORES for e in self.evidence_sets))
+        scorer = Association.Scorer()
+        partials = sorted(Association.get_partials(self.evidence_sets))
+        columns = scorer.get_partial_columns(partials, DATASOURCES_TO_DATATYPES)
+
+        for weights in [{}, {'chembl': 0.3}]:
+            expected = scorer.score_columns(scorer.get_columns(self.evidence_sets, 
+                DATASOURCES_TO_DATATYPES), weights)
+            expected.sort(key=lambda r: r.id)
+            self.assertSameDocuments(scorer.score_columns(columns, weights), expected)
+
+    def test_partials_not_sharded(self):
+        '''a shard would store the partials of its own targets only'''
+        with self.assertRaises(ValueError):
+            scoring_process(partials='partials.sqlite', shard=1, shards=2)
+
+    def test_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = Association.PartialAggregateStore(os.path.join(directory, 'partials.sqlite'))
+            store.put(Association.get_partials(self.evidence_sets))
+            store.commit()
+            self.assertEqual(store.get_targets(['chembl']), set(['ENSG1']))
+            self.assertEqual(list(store.get_target('ENSG1')), 
+                sorted(Association.get_partials(self.evidence_sets)))
+
+            store.delete_datasources(['chembl'])
+            self.assertEqual(store.get_targets(['chembl']), set())
+            self.assertEqual(set(p[2] for p in store.get_target('ENSG1')), set(['europepmc']))
+            store.close()
+        finally:
+            shutil.rmtree(directory)
@@ -1,5 +1,28 @@
+import gzip
+import os
+import random
+import shutil
+import struct
+import tempfile
 import unittest
-from mrtarget.common.IO import check_to_open
+import zlib
+
+from mrtarget.common.IO import check_to_open, make_iter_batches, make_iter_lines, \
+    make_parallel_iter_batches, get_line_ranges, iter_range_lines, count_range_lines
+
+
+def write_bgzf(filename, data, block_size):
+    """write data block gzipped in blocks of block_size bytes, as bgzip does"""
+    with open(filename, 'wb') as f:
+        for i in range(0, len(data), block_size):
+            block = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            compressed = compressor.compress(block) + compressor.flush()
+            f.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' +
+                struct.pack('<H', len(compressed) + 25) + compressed +
+                struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+        #empty end of file block
+        f.write(bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000'))
 
 
 class IOTests(unittest.TestCase):
@@ -10,3 +33,67 @@ class IOTests(unittest.TestCase):
     def test_check_to_open_true(self):
         filename = 'https://www.google.com/robots.txt'
         self.assertTrue(check_to_open(filename),'google robots url must exist')
+
+    def test_make_iter_batches(self):
+        lines = [('f', (i, b'x' * i)) for i in range(1, 8)]
+        batches = list(make_iter_batches(iter(lines), 3))
+        self.assertEqual([len(b) for b in batches], [3, 3, 1], 'batches are closed by number of lines')
+        self.assertEqual(sum(batches, []), lines, 'lines keep their order')
+
+        batches = list(make_iter_batches(iter(lines), 3, 9))
+        self.assertEqual([[e[1][0] for e in b] for b in batches], [[1, 2, 3], [4, 5], [6, 7]],
+            'batches are closed by bytes')
+        self.assertEqual(list(make_iter_batches(iter([]), 3)), [])
+
+
+class LineRangeTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_line_ranges(self):
+        rng = random.Random(1)
+        for trial in range(50):
+            data = b''.join(b'x' * rng.randint(0, 300) + b'\n' for _ in range(rng.randint(0, 40)))
+            if data and trial % 3 == 0:
+                data = data[:-1]
+            plain = os.path.join(self.directory, 'evidence.json')
+            with open(plain, 'wb') as f:
+                f.write(data)
+            bgzf = os.path.join(self.directory, 'evidence.json.gz')
+            write_bgzf(bgzf, data, rng.randint(1, 500))
+            self.assertEqual(gzip.open(bgzf).read(), data)
+
+            for filename, range_bytes in ((plain, rng.randint(1, 2000)), (bgzf, rng.randint(1, 400))):
+                ranges = get_line_ranges(filename, range_bytes)
+                lines = []
+                for line_range in ranges:
+                    range_lines = list(iter_range_lines(line_range))
+                    if line_range != ranges[-1]:
+                        self.assertEqual(count_range_lines(line_range), len(range_lines))
+                    lines.extend(range_lines)
+                self.assertEqual(lines, data.splitlines(True), 'every line is read once, whole')
+
+    def test_parallel_batches(self):
+        plain = os.path.join(self.directory, 'plain.json')
+        with open(plain, 'wb') as f:
+            f.write(b''.join(b'{"n": %d}\n' % i for i in range(5000)))
+        bgzf = os.path.join(self.directory, 'bgzf.json.gz')
+        write_bgzf(bgzf, b''.join(b'{"m": %d}\n' % i for i in range(3000)), 6000)
+        gzipped = os.path.join(self.directory, 'gzipped.json.gz')
+        with gzip.open(gzipped, 'wb') as f:
+            f.write(b'{"k": 1}\n{"k": 2}\n')
+        filenames = [plain, bgzf, gzipped]
+
+        expected = sorted((f, n, l if isinstance(l, bytes) else l.encode('utf-8'))
+            for f, (n, l) in make_iter_lines(filenames))
+        lines = sorted((f, n, l) for batch in make_parallel_iter_batches(filenames, 100, 0, 2, 4000)
+            for f, (n, l) in batch)
+        self.assertEqual(lines, expected, 'lines keep the filename and line number they have')
+
+        skip = lambda f, n: f == plain and n % 7 != 0
+        lines = sorted((f, n, l) for batch in make_parallel_iter_batches(filenames, 100, 0, 2, 4000,
+            skip=skip) for f, (n, l) in batch)
+        self.assertEqual(lines, [e for e in expected if not skip(e[0], e[1])], 'skipped lines are left out')
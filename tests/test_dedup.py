@@ -0,0 +1,32 @@
+import os
+import unittest
+
+from mrtarget.common.dedup import BloomFilter, DuplicateFilter
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_added(self):
+        '''added keys are always found, others rarely'''
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('key %d' % i)
+        self.assertTrue(all('key %d' % i in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(10000) if 'other %d' % i in bloom)
+        self.assertLess(false_positives, 300)
+
+
+class DuplicateFilterTestCase(unittest.TestCase):
+
+    def test_duplicates(self):
+        '''repeats are confirmed on disk, false positives of the filter are not repeats'''
+        duplicates = DuplicateFilter(10, 0.5, commit_keys=3)
+        keys = ['key %d' % i for i in range(200)]
+        self.assertEqual([duplicates.add(key) for key in keys], [False] * 200)
+        self.assertGreater(duplicates.false_positives, 0)
+        self.assertEqual([duplicates.add(key) for key in keys[::10]], [True] * 20)
+        self.assertEqual(duplicates.duplicates, 20)
+
+        filename = duplicates.filename
+        duplicates.close()
+        self.assertFalse(os.path.exists(filename))
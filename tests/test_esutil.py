@@ -0,0 +1,316 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from mrtarget.common.esutil import ElasticsearchBulkIndexManager, ElasticsearchSink, BulkFileSink, \
+    BulkWriter, is_routing_required, list_bulk_files, load_bulk_folder
+
+SETTINGS = {"index": {"refresh_interval": "1s", "number_of_shards": "32",
+                      "translog": {"durability": "request"}, "number_of_replicas": "0"}}
+
+
+def bulk_client(exists=True):
+    client = mock.MagicMock()
+    client.indices.exists.return_value = exists
+    client.indices.get_settings.return_value = {"evidence": {"settings": {"index": {
+        "number_of_replicas": "1", "refresh_interval": "-1"}}}}
+    client.cat.indices.return_value = "green open evidence"
+    return client
+
+
+class ElasticsearchBulkIndexManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('mrtarget.common.esutil.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restored_settings(self, client):
+        return client.indices.put_settings.call_args_list[-1][1]["body"]["index"]
+
+    def test_replace(self):
+        '''the index is replaced, and given back the settings it had'''
+        client = bulk_client()
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS):
+            pass
+        client.indices.delete.assert_called_once()
+        self.assertEqual(self.restored_settings(client)["number_of_replicas"], "1")
+        client.indices.forcemerge.assert_called_once()
+
+    def test_resume(self):
+        '''a resumed index is appended to, and given the settings it was created with'''
+        client = bulk_client()
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, resume=True):
+            pass
+        client.indices.delete.assert_not_called()
+        self.assertEqual(self.restored_settings(client), {"number_of_replicas": "0",
+            "refresh_interval": "1s", "translog.durability": "request"})
+
+    def test_keep_on_error(self):
+        '''an index that failed to load can be left in bulk mode'''
+        client = bulk_client()
+        with self.assertRaises(ValueError):
+            with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, keep_on_error=True):
+                raise ValueError()
+        self.assertEqual(self.restored_settings(client)["refresh_interval"], -1)
+        client.indices.forcemerge.assert_not_called()
+
+
+class AliasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('mrtarget.common.esutil.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def alias_client(self, aliased):
+        client = bulk_client()
+        client.indices.get_alias.return_value = aliased or {"error": "missing", "status": 404}
+        client.indices.get_settings.side_effect = lambda index: {index: {"settings": {"index": {
+            "number_of_replicas": "1", "refresh_interval": "1s"}}}}
+        return client
+
+    def test_swap(self):
+        '''a new version is loaded while the alias stays on the live index, then moved'''
+        client = self.alias_client({"evidence-20200101000000": {"aliases": {"evidence": {}}}})
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, alias=True) as manager:
+            self.assertRegex(manager.target, r"^evidence-\d{14}$")
+            client.indices.delete.assert_not_called()
+            client.indices.update_aliases.assert_not_called()
+        client.indices.create.assert_called_once()
+        self.assertEqual(client.indices.create.call_args[1]["index"], manager.target)
+        actions = client.indices.update_aliases.call_args[1]["body"]["actions"]
+        self.assertEqual(actions, [{"add": {"index": manager.target, "alias": "evidence"}},
+            {"remove": {"index": "evidence-20200101000000", "alias": "evidence"}}])
+        client.indices.delete.assert_called_once_with(index="evidence-20200101000000", ignore=[404])
+
+    def test_replace_index(self):
+        '''an index with the name of the alias is replaced by it'''
+        client = self.alias_client(None)
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, alias=True):
+            pass
+        actions = client.indices.update_aliases.call_args[1]["body"]["actions"]
+        self.assertEqual(actions[1], {"remove_index": {"index": "evidence"}})
+        client.indices.delete.assert_not_called()
+
+    def test_failed_load(self):
+        '''a failed load is deleted and the alias is not moved'''
+        client = self.alias_client(None)
+        with self.assertRaises(ValueError):
+            with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, alias=True) as manager:
+                raise ValueError()
+        client.indices.update_aliases.assert_not_called()
+        client.indices.delete.assert_called_once_with(index=manager.target, ignore=[404])
+
+    def test_finalize(self):
+        '''the merge can be started without waiting, or left for later with the replicas'''
+        client = self.alias_client(None)
+        client.cat.indices.return_value = "yellow open evidence"
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, finalize="async") as manager:
+            pass
+        manager.merge_thread.join()
+        client.indices.forcemerge.assert_called_once_with(index=manager.target, max_num_segments=1,
+            request_timeout=ElasticsearchBulkIndexManager.MERGE_TIMEOUT)
+        self.assertEqual(client.indices.put_settings.call_args[1]["body"]["index"]["number_of_replicas"], "1")
+
+        client = self.alias_client(None)
+        client.cat.indices.return_value = "yellow open evidence"
+        with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, finalize="defer"):
+            pass
+        client.indices.forcemerge.assert_not_called()
+        self.assertNotIn("number_of_replicas", client.indices.put_settings.call_args[1]["body"]["index"])
+
+    def test_async_forcemerge_request(self):
+        '''the async merge only sends parameters every supported version accepts'''
+        client = Elasticsearch()
+        client.transport.perform_request = mock.Mock(return_value={})
+        manager = ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, 
+            finalize="async", status_timeout=600)
+        manager.start_forcemerge()
+        manager.merge_thread.join()
+        args, kwargs = client.transport.perform_request.call_args
+        self.assertEqual(args, ("POST", "/evidence/_forcemerge"))
+        self.assertEqual(kwargs["params"], {"max_num_segments": "1", "request_timeout": 600})
+
+    def test_status_timeout(self):
+        '''waiting for the status of an index gives up after the timeout'''
+        client = self.alias_client(None)
+        client.cat.indices.return_value = "yellow open evidence"
+        with self.assertRaises(RuntimeError):
+            with ElasticsearchBulkIndexManager(client, "evidence", SETTINGS, status_timeout=0):
+                pass
+
+    def test_sink_target(self):
+        '''actions for an index loaded behind an alias go to the new version'''
+        client = self.alias_client(None)
+        client.transport.serializer = JSONSerializer()
+        client.bulk.side_effect = lambda body: {"items": [{"index": {"status": 201}}]}
+        sink = ElasticsearchSink(client, alias=True)
+        with sink.index("evidence", SETTINGS) as manager:
+            list(sink.bulk([{"_index": "evidence", "_id": "1", "_source": {}}], thread_count=0))
+            ndjson = b'{"index":{"_index":"evidence","_id":"2"}}\n{}\n'
+            list(sink.bulk_ndjson([(1, ndjson)], thread_count=0))
+        bodies = [c[1]["body"] for c in client.bulk.call_args_list]
+        for body in bodies:
+            self.assertEqual(json.loads(body.splitlines()[0])["index"]["_index"], manager.target)
+
+
+class RoutingTestCase(unittest.TestCase):
+
+    def test_is_routing_required(self):
+        client = mock.MagicMock()
+        client.indices.get_mapping.return_value = {"evidence-1": {"mappings": {
+            "_routing": {"required": True}, "properties": {}}}}
+        self.assertTrue(is_routing_required(client, "evidence"))
+        client.indices.get_mapping.return_value = {"evidence-1": {"mappings": {"properties": {}}}}
+        self.assertFalse(is_routing_required(client, "evidence"))
+
+
+class BulkFileSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        patcher = mock.patch('mrtarget.common.esutil.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def actions(self, index, count):
+        for i in range(count):
+            yield {"_index": index, "_id": "id%d" % i, "_routing": "ENSG%d" % (i % 3),
+                   "_source": {"i": i, "name": u"é"}}
+
+    def loaded_bodies(self, client):
+        lines = b"".join(c[1]["body"] for c in client.bulk.call_args_list).splitlines()
+        return [json.loads(line) for line in lines]
+
+    def test_write_and_load(self):
+        '''actions are written to rotated files and loaded back into their index'''
+        sink = BulkFileSink(self.folder, rotate_bytes=1000, block_bytes=200, compress_threads=2)
+        mappings = {"_routing": {"required": True}}
+        with sink.index("evidence", SETTINGS, mappings):
+            results = list(sink.bulk(self.actions("evidence", 50)))
+            ndjson = b'{"index":{"_index":"evidence","_id":"raw"}}\n{"i":50}\n'
+            results.extend(sink.bulk_ndjson([(1, ndjson)]))
+        self.assertEqual(len(results), 51)
+        self.assertTrue(all(success for success, _ in results))
+        self.assertGreater(len(list_bulk_files(os.path.join(self.folder, "evidence"))), 1)
+        self.assertTrue(sink.is_routing_required("evidence"))
+
+        client = bulk_client(exists=False)
+        client.bulk.side_effect = lambda body: {"items": [{"index": {"status": 201}}] * (body.count(b"\n") // 2)}
+        self.assertEqual(load_bulk_folder(client, self.folder, thread_count=0, max_chunk_actions=10), {"evidence": 51})
+        client.indices.create.assert_called_once_with(index="evidence",
+            body={"settings": SETTINGS, "mappings": mappings})
+
+        bodies = self.loaded_bodies(client)
+        self.assertEqual(bodies[0], {"index": {"_index": "evidence", "_id": "id0", "routing": "ENSG0"}})
+        self.assertEqual(bodies[1], {"i": 0, "name": u"é"})
+        self.assertEqual([b["i"] for b in bodies[1::2]], list(range(51)))
+
+    def test_append(self):
+        '''appending keeps the files already written, replacing removes them'''
+        sink = BulkFileSink(self.folder, compress_threads=1)
+        with sink.index("evidence"):
+            list(sink.bulk(self.actions("evidence", 2)))
+        with sink.index("evidence", append_data=True):
+            list(sink.bulk(self.actions("evidence", 3)))
+        self.assertEqual(len(list_bulk_files(os.path.join(self.folder, "evidence"))), 2)
+        with sink.index("evidence"):
+            list(sink.bulk(self.actions("evidence", 1)))
+        self.assertEqual(len(list_bulk_files(os.path.join(self.folder, "evidence"))), 1)
+
+    def test_incomplete(self):
+        '''indexes that failed to be written are not loaded'''
+        sink = BulkFileSink(self.folder, compress_threads=1)
+        with self.assertRaises(ValueError):
+            with sink.index("evidence"):
+                list(sink.bulk(self.actions("evidence", 2)))
+                raise ValueError()
+        with self.assertRaises(RuntimeError):
+            load_bulk_folder(bulk_client(), self.folder)
+
+
+class BulkWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('mrtarget.common.esutil.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.MagicMock()
+        self.client.transport.serializer = JSONSerializer()
+
+    def actions(self, count, size=10):
+        for i in range(count):
+            yield {"_index": "genes", "_id": str(i), "_source": {"text": "x" * size}}
+
+    def respond(self, *statuses):
+        '''responses of the bulk requests, the given statuses for their first
+        actions then created'''
+        responses = list(statuses)
+
+        def bulk(body):
+            count = body.count(b"\n") // 2
+            status = responses.pop(0) if responses else []
+            if isinstance(status, Exception):
+                raise status
+            status = status + [201] * (count - len(status))
+            return {"items": [{"index": {"status": s, "error": "e%d" % s}} for s in status]}
+        self.client.bulk.side_effect = bulk
+
+    def bodies(self):
+        return [c[1]["body"] for c in self.client.bulk.call_args_list]
+
+    def test_bytes_bound(self):
+        '''requests are bounded by bytes as well as by actions'''
+        self.respond()
+        writer = BulkWriter(self.client, thread_count=0, max_chunk_bytes=1000, max_chunk_actions=5)
+        results = list(writer.bulk(self.actions(20, size=200)))
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(success for success, _ in results))
+        self.assertTrue(all(len(body) <= 1000 for body in self.bodies()))
+        self.assertGreater(len(self.bodies()), 4)
+
+        self.client.reset_mock()
+        list(writer.bulk(self.actions(20, size=1)))
+        self.assertEqual(len(self.bodies()), 4)
+
+    def test_retry_rejected(self):
+        '''only the rejected actions are sent again, and requests get smaller'''
+        self.respond([201, 429], TransportError(429, 'es_rejected_execution_exception'))
+        writer = BulkWriter(self.client, thread_count=2, max_chunk_bytes=100000)
+        results = list(writer.bulk(self.actions(3)))
+        self.assertEqual([success for success, _ in results], [True, True, True])
+        bodies = self.bodies()
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(bodies[1], bodies[2])
+        self.assertEqual(bodies[1].count(b"\n"), 2)
+        self.assertIn(b'"_id":"1"', bodies[1])
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(writer.retried, 2)
+        self.assertLess(writer.chunk_bytes, 100000)
+
+    def test_dead_letter(self):
+        '''actions that fail, or are rejected too often, go to the dead letter file'''
+        handle, dead_letter = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, dead_letter)
+        self.respond([400, 201, 429], [429])
+        writer = BulkWriter(self.client, thread_count=0, max_retries=1, dead_letter=dead_letter)
+        results = list(writer.bulk(self.actions(4)))
+        self.assertEqual([success for success, _ in results], [False, True, False, True])
+        self.assertEqual(len(self.bodies()), 2)
+        self.assertEqual(writer.failed, 2)
+        with open(dead_letter, "rb") as dead_letter_file:
+            lines = dead_letter_file.read().splitlines()
+        self.assertEqual([json.loads(line)["index"]["_id"] for line in lines[::2]], ["0", "2"])
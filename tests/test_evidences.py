@@ -0,0 +1,318 @@
+import collections
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import jsonschema
+
+from mrtarget.common.EvidenceString import EvidenceManager
+from mrtarget.common.hashing import CanonicalHasher
+from mrtarget.common.LookupHelpers import LookUpDataRetriever
+from mrtarget.common.LookupTables import EFOLookUpTable
+from mrtarget.common.dedup import DuplicateFilter
+from mrtarget.modules.Evidences import (ValidationCache, ValidationCheckpoint, ValidationStats,
+    drop_duplicate_actions, get_cached_actions, prefilter_evidence, process_evidence, process_evidence_batch,
+    validate_evidence)
+
+DATASOURCES_TO_DATATYPES = {'europepmc': 'literature'}
+
+ECO_LITERATURE = 'http://purl.obolibrary.org/obo/ECO_0000213'
+
+
+class MemoryGenes(object):
+    def __contains__(self, gene_id):
+        return gene_id.startswith('ENSG')
+
+    def get_gene(self, gene_id):
+        return {'id': gene_id, 'approved_symbol': 'GENE', 'approved_name': 'gene',
+                'biotype': 'protein_coding', 'is_reference': True}
+
+
+class MemoryEfos(object):
+    get_ontology_code_from_url = staticmethod(EFOLookUpTable.get_ontology_code_from_url)
+
+    def __contains__(self, efo_id):
+        return efo_id.startswith('EFO_')
+
+    def get_efo(self, efo_id):
+        return {'code': efo_id, 'label': efo_id, 'path_codes': [['EFO_0000408', efo_id]],
+                'therapeutic_codes': ['EFO_0000408'], 'therapeutic_labels': ['disease']}
+
+
+class MemoryEcos(object):
+    def get_eco(self, eco_id):
+        return {'code': eco_id, 'label': eco_id}
+
+
+def memory_lookup():
+    lookup = LookUpDataRetriever(None).lookup
+    lookup.available_genes = MemoryGenes()
+    lookup.available_efos = MemoryEfos()
+    lookup.available_ecos = MemoryEcos()
+    lookup.non_reference_genes = {}
+    return lookup
+
+
+def evidence_line(target='ENSG00000157764', disease='EFO_0000311', source='europepmc'):
+    pmid = 'http://europepmc.org/abstract/MED/1'
+    return json.dumps({'sourceID': source, 'label': 'literature', 'access_level': 'public',
+        'target': {'id': 'http://identifiers.org/ensembl/' + target,
+                   'target_type': 'http://identifiers.org/cttv.target/gene_evidence',
+                   'activity': 'http://identifiers.org/cttv.activity/unknown'},
+        'disease': {'id': 'http://www.ebi.ac.uk/efo/' + disease},
+        'unique_association_fields': {'publicationIDs': pmid, 'target': target, 'disease': disease},
+        'literature': {'references': [{'lit_id': pmid}]},
+        'evidence': {'date_asserted': '2019-06-01T00:00:00', 'is_associated': True,
+            'evidence_codes': [ECO_LITERATURE],
+            'resource_score': {'type': 'summed_total', 'method': {'description': 'text mining'},
+                               'value': 5.0},
+            'provenance_type': {'database': {'id': 'EuropePMC', 'version': '2019'}},
+            'literature_ref': {'lit_id': pmid}}}).encode('utf-8')
+
+
+class ProcessEvidenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.validator = jsonschema.validators.validator_for({})({})
+        self.lookup = memory_lookup()
+        self.directory = tempfile.mkdtemp()
+        eco_scores = os.path.join(self.directory, 'eco_scores.tsv')
+        with open(eco_scores, 'w') as eco_scores_file:
+            eco_scores_file.write('%s\tECO_0000213\t1.0\n' % ECO_LITERATURE)
+        self.evidence_manager = EvidenceManager(self.lookup, eco_scores, {}, DATASOURCES_TO_DATATYPES)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process(self, line, prefilter=False):
+        return process_evidence(('evidence.json', (3, line)), self.logger, self.validator,
+            self.lookup, DATASOURCES_TO_DATATYPES, self.evidence_manager, prefilter=prefilter)
+
+    def test_validate_keeps_parsed_evidence(self):
+        '''a valid line is handed on parsed, keyed by its unique association fields'''
+        left, right = validate_evidence(('evidence.json', (3, evidence_line())), self.logger,
+            self.validator, self.lookup, DATASOURCES_TO_DATATYPES)
+
+        self.assertIsNone(left)
+        self.assertIsInstance(right['line'], dict)
+        self.assertEqual(right['line']['id'], right['hash'])
+        self.assertEqual(right['line']['type'], 'literature')
+        self.assertEqual(right['line']['unique_association_fields']['datasource'], 'europepmc')
+
+    def test_valid_evidence_is_serialized_once_processed(self):
+        '''the processed evidence is written out as json, scored and extended'''
+        left, right = self.process(evidence_line())
+
+        self.assertIsNone(left)
+        self.assertTrue(right['is_valid'])
+        self.assertEqual((right['filename'], right['line_n']), ('evidence.json', 3))
+        evidence = json.loads(right['line'])
+        self.assertEqual(evidence['id'], right['hash'])
+        self.assertEqual(evidence['target']['id'], 'ENSG00000157764')
+        self.assertEqual(evidence['disease']['id'], 'EFO_0000311')
+        self.assertIn('association_score', evidence['scores'])
+
+    def test_invalid_evidence(self):
+        '''faulty lines are explained on the left'''
+        left, right = self.process(b'{not json')
+        self.assertIsNone(right)
+        self.assertEqual(left['explanation_type'], 'unparseable_json')
+
+        left, right = self.process(evidence_line(source='unknown'))
+        self.assertIsNone(right)
+        self.assertEqual(left['explanation_type'], 'unsupported_datasource')
+
+        left, right = self.process(evidence_line(target='UNKNOWN'))
+        self.assertIsNone(right)
+        self.assertFalse(left['is_valid'])
+
+    def test_prefilter(self):
+        '''lines with unknown fields are rejected unparsed, explained and stored as when fully validated'''
+        for kwargs in ({'source': 'unknown'}, {'target': 'UNKNOWN'}, {'disease': 'HP_0000001'},
+                       {'target': 'UNKNOWN', 'disease': 'HP_0000001'}):
+            line = evidence_line(**kwargs)
+            left, right = self.process(line, prefilter=True)
+            self.assertIsNone(right)
+            expected, _ = self.process(line)
+            for field in ('explanation_type', 'explanation_str', 'data_source', 'target_id', 'efo_id'):
+                self.assertEqual(left[field], expected[field], field)
+            self.assertEqual(left['id'], expected['id'])
+            #the id does not depend on the order of the keys either
+            reordered = json.dumps(json.loads(line), sort_keys=True).encode('utf-8')
+            self.assertNotEqual(reordered, line)
+            self.assertEqual(self.process(reordered, prefilter=True)[0]['id'], left['id'])
+
+        left, right = self.process(evidence_line(), prefilter=True)
+        self.assertIsNone(left)
+        self.assertEqual(right, self.process(evidence_line())[1])
+
+    def test_prefilter_ambiguous(self):
+        '''lines are only rejected by fields that are surely the ones looked at when validating'''
+        evidence = json.loads(evidence_line(disease='HP_0000001'))
+        cases = [dict(evidence, sourceID=None),
+                 dict(evidence, disease={'name': {'en': 'nested'}, 'id': evidence['disease']['id']}),
+                 dict(evidence, disease={'name': 'escaped \" quote', 'id': evidence['disease']['id']}),
+                 dict(evidence, extra={'disease': {'id': 'EFO_0000311'}})]
+        for case in cases:
+            self.assertIsNone(prefilter_evidence(json.dumps(case), self.lookup, DATASOURCES_TO_DATATYPES))
+        self.assertIsNotNone(prefilter_evidence(json.dumps(evidence), self.lookup, DATASOURCES_TO_DATATYPES))
+
+    def test_process_evidence_batch(self):
+        '''a batch of lines comes back as actions in the order of the lines'''
+        batch = [('evidence.json', (1, evidence_line())),
+                 ('evidence.json', (2, b'{not json')),
+                 ('evidence.json', (3, evidence_line(disease='EFO_0000001'))),
+                 ('other.json', (7, evidence_line(disease='EFO_0000002')))]
+        actions, misses, hits, spans, stats = process_evidence_batch(batch, self.logger, self.validator, self.lookup,
+            DATASOURCES_TO_DATATYPES, self.evidence_manager, CanonicalHasher(),
+            index_valid='valid', index_invalid='invalid')
+        self.assertEqual((misses, hits), ([], 0))
+        self.assertEqual(spans, [('evidence.json', 1, 3), ('other.json', 7, 7)])
+        self.assertEqual(stats.datasources['europepmc']['lines'], 3)
+        self.assertEqual(stats.rejections, {('unknown', 'unparseable_json'): 1})
+
+        self.assertEqual([a['_index'] for a in actions], ['valid', 'invalid', 'valid', 'valid'])
+        self.assertEqual(actions[1]['_source']['line_n'], 2)
+        self.assertEqual(actions[1]['_id'], CanonicalHasher().hash_line('{not json'))
+        self.assertEqual(json.loads(actions[2]['_source'])['id'], actions[2]['_id'])
+        self.assertNotEqual(actions[0]['_id'], actions[2]['_id'])
+
+    def test_drop_duplicates(self):
+        '''repeats of an evidence are dropped and counted by datasource'''
+        def process(batch):
+            return process_evidence_batch(batch, self.logger, self.validator, self.lookup,
+                DATASOURCES_TO_DATATYPES, self.evidence_manager, CanonicalHasher(),
+                index_valid='valid', index_invalid='invalid')
+
+        results = [process([('first.json', (1, evidence_line())), ('first.json', (2, b'{not json'))]),
+                   process([('second.json', (1, b'{not json')), ('second.json', (2, evidence_line())),
+                            ('second.json', (3, evidence_line(disease='EFO_0000001')))])]
+        duplicates = DuplicateFilter(100)
+        counts = collections.Counter()
+        batches = list(drop_duplicate_actions(results, duplicates, 'valid', counts))
+        duplicates.close()
+
+        self.assertEqual(batches[0][0], results[0][0])
+        self.assertEqual(batches[1][0], results[1][0][2:])
+        self.assertEqual(batches[1][3], [('second.json', 1, 3)])
+        self.assertEqual(counts, {'europepmc': 1, 'invalid': 1})
+
+    def test_validation_stats(self):
+        '''stats of batches are merged into counts, timings and rejections by datasource'''
+        stats = ValidationStats()
+        for lines in ([evidence_line(), evidence_line(target='UNKNOWN')],
+                      [evidence_line(source='unknown'), evidence_line(disease='EFO_0000001')]):
+            batch = [('evidence.json', (n, line)) for n, line in enumerate(lines)]
+            stats.merge(process_evidence_batch(batch, self.logger, self.validator, self.lookup,
+                DATASOURCES_TO_DATATYPES, self.evidence_manager, CanonicalHasher(),
+                index_valid='valid', index_invalid='invalid')[4])
+
+        metrics = stats.metrics()
+        self.assertEqual(metrics['evidence.validation.europepmc.lines'], 3)
+        self.assertEqual(metrics['evidence.validation.europepmc.valid'], 2)
+        self.assertEqual(metrics['evidence.validation.europepmc.bytes'], sum(len(evidence_line(**kwargs))
+            for kwargs in ({}, {'target': 'UNKNOWN'}, {'disease': 'EFO_0000001'})))
+        self.assertEqual(sum(metrics['evidence.validation.europepmc.histogram']), 3)
+        self.assertGreater(metrics['evidence.validation.europepmc.seconds.extend'], 0)
+        self.assertEqual(metrics['evidence.rejected.europepmc.invalid_target'], 1)
+        self.assertEqual(metrics['evidence.rejected.unknown.unsupported_datasource'], 1)
+
+    def test_validation_cache(self):
+        '''lines already in the cache are not processed again'''
+        filename = os.path.join(self.directory, 'cache.sqlite')
+        cache = ValidationCache(filename)
+        worker_cache = ValidationCache(filename, read_only=True)
+
+        def run(batch):
+            results = [process_evidence_batch(batch, self.logger, self.validator, self.lookup,
+                DATASOURCES_TO_DATATYPES, self.evidence_manager, CanonicalHasher(), worker_cache,
+                index_valid='valid', index_invalid='invalid')]
+            hits = sum(r[2] for r in results)
+            return list(get_cached_actions(results, cache, 'valid', self.logger)), hits
+
+        batch = [('first.json', (1, evidence_line())), ('first.json', (2, b'{not json'))]
+        first, hits = run(batch)
+        self.assertEqual(hits, 0)
+
+        batch = [('second.json', (5, b'{not json')), ('second.json', (6, evidence_line())),
+                 ('second.json', (7, evidence_line(disease='EFO_0000001')))]
+        second, hits = run(batch)
+        self.assertEqual(hits, 2)
+
+        self.assertEqual(second[1], first[0])
+        self.assertEqual(second[0]['_id'], first[1]['_id'])
+        self.assertEqual(json.loads(second[0]['_source'])['filename'], 'second.json')
+        self.assertEqual(json.loads(second[0]['_source'])['line_n'], 5)
+        self.assertEqual(second[2]['_index'], 'valid')
+        worker_cache.close()
+        cache.close()
+
+    def test_route_by_target(self):
+        '''valid evidence is routed by the target it has once fixed, also from the cache'''
+        filename = os.path.join(self.directory, 'cache.sqlite')
+        cache = ValidationCache(filename)
+        batch = [('evidence.json', (1, evidence_line())), ('evidence.json', (2, b'{not json'))]
+        for _ in range(2):
+            results = [process_evidence_batch(batch, self.logger, self.validator, self.lookup,
+                DATASOURCES_TO_DATATYPES, self.evidence_manager, CanonicalHasher(), cache,
+                index_valid='valid', index_invalid='invalid', route_by_target=True)]
+            actions = list(get_cached_actions(results, cache, 'valid', self.logger))
+            self.assertEqual(actions[0]['_routing'], 'ENSG00000157764')
+            self.assertNotIn('_routing', actions[1])
+        self.assertEqual(results[0][2], 2)
+        cache.close()
+
+
+class ValidationCheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lines(self):
+        '''lines are kept as merged intervals'''
+        checkpoint = ValidationCheckpoint(self.filename, 'configuration')
+        for first, last in ((10, 19), (1, 4), (30, 30), (5, 8), (20, 25), (2, 3)):
+            checkpoint.add('evidence.json', first, last)
+        self.assertEqual(checkpoint.lines['evidence.json'], [[1, 8], [10, 25], [30, 30]])
+        self.assertEqual(checkpoint.count(), 25)
+        self.assertTrue(checkpoint.contains('evidence.json', 1))
+        self.assertTrue(checkpoint.contains('evidence.json', 25))
+        self.assertFalse(checkpoint.contains('evidence.json', 9))
+        self.assertFalse(checkpoint.contains('evidence.json', 31))
+        self.assertFalse(checkpoint.contains('other.json', 1))
+
+    def test_acknowledge(self):
+        '''the lines of a batch are recorded once all of its actions are acknowledged'''
+        checkpoint = ValidationCheckpoint(self.filename, 'configuration')
+        results = [([1, 2], [], 0, [('a.json', 1, 2)]),
+                   ([], [], 0, [('a.json', 3, 4)]),
+                   ([3, 4], [], 0, [('a.json', 5, 5), ('b.json', 1, 1)])]
+        actions = (action for r in checkpoint.track(results) for action in r[0])
+
+        self.assertEqual([next(actions), next(actions), next(actions)], [1, 2, 3])
+        checkpoint.acknowledge(3)
+        self.assertEqual(checkpoint.lines, {'a.json': [[1, 4]]})
+        self.assertEqual(list(actions), [4])
+        checkpoint.acknowledge(4)
+        self.assertEqual(checkpoint.lines, {'a.json': [[1, 5]], 'b.json': [[1, 1]]})
+
+    def test_resume(self):
+        '''a checkpoint is only resumed with the same configuration'''
+        checkpoint = ValidationCheckpoint(self.filename, 'configuration')
+        checkpoint.add('a.json', 1, 10)
+        checkpoint.save()
+
+        resumed = ValidationCheckpoint(self.filename, 'configuration')
+        resumed.load()
+        self.assertTrue(resumed.contains('a.json', 10))
+
+        with self.assertRaises(RuntimeError):
+            ValidationCheckpoint(self.filename, 'other configuration').load()
@@ -0,0 +1,47 @@
+import hashlib
+import pickle
+import unittest
+
+import simplejson as json
+
+from mrtarget.common.hashing import CanonicalHasher, HASH_ALGORITHMS, canonical_json
+
+
+UNIQUE_FIELDS = {'target': 'http://identifiers.org/ensembl/ENSG00000157764',
+                 'disease_id': 'http://www.ebi.ac.uk/efo/EFO_0000311',
+                 'publicationIDs': u'http://europepmc.org/abstract/MED/1 é',
+                 'score': 0.1, 'rank': 3, 'flag': None}
+
+
+class CanonicalHasherTestCase(unittest.TestCase):
+
+    def test_canonical_json(self):
+        '''canonical json is what simplejson.dumps(sort_keys=True) gives'''
+        evidence = {'b': [1, 2.5, {'d': True, 'c': None}], 'a': UNIQUE_FIELDS}
+        self.assertEqual(canonical_json(evidence), json.dumps(evidence, sort_keys=True))
+
+    def test_md5_ids(self):
+        '''md5 ids are the ones of previous releases'''
+        expected = hashlib.md5(json.dumps(UNIQUE_FIELDS, sort_keys=True).encode("utf-8")).hexdigest()
+        self.assertEqual(CanonicalHasher().hash_object(UNIQUE_FIELDS), expected)
+        self.assertEqual(CanonicalHasher('md5').hash_object(UNIQUE_FIELDS), expected)
+
+    def test_hash_line(self):
+        '''lines are hashed canonically, or as they are if they are not json'''
+        for algorithm in ('md5', 'sha1', 'blake2b'):
+            hasher = CanonicalHasher(algorithm)
+            self.assertEqual(hasher.hash_line('{"a": 1, "b": [2]}'), hasher.hash_line('{"b":[2],"a":1}'))
+            self.assertEqual(hasher.hash_line('{"a": 1}'), hasher.hash_object({'a': 1}))
+            self.assertNotEqual(hasher.hash_line('{"a": 1}'), hasher.hash_line('{"a": 2}'))
+        self.assertEqual(CanonicalHasher().hash_line('{not json'), hashlib.md5(b'{not json').hexdigest())
+
+    def test_pickle(self):
+        '''hashers are sent to validation processes'''
+        hasher = pickle.loads(pickle.dumps(CanonicalHasher('blake2b')))
+        self.assertEqual(hasher.algorithm, 'blake2b')
+        self.assertEqual(hasher.hash_object(UNIQUE_FIELDS), CanonicalHasher('blake2b').hash_object(UNIQUE_FIELDS))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            CanonicalHasher('crc')
+        self.assertIn('md5', HASH_ALGORITHMS)
@@ -0,0 +1,55 @@
+import unittest
+
+import mock
+from elasticsearch_dsl.response import Hit
+
+from mrtarget.common import LookupTables
+from mrtarget.common.LookupTables import EFOLookUpTable, GeneLookUpTable
+
+
+class FakeSearch(object):
+    '''a Search that scans the given documents, whatever it is asked'''
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __call__(self):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def scan(self):
+        for _id, source in self.documents:
+            yield Hit({'_id': _id, '_source': source})
+
+
+class UniverseTestCase(unittest.TestCase):
+
+    def test_gene_universe(self):
+        '''gene ids and uniprot accessions are read with one scan and answered from memory'''
+        genes = [('ENSG1', {'uniprot_id': 'P1', 'uniprot_accessions': ['P1', 'Q1']}),
+                 ('ENSG2', {'uniprot_id': '', 'uniprot_accessions': ['Q1', 'Q2']}),
+                 ('ENSG3', {})]
+        with mock.patch.object(LookupTables, 'Search', FakeSearch(genes)):
+            universe = GeneLookUpTable.load_universe(None, 'genes')
+
+        with mock.patch.object(LookupTables, 'Search', side_effect=AssertionError('no queries')):
+            table = GeneLookUpTable(None, 'genes', 0, 0, 0, universe)
+            self.assertIn('ENSG3', table)
+            self.assertNotIn('ENSG4', table)
+            self.assertEqual(table.get_uniprot2ensembl('P1'), 'ENSG1')
+            self.assertEqual(table.get_uniprot2ensembl('Q2'), 'ENSG2')
+            self.assertIsNone(table.get_uniprot2ensembl('P9'))
+            with self.assertRaises(ValueError):
+                table.get_uniprot2ensembl('Q1')
+
+    def test_efo_universe(self):
+        '''disease ids are read with one scan and answered from memory'''
+        with mock.patch.object(LookupTables, 'Search', FakeSearch([('EFO_1', {}), ('HP_2', {})])):
+            universe = EFOLookUpTable.load_universe(None, 'diseases')
+
+        with mock.patch.object(LookupTables, 'Search', side_effect=AssertionError('no queries')):
+            table = EFOLookUpTable(None, 'diseases', 0, 0, universe)
+            self.assertIn('HP_2', table)
+            self.assertNotIn('EFO_3', table)
@@ -1,8 +1,77 @@
 from builtins import range
+import random
 import unittest
 
-from mrtarget.common.Scoring import HarmonicSumScorer
+from mrtarget.common.Scoring import HarmonicSumScorer, HarmonicSumBatchScorer, ScoringMethods
 from mrtarget.common.EvidenceString import DataNormaliser, Evidence
+from mrtarget.modules.Association import Association, EvidenceScore, Scorer
+
+
+DATASOURCES_TO_DATATYPES = {
+    'europepmc': 'literature',
+    'gwas_catalog': 'genetic_association',
+    'eva': 'genetic_association',
+    'uniprot': 'genetic_association',
+    'chembl': 'known_drug',
+    'expression_atlas': 'rna_expression',
+    'phenodigm': 'animal_model',
+    'reactome': 'affected_pathway',
+    'slapenrich': 'affected_pathway',
+}
+
+
+def reference_association(target, disease, evidence_scores, is_direct, datasources_to_datatypes):
+    '''association scored one HarmonicSumScorer per datasource, datatype and overall'''
+    association = Association(target, disease, is_direct,
+        list(datasources_to_datatypes.keys()), set(datasources_to_datatypes.values()))
+    for e in evidence_scores:
+        association.evidence_count['total'] += 1
+        association.evidence_count['datatypes'][e.datatype] += 1
+        association.evidence_count['datasources'][e.datasource] += 1
+        association.set_available_datatype(e.datatype)
+        association.set_available_datasource(e.datasource)
+
+    har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+    datasource_scorers = {}
+    for e in evidence_scores:
+        if e.datasource not in datasource_scorers:
+            datasource_scorers[e.datasource] = HarmonicSumScorer(buffer=100)
+        datasource_scorers[e.datasource].add(e.score)
+    overall_scorer = HarmonicSumScorer(buffer=100)
+    for datasource in datasource_scorers:
+        har_sum_score.datasources[datasource] = datasource_scorers[datasource].score(scale_factor=2, cap=1)
+        overall_scorer.add(har_sum_score.datasources[datasource])
+    datatypes_scorers = dict()
+    for ds in har_sum_score.datasources:
+        dt = datasources_to_datatypes[ds]
+        if dt not in datatypes_scorers:
+            datatypes_scorers[dt] = HarmonicSumScorer(buffer=100)
+        datatypes_scorers[dt].add(har_sum_score.datasources[ds])
+    for datatype in datatypes_scorers:
+        har_sum_score.datatypes[datatype] = datatypes_scorers[datatype].score(scale_factor=2)
+    har_sum_score.overall = overall_scorer.score(scale_factor=2)
+    return association
+
+
+def random_evidence_scores(rng, datasources_to_datatypes):
+    datasources = sorted(datasources_to_datatypes)
+    evidence_scores = []
+    for datasource in rng.sample(datasources, rng.randint(1, len(datasources))):
+        n = rng.choice([1, 2, 5, 99, 100, 101, 250])
+        kind = rng.choice(['uniform', 'ties', 'ones', 'tiny'])
+        for _ in range(n):
+            if kind == 'uniform':
+                score = rng.random()
+            elif kind == 'ties':
+                score = rng.choice([0.1, 0.25, 0.5, 0.9])
+            elif kind == 'ones':
+                score = 1.
+            else:
+                score = rng.random() * 1e-3
+            evidence_scores.append(EvidenceScore(score, datasources_to_datatypes[datasource],
+                datasource, rng.random() > 0.5))
+    rng.shuffle(evidence_scores)
+    return evidence_scores
 
 
 class HarmonicSumTestCase(unittest.TestCase):
@@ -119,6 +188,75 @@ class HarmonicSumTestCase(unittest.TestCase):
 
 
 
+class HarmonicSumBatchTestCase(unittest.TestCase):
+
+    def test_batch_matches_harmonic_sum_scorer(self):
+        '''each group of the batch must be identical to an HarmonicSumScorer'''
+        rng = random.Random(42)
+        batch = HarmonicSumBatchScorer({'a': 'x'})
+        groups = []
+        scores = []
+        n_groups = 50
+        for group in range(n_groups):
+            for _ in range(rng.choice([0, 1, 3, 100, 101, 1000])):
+                groups.append(group)
+                scores.append(rng.choice([rng.random(), 0.5, 2.]))
+
+        top, counts = batch.top_scores(groups, scores, n_groups)
+        sums = batch.harmonic_sums(top)
+        for group in range(n_groups):
+            scorer = HarmonicSumScorer(buffer=100)
+            for g, score in zip(groups, scores):
+                if g == group:
+                    scorer.add(score)
+            self.assertEqual(counts[group], groups.count(group))
+            self.assertEqual(sums[group], scorer.score(scale_factor=2))
+
+    def test_batch_empty(self):
+        batch = HarmonicSumBatchScorer(DATASOURCES_TO_DATATYPES)
+        datasource_scores, datatype_scores, overall, counts, capped = \
+            batch.score([], [], [], 2)
+        self.assertEqual(datasource_scores.shape, (2, len(DATASOURCES_TO_DATATYPES)))
+        self.assertFalse(datatype_scores.any())
+        self.assertFalse(overall.any())
+        self.assertFalse(counts.any())
+
+    def test_scorer_bit_for_bit(self):
+        '''scorer associations must serialize exactly as the per-object scoring did'''
+        rng = random.Random(7)
+        scorer = Scorer()
+        evidence_sets = []
+        for i in range(40):
+            evidence_scores = random_evidence_scores(rng, DATASOURCES_TO_DATATYPES)
+            evidence_sets.append(('ENSG%011d' % i, 'EFO_%07d' % i, evidence_scores, True))
+
+        # one pair at a time
+        for evidence_set in evidence_sets:
+            association = scorer.score(*(evidence_set + (DATASOURCES_TO_DATATYPES,)))
+            reference = reference_association(*(evidence_set + (DATASOURCES_TO_DATATYPES,)))
+            self.assertEqual(association.to_json(), reference.to_json())
+
+        # all pairs of a target in one batch
+        associations = scorer.score_many(evidence_sets, DATASOURCES_TO_DATATYPES)
+        self.assertEqual(len(associations), len(evidence_sets))
+        for association, evidence_set in zip(associations, evidence_sets):
+            reference = reference_association(*(evidence_set + (DATASOURCES_TO_DATATYPES,)))
+            self.assertEqual(association.to_json(), reference.to_json())
+
+    def test_scorer_cap(self):
+        '''a capped datasource keeps the cap value while an exact 1.0 stays a float'''
+        scorer = Scorer()
+        capped = [EvidenceScore(1., 'literature', 'europepmc', True)] * 3
+        association = scorer.score('ENSG1', 'EFO_1', capped, True, DATASOURCES_TO_DATATYPES)
+        har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+        self.assertIsInstance(har_sum_score.datasources['europepmc'], int)
+        self.assertEqual(har_sum_score.datasources['europepmc'], 1)
+        self.assertEqual(har_sum_score.overall, 1.)
+
+        single = [EvidenceScore(1., 'literature', 'europepmc', True)]
+        association = scorer.score('ENSG1', 'EFO_1', single, True, DATASOURCES_TO_DATATYPES)
+        har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+        self.assertIsInstance(har_sum_score.datasources['europepmc'], float)
 
 
 if __name__ == '__main__':
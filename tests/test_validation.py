@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import jsonschema
+
+from mrtarget.common.validation import CompiledValidator
+
+SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'required': ['sourceID', 'target'],
+    'properties': {
+        'sourceID': {'type': 'string', 'enum': ['europepmc', 'chembl']},
+        'target': {'$ref': 'target.json'},
+        'score': {'type': 'number', 'minimum': 0, 'maximum': 1},
+        'date_asserted': {'type': 'string', 'format': 'date-time'},
+        'is_associated': {'type': 'boolean', 'default': True},
+    },
+}
+
+TARGET_SCHEMA = {
+    'type': 'object',
+    'required': ['id'],
+    'properties': {'id': {'type': 'string', 'pattern': '^http://identifiers.org/'}},
+}
+
+
+class CompiledValidatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, schema in (('opentargets.json', SCHEMA), ('target.json', TARGET_SCHEMA)):
+            with open(os.path.join(self.directory, name), 'w') as schema_file:
+                json.dump(schema, schema_file)
+        schema_uri = 'file://' + os.path.join(self.directory, 'opentargets.json')
+
+        # as opentargets_validator.helpers.generate_validator_from_schema does
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            resolver = jsonschema.RefResolver(schema_uri, SCHEMA, store={})
+        self.validator = jsonschema.Draft7Validator(schema=SCHEMA, resolver=resolver)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def errors(self, validator, instance):
+        return [str(e) for e in validator.iter_errors(instance)]
+
+    def test_same_errors(self):
+        '''the compiled validator gives the errors of the jsonschema one'''
+        compiled = CompiledValidator(self.validator)
+        self.assertIsNotNone(compiled.compiled)
+
+        instances = [
+            {'sourceID': 'europepmc', 'target': {'id': 'http://identifiers.org/ensembl/ENSG1'}},
+            {'sourceID': 'europepmc', 'target': {'id': 'http://identifiers.org/ensembl/ENSG1'},
+             'score': 0.5, 'date_asserted': 'not a date'},
+            {'sourceID': 'unknown', 'target': {'id': 'http://identifiers.org/ensembl/ENSG1'}},
+            {'sourceID': 'chembl', 'target': {'id': 'ENSG1'}, 'score': 2},
+            {'sourceID': 'chembl', 'target': {}, 'score': True},
+            {'target': 'ENSG1'},
+            [],
+        ]
+        for instance in instances:
+            self.assertEqual(self.errors(compiled, instance), self.errors(self.validator, instance))
+
+    def test_no_defaults(self):
+        '''valid instances are not changed by validation'''
+        compiled = CompiledValidator(self.validator)
+        instance = {'sourceID': 'europepmc', 'target': {'id': 'http://identifiers.org/ensembl/ENSG1'}}
+        self.assertEqual(self.errors(compiled, instance), [])
+        self.assertNotIn('is_associated', instance)
+
+    def test_uncompilable_schema(self):
+        '''schemas that cannot be compiled are validated without compiling'''
+        self.validator.schema = dict(SCHEMA, properties={'target': {'$ref': 'missing.json'}})
+        compiled = CompiledValidator(self.validator)
+        self.assertIsNone(compiled.compiled)
+        errors = self.errors(compiled, {'sourceID': 'europepmc'})
+        self.assertEqual(errors, self.errors(self.validator, {'sourceID': 'europepmc'}))
+        self.assertEqual(len(errors), 1)
+
+    def test_stripped_keywords(self):
+        '''defaults and formats are ignored in referenced schemas too, not properties with their names'''
+        target = dict(TARGET_SCHEMA, properties={
+            'id': {'type': 'string', 'format': 'uri', 'default': 'none'},
+            'format': {'type': 'string'},
+            'default': {'type': 'integer'}})
+        with open(os.path.join(self.directory, 'target.json'), 'w') as schema_file:
+            json.dump(target, schema_file)
+        compiled = CompiledValidator(self.validator)
+        self.assertIsNotNone(compiled.compiled)
+
+        instance = {'sourceID': 'chembl', 'target': {'id': 'not a uri'}}
+        self.assertEqual(self.errors(compiled, instance), [])
+        self.assertEqual(instance['target'], {'id': 'not a uri'})
+        instance = {'sourceID': 'chembl', 'target': {'id': 'x', 'format': 1, 'default': 'x'}}
+        self.assertEqual(self.errors(compiled, instance), self.errors(self.validator, instance))
+        self.assertEqual(len(self.errors(compiled, instance)), 2)